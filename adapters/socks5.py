@@ -1,5 +1,4 @@
 
-import base64
 import struct
 import random
 import socket
@@ -7,6 +6,87 @@ import asyncio
 import logging
 import traceback
 
+import metrics
+
+
+# Seconds to wait for the other extreme to connect to the destination.
+CONNECT_TIMEOUT = 30.0
+
+CONNECT = 1
+UDP_ASSOCIATE = 3
+
+
+# Returns the SOCKS5 address type and bytes of an address.
+def pack_address(address):
+    for address_type, family in ((1, socket.AF_INET), (4, socket.AF_INET6)):
+        try:
+            return address_type, socket.inet_pton(family, address)
+        except (OSError, ValueError):
+            pass
+    data = address.encode('ascii')
+    return 3, struct.pack('B', len(data)) + data
+
+
+# UDP relay of a SOCKS5 UDP ASSOCIATE. The client datagrams go through the tunnel with their destination,
+# and the answers come back with the SOCKS5 UDP header of their source.
+# +-----+------+------+----------+----------+------+
+# | RSV | FRAG | ATYP | DST.ADDR | DST.PORT | DATA |
+# +-----+------+------+----------+----------+------+
+#    2      1      1
+class Association(asyncio.DatagramProtocol):
+
+    def __init__(self, sid, host, tunnel):
+        self.logger = logging.getLogger('bogeyman')
+        self.sid = sid
+        # Only the host which asked for the association can use it.
+        self.host = host
+        self.tunnel = tunnel
+        self.transport = None
+        self.client = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if address[0] != self.host or len(data) < 4:
+            return
+        self.client = address
+
+        _, fragment, address_type = struct.unpack('>HBB', data[:4])
+        try:
+            # Fragments are not supported.
+            if fragment:
+                return
+            if address_type == 1:
+                destination = socket.inet_ntoa(data[4:8])
+                offset = 8
+            elif address_type == 3:
+                offset = 5 + data[4]
+                destination = data[5:offset].decode('ascii')
+            elif address_type == 4:
+                destination = socket.inet_ntop(socket.AF_INET6, data[4:20])
+                offset = 20
+            else:
+                return
+            port = struct.unpack('>H', data[offset:offset + 2])[0]
+        except (IndexError, ValueError, struct.error):
+            self.logger.debug('[#{}] malformed datagram'.format(self.sid))
+            return
+
+        # Datagrams can be lost, so they are not queued while the tunnel is not ready.
+        self.tunnel.dispatch({'cmd': 'datagram', 'addr': destination, 'port': port, 'data': data[offset + 2:],
+                              'id': self.sid})
+
+    def error_received(self, exc):
+        self.logger.debug('[#{}] datagram error: {}'.format(self.sid, exc))
+
+    def send(self, message):
+        if self.client is None or self.transport is None:
+            return
+        address_type, address = pack_address(message['addr'])
+        header = struct.pack('>HBB', 0, 0, address_type) + address + struct.pack('>H', message['port'])
+        self.transport.sendto(header + message['data'], self.client)
+
 
 class Stream:
     def __init__(self, reader, writer):
@@ -17,6 +97,28 @@ class Stream:
         self.version = 0
         self.status = -1
         self.task = None
+        # Result of the connect command.
+        self.connected = asyncio.Future()
+
+        # Flow control (disabled when the tunnel does not support it).
+        # credit: bytes we can still send through the tunnel.
+        # window: bytes the other extreme can send us without being acknowledged.
+        # consumed: bytes written to the client but not acknowledged yet.
+        self.tunnel = None
+        self.settings = None
+        self.credit = None
+        self.credit_ready = asyncio.Event()
+        self.window = 0
+        self.max_window = 0
+        self.consumed = 0
+        self.draining = False
+
+        # UDP relay, if the client asked for a UDP ASSOCIATE.
+        self.association = None
+
+        # Stream data from the client (upload) and to it (download).
+        self.uploaded = 0
+        self.downloaded = 0
 
     def __del__(self):
         try:
@@ -58,6 +160,12 @@ class Stream:
         # +----+-----+-------+------+
         data = yield from self.reader.readexactly(4)
         _, command, _, address_type = struct.unpack('BBBB', data)
+        if command not in [CONNECT, UDP_ASSOCIATE]:
+            self.logger.debug('[#{}] command not supported'.format(self.id))
+            self.reply(7)
+            self.writer.close()
+            return None
+
         if address_type not in [1, 3]:
             self.logger.debug('[#{}] address type not supported'.format(self.id))
             # +----+-----+-----+------+----------+----------+
@@ -81,45 +189,135 @@ class Stream:
 
         # We will implement ipv6 when we need it :P.
 
+        if command == UDP_ASSOCIATE:
+            # The address is where the client will send datagrams from, we only check its host.
+            return {'cmd': 'associate', 'addr': address, 'port': port, 'id': self.id}
+
         self.logger.info('[#{}] trying to connect to {}:{}'.format(self.id, address, port))
         #with (yield from self.lock):
         #    self.streams[self.cid] = {'writer': self.writer, 'status': -1}
 
         return {'cmd': 'connect', 'addr': address, 'port': port, 'id': self.id}
 
-    @asyncio.coroutine
+    # Sends the command execution status.
+    # +----+-----+-------+------+----------+----------+
+    # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
+    # +----+-----+-------+------+----------+----------+
+    def reply(self, status, address='0.0.0.0', port=0):
+        address_type, data = pack_address(address)
+        self.writer.write(struct.pack('>BBBB', self.version, status, 0, address_type) + data + struct.pack('>H', port))
+
+    # The reply goes right away, data for the stream can come right after the status.
     def set_status(self, status):
         if self.status == -1:
-            # Sends the command execution status.
             # The client have to continue using this connection for the stream.
-            # +----+-----+-------+------+----------+----------+
-            # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
-            # +----+-----+-------+------+----------+----------+
-            self.writer.write(struct.pack('>BBBBIH', self.version, status, 0, 1, 0, 0))
+            self.reply(status)
+            self.status = status
+            self.connected.set_result(status)
+
+        elif status and self.status == 0:
+            # The other extreme lost the destination.
+            self.status = status
+            self.writer.close()
+
+    # Waits for the connect command status (6, TTL expired, if it takes too long).
+    @asyncio.coroutine
+    def wait_status(self, timeout):
+        try:
+            yield from asyncio.wait_for(asyncio.shield(self.connected), timeout)
+        except asyncio.TimeoutError:
+            self.logger.debug('[#{}] connection timeout'.format(self.id))
+            self.set_status(6)
 
-        self.status = status
         if self.status:
             try:
                 yield from self.writer.drain()
             except ConnectionResetError:
                 pass
             self.writer.close()
+        return self.status
+
+    # The settings of the tunnel connection the stream goes through tell the flow control, the size of the
+    # data messages and whether datagrams are relayed.
+    def set_tunnel(self, tunnel):
+        self.tunnel = tunnel
+        self.settings = tunnel.settings(self.id)
+        if self.settings.window is not None:
+            self.credit = self.settings.window
+            self.window = tunnel.initial_window
+            self.max_window = tunnel.max_window
+
+    @asyncio.coroutine
+    def wait_credit(self):
+        while self.credit is not None and self.credit <= 0:
+            self.credit_ready.clear()
+            yield from self.credit_ready.wait()
+
+    def add_credit(self, value):
+        if self.credit is not None:
+            self.credit += value
+            self.credit_ready.set()
+
+    # Writes data coming from the tunnel and gives the credit back once the client has read it.
+    def received(self, data):
+        self.writer.write(data)
+        self.downloaded += len(data)
+        if self.window:
+            self.consumed += len(data)
+            if not self.draining:
+                self.draining = True
+                asyncio.async(self.acknowledge())
+
+    @asyncio.coroutine
+    def acknowledge(self):
+        try:
+            yield from self.writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            self.draining = False
+
+        # Small acknowledges are delayed, the other extreme still has most of its credit.
+        if self.consumed < self.window // 4:
+            return
+
+        increment = self.consumed
+        # The client keeps up with the data, so we let the other extreme send more at once.
+        if self.consumed >= self.window // 2 and self.window < self.max_window:
+            if not self.writer.transport.get_write_buffer_size():
+                growth = min(self.window, self.max_window - self.window)
+                self.window += growth
+                increment += growth
+
+        self.consumed = 0
+        yield from self.tunnel.send({'cmd': 'window', 'value': increment, 'id': self.id})
 
 
 class Socks5:
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, connect_timeout=CONNECT_TIMEOUT, reuse_port=False):
         self.logger = logging.getLogger('bogeyman')
         self.address = address
         self.port = port
+        self.connect_timeout = float(connect_timeout)
+        # Workers share the port, the kernel spreads the clients among them.
+        self.reuse_port = reuse_port
         self.tunnel = None
 
         self.server = None
         self.loop = None
-        self.lock = asyncio.Condition()
         self.streams = {}
         self.running = False
 
+        # Metrics. Bytes of the open streams are added when they are collected.
+        self.opened = 0
+        self.failed = 0
+        self.uploaded = 0
+        self.downloaded = 0
+        self.connect_latencies = metrics.Histogram(metrics.LATENCIES)
+        self.lifetimes = metrics.Histogram(metrics.LIFETIMES)
+        self.sizes = metrics.Histogram(metrics.SIZES)
+
     def set_peer(self, peer):
         self.tunnel = peer
 
@@ -129,6 +327,9 @@ class Socks5:
         # new stream
         stream = Stream(reader, writer)
         stream.task = asyncio.Task.current_task(loop=self.loop)
+        connecting = False
+        begin = self.loop.time()
+        self.opened += 1
 
         try:
             self.streams[stream.id] = stream
@@ -138,49 +339,62 @@ class Socks5:
             command = yield from stream.socks5_command()
             assert command is not None, 'unknown socks5 command'
 
-            # Once we know where the client wants to connect to, we send the command to the tunnel.
-            while not self.tunnel.dispatch(command):
-                yield from asyncio.sleep(1.0)
-                assert self.running, 'aborting stream #{}'.format(stream.id)
-
-            # Wait until the connection status will be established
-            # TODO: We have to control how much time has passed before assume it's lost.
-            with (yield from self.lock):
-                while self.running and (stream.status == -1):
-                    self.logger.debug('[#{}] waiting until stream status change'.format(stream.id))
-                    yield from self.lock.wait()
-
-            assert self.running and stream.status == 0, 'aborting stream #{}'.format(stream.id)
-
-            # The socks5 connection is done. We can start forwarding data
-            while True:
-                try:
-                    data = yield from reader.read(8192)
-                except BrokenPipeError:
-                    data = ''
-
-                if not data:
-                    break
-
-                self.logger.debug('[#{}] received data: {}'.format(stream.id, repr(data)))
-
-                b64data = base64.b64encode(data).decode('ascii')
-                message = {'cmd': 'sync', 'data': b64data, 'id': stream.id}
-                while not self.tunnel.dispatch(message):
-                    # If the dispatch fails, we have to wait before retry.
-                    yield from asyncio.sleep(1.0)
+            stream.set_tunnel(self.tunnel)
+
+            if command['cmd'] == 'associate':
+                # The association lasts as long as this connection.
+                yield from self.associate(stream)
+            else:
+                # Once we know where the client wants to connect to, we send the command to the tunnel.
+                sent = yield from self.tunnel.send(command)
+                assert sent, 'tunnel not available, aborting stream #{}'.format(stream.id)
+                connecting = True
+
+                # Wait until the connection status will be established
+                asked = self.loop.time()
+                status = yield from stream.wait_status(self.connect_timeout)
+                if status == 0:
+                    self.connect_latencies.observe(self.loop.time() - asked)
+                else:
+                    self.failed += 1
+                assert self.running and status == 0, 'aborting stream #{}'.format(stream.id)
+
+                # The socks5 connection is done. We can start forwarding data
+                while True:
+                    yield from stream.wait_credit()
                     assert self.running, 'aborting stream #{}'.format(stream.id)
 
-            # Closing socks5 client connection
-            self.logger.debug('closing stream #{}'.format(stream.id))
-            # We have to control if the writer was not closed by a "disconnect" message first.
-            if stream.status == 0:
-                try:
-                    yield from writer.drain()
-                except BrokenPipeError:
-                    pass
-                except ConnectionResetError:
-                    pass
+                    size = stream.settings.chunk_size
+                    if stream.credit is not None:
+                        size = min(size, stream.credit)
+
+                    try:
+                        data = yield from reader.read(size)
+                    except BrokenPipeError:
+                        data = ''
+
+                    if not data:
+                        break
+
+                    self.logger.debug('[#%s] %d bytes read', stream.id, len(data))
+
+                    stream.uploaded += len(data)
+                    message = {'cmd': 'sync', 'data': data, 'id': stream.id}
+                    if stream.credit is not None:
+                        stream.credit -= len(data)
+                    sent = yield from self.tunnel.send(message)
+                    assert sent, 'tunnel not available, aborting stream #{}'.format(stream.id)
+
+                # Closing socks5 client connection
+                self.logger.debug('closing stream #{}'.format(stream.id))
+                # We have to control if the writer was not closed by a "disconnect" message first.
+                if stream.status == 0:
+                    try:
+                        yield from writer.drain()
+                    except BrokenPipeError:
+                        pass
+                    except ConnectionResetError:
+                        pass
 
         except AssertionError as e:
             self.logger.debug(e.args[0])
@@ -194,45 +408,110 @@ class Socks5:
         except RuntimeError:
             self.logger.critical('adapter exception: \n{}'.format(traceback.format_exc()))
 
+        # Lets the other extreme release the stream (it could still be connecting).
+        if connecting:
+            self.tunnel.dispatch({'cmd': 'disconnect', 'id': stream.id})
+
         if stream.id in self.streams:
             del self.streams[stream.id]
 
+        self.uploaded += stream.uploaded
+        self.downloaded += stream.downloaded
+        if stream.status == 0:
+            self.lifetimes.observe(self.loop.time() - begin)
+            self.sizes.observe(stream.uploaded + stream.downloaded)
+
+    # Relays datagrams until the client closes the connection of its UDP ASSOCIATE.
     @asyncio.coroutine
+    def associate(self, stream):
+        if not stream.settings.datagrams:
+            self.logger.debug('[#{}] the tunnel does not relay datagrams'.format(stream.id))
+            stream.reply(7)
+            stream.writer.close()
+            # Releases the tunnel connection it got.
+            self.tunnel.dispatch({'cmd': 'disconnect', 'id': stream.id})
+            return
+
+        host = stream.writer.get_extra_info('peername')[0]
+        try:
+            transport, stream.association = yield from self.loop.create_datagram_endpoint(
+                lambda: Association(stream.id, host, self.tunnel), local_addr=(self.address, 0))
+        except OSError as e:
+            self.logger.warning('[#{}] can not relay datagrams: {}'.format(stream.id, e))
+            stream.reply(1)
+            stream.writer.close()
+            self.tunnel.dispatch({'cmd': 'disconnect', 'id': stream.id})
+            return
+        address, port = transport.get_extra_info('sockname')[:2]
+        self.logger.info('[#{}] relaying datagrams on {}:{}'.format(stream.id, address, port))
+        stream.reply(0, address, port)
+
+        try:
+            while (yield from stream.reader.read(4096)):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            transport.close()
+            self.tunnel.dispatch({'cmd': 'disconnect', 'id': stream.id})
+
+    # Each message goes straight to its stream, nothing here has to wait.
     def execute(self, message):
         try:
-            self.logger.debug('executing message {}'.format(message))
-            with (yield from self.lock):
-                if message['cmd'] == 'status':
-                    if message['id'] in self.streams:
-                        yield from self.streams[message['id']].set_status(message['value'])
-                        self.lock.notify_all()
-
-                elif message['cmd'] == 'sync':
-                    if message['id'] in self.streams:
-                        data = base64.b64decode(message['data'].encode('ascii'))
-                        self.streams[message['id']].writer.write(data)
-
-                elif message['cmd'] == 'stop':
-                    self.loop.stop()
+            self.logger.debug('executing message %s #%s (%d bytes)', message['cmd'], message.get('id'),
+                              len(message.get('data', '')))
+            if message['cmd'] == 'stop':
+                self.loop.stop()
+                return
+
+            stream = self.streams.get(message.get('id'))
+            if stream is None:
+                return
+
+            if message['cmd'] == 'status':
+                stream.set_status(message['value'])
+
+            elif message['cmd'] == 'sync':
+                stream.received(message['data'])
+
+            elif message['cmd'] == 'window':
+                stream.add_credit(message['value'])
+
+            elif message['cmd'] == 'datagram' and stream.association is not None:
+                stream.association.send(message)
+
         except KeyboardInterrupt:
             self.loop.stop()
 
     def dispatch(self, message):
-        def async_execute(msg):
-            asyncio.async(self.execute(msg), loop=self.loop)
-        self.loop.call_soon_threadsafe(async_execute, message)
+        self.loop.call_soon_threadsafe(self.execute, message)
+
+    def metrics(self):
+        streams = list(self.streams.values())
+        uploaded = self.uploaded + sum(stream.uploaded for stream in streams)
+        downloaded = self.downloaded + sum(stream.downloaded for stream in streams)
+        return [
+            ('streams', 'gauge', 'Open SOCKS5 connections.', len(streams)),
+            ('streams_opened_total', 'counter', 'Accepted SOCKS5 connections.', self.opened),
+            ('connect_failures_total', 'counter', 'Streams whose destination could not be reached.', self.failed),
+            ('stream_bytes_total', 'counter', 'Stream data from the clients (upload) and to them (download).',
+             {'direction="upload"': uploaded, 'direction="download"': downloaded}),
+            ('connect_duration_seconds', 'histogram', 'Seconds destinations took to accept the connection.',
+             self.connect_latencies),
+            ('stream_duration_seconds', 'histogram', 'Seconds the closed streams lasted.', self.lifetimes),
+            ('stream_size_bytes', 'histogram', 'Bytes moved by each closed stream, both directions.', self.sizes),
+        ]
 
     @asyncio.coroutine
     def stop_and_wait(self):
         self.server.close()
         yield from self.server.wait_closed()
-        with (yield from self.lock):
-            self.running = False
-            self.lock.notify_all()
+        self.running = False
 
         while self.streams.values():
             _, stream = self.streams.popitem()
             stream.writer.close()
+            stream.task.cancel()
             try:
                 yield from stream.task
             except:
@@ -245,6 +524,7 @@ class Socks5:
     def start(self, loop):
         self.loop = loop
         self.running = True
-        handler = asyncio.start_server(self.new_connection, self.address, self.port, loop=loop)
+        options = {'reuse_port': True} if self.reuse_port else {}
+        handler = asyncio.start_server(self.new_connection, self.address, self.port, loop=loop, **options)
         self.server = loop.run_until_complete(handler)
         self.logger.info('listening on {}:{}'.format(self.address, self.port))
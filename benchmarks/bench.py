@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+
+
+# End to end benchmark: runs bogeyman.py, a remote extreme and an echo server as separate processes on
+# this host and drives them with a SOCKS5 load client. For every mode and number of concurrent streams it
+# measures how long the streams take to connect, the echo throughput and the cpu and memory used by each
+# process (read from /proc, so Linux only). Results are saved as JSON, and two result files can be compared:
+#
+#   benchmarks/bench.py -o before.json
+#   benchmarks/bench.py -o after.json --compare before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ['forward', 'reverse', 'http']
+STREAMS = [1, 100, 5000]
+# Bytes echoed in each scenario, split among its streams.
+BYTES = 64 * 1024 * 1024
+MIN_STREAM_BYTES = 16 * 1024
+CHUNK = 64 * 1024
+# Seconds a scenario (or the startup of its processes) can take.
+TIMEOUT = 300
+STARTUP = 15
+
+PAYLOAD = os.urandom(CHUNK)
+TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+# Cpu seconds and resident memory (current and peak, in KiB) of a process.
+def usage(pid):
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        # The command name may hold spaces, fields are counted after it.
+        fields = stat.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / TICKS
+
+    memory = {}
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                memory[name] = int(value.split()[0])
+    return {'cpu': cpu, 'rss': memory.get('VmRSS'), 'max_rss': memory.get('VmHWM')}
+
+
+# Echo server, run in a process of its own.
+def echo(port):
+    @asyncio.coroutine
+    def handler(reader, writer):
+        try:
+            while True:
+                data = yield from reader.read(CHUNK)
+                if not data:
+                    break
+                writer.write(data)
+                yield from writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_server(handler, '127.0.0.1', port, backlog=1024, loop=loop))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class Chain:
+
+    def __init__(self, mode, python, logger):
+        self.mode = mode
+        self.python = python
+        self.logger = logger
+        self.processes = {}
+
+        self.adapter_port = free_port()
+        self.tunnel_port = free_port()
+        self.echo_port = free_port()
+
+    def spawn(self, name, arguments):
+        # SIGINT lets the tunnel ends shut down as they would from a terminal.
+        def preexec():
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        command = [self.python] + arguments
+        self.logger.debug('starting {}: {}'.format(name, ' '.join(command)))
+        self.processes[name] = subprocess.Popen(command, cwd=ROOT, preexec_fn=preexec, stdout=subprocess.DEVNULL,
+                                                stderr=subprocess.DEVNULL)
+
+    def start(self):
+        adapter = ['bogeyman.py', '-p', str(self.adapter_port), '-l', 'critical']
+        tunnel = ['-p', str(self.tunnel_port), '-l', 'critical']
+
+        self.spawn('echo', [os.path.abspath(__file__), '--echo', str(self.echo_port)])
+        if self.mode == 'forward':
+            self.spawn('remote', ['tunnels/tcp/remote3.py'] + tunnel)
+            time.sleep(0.5)
+            self.spawn('bogeyman', adapter + ['tcp', '-P', str(self.tunnel_port)])
+        elif self.mode == 'reverse':
+            self.spawn('bogeyman', adapter + ['tcp', '-P', str(self.tunnel_port), '-R'])
+            time.sleep(0.5)
+            self.spawn('remote', ['tunnels/tcp/remote3.py', '-r'] + tunnel)
+        else:
+            self.spawn('remote', ['tunnels/http/remote3.py'] + tunnel)
+            time.sleep(0.5)
+            url = 'http://127.0.0.1:{}/'.format(self.tunnel_port)
+            self.spawn('bogeyman', adapter + ['http', '-U', url])
+
+    def usage(self):
+        return {name: usage(process.pid) for name, process in self.processes.items()}
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self.processes.values():
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+class LoadClient:
+
+    def __init__(self, loop, adapter_port, echo_port):
+        self.loop = loop
+        self.adapter_port = adapter_port
+        self.request = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', echo_port)
+
+    # Returns the stream and the seconds its SOCKS5 CONNECT took, or raises OSError.
+    @asyncio.coroutine
+    def connect(self):
+        begin = self.loop.time()
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', self.adapter_port, loop=self.loop)
+        try:
+            writer.write(b'\x05\x01\x00')
+            yield from reader.readexactly(2)
+            writer.write(self.request)
+            reply = yield from reader.readexactly(10)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            raise OSError(errno.ECONNRESET, 'connection closed by the adapter')
+        if reply[1] != 0:
+            writer.close()
+            raise OSError(errno.ECONNREFUSED, 'SOCKS5 status {}'.format(reply[1]))
+        return reader, writer, self.loop.time() - begin
+
+    # Waits until the whole chain can carry a stream.
+    @asyncio.coroutine
+    def ready(self, timeout=STARTUP):
+        deadline = self.loop.time() + timeout
+        while True:
+            try:
+                reader, writer, _ = yield from asyncio.wait_for(self.connect(), 5, loop=self.loop)
+                writer.close()
+                return
+            except (OSError, asyncio.TimeoutError):
+                if self.loop.time() > deadline:
+                    raise
+                yield from asyncio.sleep(0.2, loop=self.loop)
+
+    @asyncio.coroutine
+    def send(self, writer, size):
+        while size > 0:
+            writer.write(PAYLOAD[:min(size, CHUNK)])
+            size -= CHUNK
+            yield from writer.drain()
+
+    # Echoes "size" bytes through the stream and returns how many came back.
+    @asyncio.coroutine
+    def transfer(self, reader, writer, size):
+        sender = asyncio.async(self.send(writer, size), loop=self.loop)
+        received = 0
+        try:
+            while received < size:
+                data = yield from reader.read(CHUNK)
+                if not data:
+                    break
+                received += len(data)
+        finally:
+            sender.cancel()
+            writer.close()
+        return received
+
+    @asyncio.coroutine
+    def run(self, streams, size):
+        tasks = [asyncio.async(self.connect(), loop=self.loop) for _ in range(streams)]
+        yield from asyncio.wait(tasks, loop=self.loop)
+
+        latencies = []
+        connected = []
+        errors = 0
+        for task in tasks:
+            if task.exception() is not None:
+                errors += 1
+                continue
+            reader, writer, latency = task.result()
+            latencies.append(latency)
+            connected.append((reader, writer))
+
+        begin = self.loop.time()
+        results = yield from asyncio.gather(*[self.transfer(reader, writer, size) for reader, writer in connected],
+                                            loop=self.loop, return_exceptions=True)
+        elapsed = self.loop.time() - begin
+        received = sum(result for result in results if isinstance(result, int))
+        failed = sum(1 for result in results if not isinstance(result, int) or result < size)
+
+        return {
+            'connect': {
+                'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99), 'max': max(latencies) if latencies else None,
+                'errors': errors},
+            'transfer': {
+                'seconds': elapsed, 'bytes': received, 'mbps': received / elapsed / 1e6 if elapsed else None,
+                'errors': failed}}
+
+
+def scenario(mode, streams, total, python, timeout, logger):
+    size = max(total // streams, MIN_STREAM_BYTES)
+    chain = Chain(mode, python, logger)
+    loop = asyncio.new_event_loop()
+    client = LoadClient(loop, chain.adapter_port, chain.echo_port)
+
+    result = {'mode': mode, 'streams': streams, 'bytes_per_stream': size}
+    chain.start()
+    try:
+        loop.run_until_complete(client.ready())
+        before = chain.usage()
+        result.update(loop.run_until_complete(asyncio.wait_for(client.run(streams, size), timeout, loop=loop)))
+        after = chain.usage()
+        for name, values in after.items():
+            values['cpu'] -= before[name]['cpu']
+        result['processes'] = after
+    except (OSError, asyncio.TimeoutError) as e:
+        result['error'] = repr(e)
+    finally:
+        chain.stop()
+        loop.close()
+    return result
+
+
+def summary(result):
+    if 'error' in result:
+        return '{mode:>8} {streams:>5} streams: {error}'.format(**result)
+    processes = ', '.join('{} {:.2f}s cpu {:.1f}MiB'.format(name, values['cpu'], values['max_rss'] / 1024)
+                          for name, values in sorted(result['processes'].items()))
+    return '{:>8} {:>5} streams: {:8.2f} MB/s, connect p50 {:.1f}ms p99 {:.1f}ms, {} errors ({})'.format(
+        result['mode'], result['streams'], result['transfer']['mbps'], result['connect']['p50'] * 1000,
+        result['connect']['p99'] * 1000, result['connect']['errors'] + result['transfer']['errors'], processes)
+
+
+def compare(old, new):
+    previous = {(result['mode'], result['streams']): result for result in old['results']}
+    for result in new['results']:
+        before = previous.get((result['mode'], result['streams']))
+        if before is None or 'error' in before or 'error' in result:
+            continue
+        print('{:>8} {:>5} streams: throughput {:+.1f}%, connect p50 {:+.1f}%'.format(
+            result['mode'], result['streams'],
+            (result['transfer']['mbps'] / before['transfer']['mbps'] - 1) * 100,
+            (result['connect']['p50'] / before['connect']['p50'] - 1) * 100))
+
+
+def revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m', '--modes', nargs='+', choices=MODES, default=MODES, help='tunnels to measure')
+    parser.add_argument('-s', '--streams', nargs='+', type=int, default=STREAMS,
+                        help='concurrent streams of each scenario (default: 1 100 5000)')
+    parser.add_argument('-b', '--bytes', type=int, default=BYTES, help='bytes echoed in each scenario')
+    parser.add_argument('-t', '--timeout', type=float, default=TIMEOUT, help='seconds a scenario can take')
+    parser.add_argument('-o', '--output', help='results file (default: bench-<date>.json)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter running the tunnel processes')
+    parser.add_argument('--compare', help='results file to compare with')
+    parser.add_argument('--echo', type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.echo:
+        echo(args.echo)
+        sys.exit(0)
+
+    logging.basicConfig(format='[%(levelname)-0.1s][%(module)s] %(message)s')
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.INFO)
+
+    # Thousands of streams need as many descriptors in every process of the chain.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': revision(), 'python': args.python,
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'results': []}
+    for mode in args.modes:
+        for streams in args.streams:
+            logger.info('running {} with {} streams'.format(mode, streams))
+            result = scenario(mode, streams, args.bytes, args.python, args.timeout, logger)
+            report['results'].append(result)
+            print(summary(result))
+
+    output = args.output or 'bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as results:
+        json.dump(report, results, indent=2)
+    logger.info('results saved to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
@@ -2,15 +2,23 @@
 
 import sys
 import asyncio
+import inspect
 import logging
 import argparse
 import traceback
 import configparser
 
+import metrics
 import tunnels
+import workers
 import adapters
 
 
+# Options of the remote scripts, which share the tunnel sections of the configuration file with ours.
+REMOTE_OPTIONS = ('ip', 'port', 'log', 'metrics_ip', 'metrics_port', 'budget', 'limit', 'session_timeout',
+                  'dns_ttl', 'dns_negative_ttl', 'dns_cache_size', 'udp_timeout', 'queue_budget')
+
+
 if __name__ == '__main__':
 
     # General arguments
@@ -21,6 +29,10 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--log', help='log level (default: info)',
                         choices=['debug', 'info', 'warning', 'error', 'critical'])
     parser.add_argument('-c', '--config', help='uses a configuration file')
+    parser.add_argument('-m', '--metrics-port', type=int, help='serves Prometheus metrics on this port (default: off)')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes sharing the adapter port (default: 1)')
+    # Channel of a worker with its supervisor.
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
 
     tunnel_parser = parser.add_subparsers(dest='tunnel', help='tunnel types (default: tcp)')
 
@@ -33,12 +45,14 @@ if __name__ == '__main__':
     # HTTP Parameters
     http_parser = tunnel_parser.add_parser('http', help='tunnel over HTTP')
     http_parser.add_argument('-U', '--url', help='remote script url (default: http://127.0.0.1/remote.php)')
-    http_parser.add_argument('-T', '--threads', help='number of threads (default: 2)')
+    http_parser.add_argument('-T', '--threads', help='number of concurrent requests (default: 2)')
 
     args = parser.parse_args()
 
     # Default configuration
-    config = {'adapter_ip': '127.0.0.1', 'adapter_port': 1080, 'adapter': 'socks5', 'log': 'info', 'tunnel': 'tcp'}
+    config = {'adapter_ip': '127.0.0.1', 'adapter_port': 1080, 'adapter': 'socks5', 'log': 'info', 'tunnel': 'tcp',
+              'connect_timeout': adapters.socks5.CONNECT_TIMEOUT, 'metrics_ip': '127.0.0.1', 'metrics_port': None,
+              'workers': 1}
     file_params = {}
 
     # Config file configuration
@@ -56,7 +70,7 @@ if __name__ == '__main__':
                     file_params[option.lower()] = value
 
     # General configuration
-    for option in ['adapter_ip', 'adapter_port', 'log', 'tunnel']:
+    for option in ['adapter_ip', 'adapter_port', 'log', 'tunnel', 'metrics_port', 'workers']:
         value = getattr(args, option)
         config[option] = value if value is not None else config[option]
 
@@ -74,24 +88,58 @@ if __name__ == '__main__':
         params['url'] = getattr(args, 'url', False) or params['url']
         params['threads'] = getattr(args, 'threads', False) or params['threads']
 
+    # Workers run this same command line, each with its own tunnel. Remote extremes listening for them have to
+    # take several tunnel connections (remote3.py and the HTTP scripts do), the reverse ones can not choose
+    # which worker they reach.
+    supervised = args.worker is None and int(config['workers']) > 1
+    if supervised and params.get('reverse'):
+        parser.error('workers need a forward tunnel')
+
     # Starts program
-    logging.basicConfig(format='[%(levelname)-0.1s][%(module)s] %(message)s')
+    if args.worker is None:
+        logging.basicConfig(format='[%(levelname)-0.1s][%(module)s] %(message)s')
+    else:
+        logging.basicConfig(format='[%(levelname)-0.1s][%(module)s][%(process)d] %(message)s')
     logger = logging.getLogger('bogeyman')
     logger.setLevel(getattr(logging, config['log'].upper()))
 
-    # Configure tunnel
+    # Anything else the tunnel does not take is probably a typo.
     tunnel_class = getattr(tunnels, config['tunnel'].upper())
-    tunnel = tunnel_class(**params)
+    options = inspect.signature(tunnel_class).parameters
+    if args.worker is None:
+        for option in sorted(set(params) - set(options) - set(REMOTE_OPTIONS)):
+            logger.warning('unknown {} option "{}" ignored'.format(config['tunnel'], option))
 
-    # Configure adapter
-    adapter = adapters.Socks5(config['adapter_ip'], int(config['adapter_port']))
+    loop = asyncio.get_event_loop()
+    if supervised:
+        supervisor = workers.Supervisor(config['workers'], sys.argv[1:])
+        supervisor.start(loop)
+        parts = [supervisor]
 
-    tunnel.set_peer(adapter)
-    adapter.set_peer(tunnel)
+    else:
+        # Configure tunnel
+        tunnel = tunnel_class(**{option: value for option, value in params.items() if option in options})
 
-    loop = asyncio.get_event_loop()
-    tunnel.start(loop)
-    adapter.start(loop)
+        # Configure adapter
+        adapter = adapters.Socks5(config['adapter_ip'], int(config['adapter_port']), config['connect_timeout'],
+                                  reuse_port=args.worker is not None)
+
+        tunnel.set_peer(adapter)
+        adapter.set_peer(tunnel)
+
+        tunnel.start(loop)
+        adapter.start(loop)
+        parts = [adapter, tunnel]
+
+        # The supervisor collects the metrics of its workers.
+        if args.worker is not None:
+            asyncio.async(workers.serve(args.worker, parts, loop), loop=loop)
+
+    # Stats listener
+    stats = None
+    if config['metrics_port'] and args.worker is None:
+        stats = metrics.Server(config['metrics_ip'], config['metrics_port'], parts)
+        stats.start(loop)
 
     try:
         loop.run_forever()
@@ -104,8 +152,10 @@ if __name__ == '__main__':
 
     try:
         if not loop.is_closed():
-            adapter.stop()
-            tunnel.stop()
+            if stats is not None:
+                stats.stop()
+            for part in parts:
+                part.stop()
             loop.stop()
 
         logging.basicConfig(level=logging.CRITICAL)
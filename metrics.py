@@ -0,0 +1,175 @@
+
+import json
+import bisect
+import asyncio
+import logging
+import collections
+
+
+# Every metric name starts with it.
+PREFIX = 'bogeyman_'
+
+# Histogram buckets.
+LATENCIES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LIFETIMES = (0.1, 1, 10, 60, 300, 1800, 3600, 14400)
+SIZES = (1024, 16 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024, 1024 * 1024 * 1024)
+
+# Seconds a scraper has to send its request.
+TIMEOUT = 5.0
+
+# Gauges which make no sense added up across workers, the smallest (or largest) one is kept.
+MINIMUMS = ('tunnel_rtt_seconds',)
+MAXIMUMS = ('tunnel_reorder_max_depth',)
+
+
+# Counts the observed values by bucket. The cumulative counts Prometheus expects are only computed
+# when the histogram is rendered.
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=''):
+        prefix = labels + ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, total))
+        labels = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+
+# Prometheus text format of a list of (name, type, help, value) families. The value is a number, a
+# Histogram, or a dict of them by labels ('direction="in"').
+def render(families, prefix=PREFIX):
+    lines = []
+    for name, kind, description, value in families:
+        name = prefix + name
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        samples = value if isinstance(value, dict) else {'': value}
+        for labels, sample in sorted(samples.items()):
+            if isinstance(sample, Histogram):
+                lines.extend(sample.lines(name, labels))
+            else:
+                lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', sample))
+    return '\n'.join(lines) + '\n'
+
+
+# Families as a JSON line, so a worker can send them to its supervisor.
+def dump(families):
+    def encode(value):
+        if isinstance(value, Histogram):
+            return {'buckets': value.buckets, 'counts': value.counts, 'sum': value.sum}
+        if isinstance(value, dict):
+            return {'labels': {labels: encode(sample) for labels, sample in value.items()}}
+        return value
+    families = [(name, kind, description, encode(value)) for name, kind, description, value in families]
+    return json.dumps(families).encode()
+
+
+def load(data):
+    def decode(value):
+        if isinstance(value, dict) and 'labels' in value:
+            return {labels: decode(sample) for labels, sample in value['labels'].items()}
+        if isinstance(value, dict):
+            histogram = Histogram(value['buckets'])
+            histogram.counts = value['counts']
+            histogram.sum = value['sum']
+            return histogram
+        return value
+    families = json.loads(data.decode())
+    return [(name, kind, description, decode(value)) for name, kind, description, value in families]
+
+
+# Adds up the families of several workers, in the order they first appear.
+def merge(results):
+    def add(name, total, value):
+        if total is None:
+            return value
+        if isinstance(value, Histogram):
+            histogram = Histogram(total.buckets)
+            histogram.counts = [a + b for a, b in zip(total.counts, value.counts)]
+            histogram.sum = total.sum + value.sum
+            return histogram
+        if isinstance(value, dict):
+            merged = dict(total)
+            for labels, sample in value.items():
+                merged[labels] = add(name, total.get(labels), sample)
+            return merged
+        if name in MINIMUMS:
+            return min(total, value)
+        if name in MAXIMUMS:
+            return max(total, value)
+        return total + value
+
+    families = collections.OrderedDict()
+    for result in results:
+        for name, kind, description, value in result:
+            total = families[name][2] if name in families else None
+            families[name] = (kind, description, add(name, total, value))
+    return [(name, kind, description, value) for name, (kind, description, value) in families.items()]
+
+
+# Stats listener. Each scrape asks the sources (the adapter and the tunnel) for their metrics, so keeping
+# them costs nothing but a few counters while nobody is looking.
+class Server:
+
+    def __init__(self, address, port, sources):
+        self.logger = logging.getLogger('bogeyman')
+        self.address = address
+        self.port = int(port)
+        self.sources = sources
+        self.server = None
+        self.loop = None
+
+    @asyncio.coroutine
+    def handler(self, reader, writer):
+        try:
+            request = yield from asyncio.wait_for(reader.readline(), TIMEOUT, loop=self.loop)
+            while (yield from asyncio.wait_for(reader.readline(), TIMEOUT, loop=self.loop)).strip():
+                pass
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+
+        parts = request.decode('latin-1').split()
+        if len(parts) > 1 and parts[1].split('?')[0] in ('/', '/metrics'):
+            families = []
+            for source in self.sources:
+                result = source.metrics()
+                # The supervisor has to ask its workers first.
+                if asyncio.iscoroutine(result):
+                    result = yield from result
+                families.extend(result)
+            status, body = '200 OK', render(families).encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+
+        headers = ['HTTP/1.0 {}'.format(status), 'Content-Type: text/plain; version=0.0.4; charset=utf-8',
+                   'Content-Length: {}'.format(len(body)), 'Connection: close']
+        writer.writelines([('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'), body])
+        try:
+            yield from writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def stop(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def start(self, loop):
+        self.loop = loop
+        handler = asyncio.start_server(self.handler, self.address, self.port, loop=loop)
+        self.server = loop.run_until_complete(handler)
+        self.logger.info('metrics on http://{}:{}/metrics'.format(self.address, self.port))
@@ -0,0 +1,398 @@
+import json
+import zlib
+import base64
+import struct
+import asyncio
+
+# Tunnel messages travel as binary frames once both extremes agree on it.
+#
+# Handshake (every message is a legacy JSON frame):
+#   local  -> remote  {"cmd": "hello", "version": N, "caps": [...]}
+#   remote -> local   {"cmd": "hello", "version": M, "caps": [...]}  (the remote writes binary from now on)
+#   local  -> remote  {"cmd": "upgrade"}                              (the local writes binary from now on)
+#
+# The remote answers with the lowest version and the capabilities both extremes support. With the
+# "window" capability each hello also carries the initial flow control window of its sender.
+# Peers which do not know the "hello" command just ignore it and both extremes keep talking JSON.
+#
+# Legacy frame:
+# +--------+------+
+# | LENGTH | JSON |
+# +--------+------+
+#     2
+#
+# Binary frame:
+# +-----+----+--------+---------+
+# | CMD | ID | LENGTH | PAYLOAD |
+# +-----+----+--------+---------+
+#    1     4    2/4
+#
+# LENGTH takes 4 bytes when the "large" capability was agreed.
+#
+# HTTP tunnels with the "binary" capability send their bulks as application/octet-stream bodies: a
+# SEQ (4 bytes) and HOLD (2 bytes) header followed by binary frames with large headers.
+#
+# Flow control ("window" capability): each extreme can send up to "window" bytes of a stream before
+# being acknowledged, the receiver gives the credit back with "window" frames once the data was
+# written to its destination (and may grow the window up to its maximum).
+#
+# Compression ("zlib" capability): the highest bit of CMD marks sync payloads deflated with the
+# zlib context of their stream (one per stream and direction, flushed on each frame). Each
+# extreme stops compressing the streams whose data does not shrink, uncompressed frames do not
+# touch the contexts. Window accounting always uses the uncompressed size.
+#
+# Datagrams ("udp" capability, needs "large" too): "datagram" frames carry the UDP datagrams of a
+# SOCKS5 UDP ASSOCIATE, with the id of its stream and the destination (or source) of the datagram.
+# +------+------+------+------+
+# | PORT | ALEN | ADDR | DATA |
+# +------+------+------+------+
+#    2      1
+# The remote extreme keeps one UDP socket per association until a "disconnect" or a while idle.
+#
+# Heartbeats ("ping" capability): each extreme sends a "ping" frame every few seconds and the other one
+# answers with a "pong" carrying the same 4 bytes value. Only one ping waits for its pong at a time. The
+# round trip time is smoothed as TCP does (RFC 6298), and a connection whose ping got no answer after a
+# few intervals is considered dead and closed, so it can be replaced right away.
+#
+# Session resumption ("resume" capability): the local hello also carries the "session" id of the local
+# extreme and the "link" id of the connection. Each extreme counts the binary frames it writes and
+# receives through a link, and keeps the frames it wrote until an "ack" frame (4 bytes, the number of
+# frames received) covers them. Acks are not counted nor kept themselves. A lost link keeps its streams
+# for a while: the next connection offers to resume it with the link id and the frames it "received",
+# and the remote hello answers with its own "received" if it still has the link. Each extreme then
+# writes again the frames the other one did not receive, and the link goes on where it stopped.
+
+VERSION = 1
+CAPABILITIES = ['large', 'window', 'zlib', 'udp', 'ping', 'resume']
+
+LEGACY_HEADER = struct.Struct('>H')
+HEADER = struct.Struct('>BIH')
+LARGE_HEADER = struct.Struct('>BII')
+BULK_HEADER = struct.Struct('>IH')
+
+MAX_PAYLOAD = 0xffff
+# Same as the biggest read of an asyncio transport, so one read becomes one frame.
+MAX_LARGE_PAYLOAD = 256 * 1024
+# Biggest chunk of data whose base64 encoding fits into a legacy frame.
+MAX_LEGACY_DATA = 48750
+
+# Default initial and maximum flow control windows.
+WINDOW = 256 * 1024
+MAX_WINDOW = 4 * 1024 * 1024
+
+COMMANDS = {'connect': 1, 'status': 2, 'sync': 3, 'disconnect': 4, 'stop': 5, 'window': 6, 'datagram': 7,
+            'ping': 8, 'pong': 9, 'ack': 10}
+DATAGRAM_HEADER = struct.Struct('>HB')
+NAMES = {code: name for name, code in COMMANDS.items()}
+COMPRESSED = 0x80
+
+# Default zlib level (0 disables compression).
+COMPRESSION = 6
+# Frames smaller than this are not worth compressing.
+MIN_COMPRESS = 128
+# Streams which after PROBE bytes do not shrink below RATIO are no longer compressed.
+PROBE = 16 * 1024
+RATIO = 0.9
+# Prefixes of data which is already compressed or encrypted (TLS records, gzip, zip, png, jpeg).
+SIGNATURES = (b'\x16\x03', b'\x17\x03', b'\x1f\x8b', b'PK\x03\x04', b'\x89PNG', b'\xff\xd8\xff')
+
+# Seconds between pings, and intervals without pong before the connection is considered dead.
+HEARTBEAT = 5.0
+MISSES = 3
+
+# Seconds a lost link waits to be resumed, and bytes of unacknowledged frames each link keeps (writing
+# stops once they are more).
+RESUME_TIMEOUT = 60.0
+REPLAY_SIZE = 4 * 1024 * 1024
+# Frames received before they are acknowledged, or seconds after the first one.
+ACK_FRAMES = 16
+ACK_DELAY = 0.02
+# Bytes received and not parsed yet before the connection stops being read, until they go under LOW_WATER
+# (the biggest frame fits under HIGH_WATER).
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+
+# Returns the header to use and the biggest data chunk one frame can carry (None header means JSON).
+def negotiate(caps):
+    if caps is None:
+        return None, MAX_LEGACY_DATA
+    if 'large' in caps:
+        return LARGE_HEADER, MAX_LARGE_PAYLOAD
+    return HEADER, MAX_PAYLOAD
+
+
+# Capabilities to announce with the given compression level.
+def capabilities(compression):
+    return [cap for cap in CAPABILITIES if cap != 'zlib' or compression]
+
+
+# Heartbeat of one tunnel connection.
+class Heartbeat:
+
+    def __init__(self, interval=HEARTBEAT, misses=MISSES):
+        self.interval = float(interval)
+        self.misses = int(misses)
+        # Smoothed round trip time and its variation, None until the first pong.
+        self.rtt = None
+        self.rttvar = None
+        self.value = 0
+        self.sent = None
+        self.missed = 0
+
+    # Called every interval. Returns the ping to send, or None while the last one was not answered.
+    def beat(self, now):
+        if self.sent is not None:
+            self.missed += 1
+            return None
+        self.value = (self.value + 1) & 0xffffffff
+        self.sent = now
+        return {'cmd': 'ping', 'value': self.value}
+
+    def expired(self):
+        return self.missed >= self.misses
+
+    def pong(self, message, now):
+        if self.sent is None or message['value'] != self.value:
+            return
+        sample = now - self.sent
+        self.sent = None
+        self.missed = 0
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+
+# Compression context of the data one stream sends.
+class Deflater:
+
+    def __init__(self, level=COMPRESSION):
+        self.context = zlib.compressobj(level)
+        self.original = 0
+        self.compressed = 0
+
+    # Updates the sync message with its compressed data, if it is worth it.
+    def compress(self, message):
+        data = message['data']
+        if self.context is None or len(data) < MIN_COMPRESS:
+            return message
+
+        if not self.original and data.startswith(SIGNATURES):
+            self.context = None
+            return message
+
+        payload = self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        if self.original < PROBE:
+            self.original += len(data)
+            self.compressed += len(payload)
+            if self.original >= PROBE and self.compressed > self.original * RATIO:
+                self.context = None
+        return dict(message, data=payload, compressed=True)
+
+
+# Returns the sync message with its data uncompressed, using the context of its stream. Data of
+# streams already released can not be uncompressed, it is dropped.
+def inflate(message, inflaters):
+    if message.pop('compressed', False):
+        inflater = inflaters.get(message['id'])
+        if inflater is None:
+            inflater = inflaters[message['id']] = zlib.decompressobj()
+        try:
+            message['data'] = inflater.decompress(message['data'])
+        except zlib.error:
+            del inflaters[message['id']]
+            message['data'] = b''
+    return message
+
+
+# Returns the frame header and payload, so they can be written without joining them first.
+def pack(message, header=HEADER):
+    cmd = message['cmd']
+    if cmd == 'sync':
+        payload = message['data']
+    elif cmd == 'connect':
+        payload = struct.pack('>H', message['port']) + message['addr'].encode()
+    elif cmd == 'status':
+        payload = struct.pack('B', message['value'])
+    elif cmd in ('window', 'ping', 'pong', 'ack'):
+        payload = struct.pack('>I', message['value'])
+    elif cmd == 'datagram':
+        address = message['addr'].encode()
+        payload = DATAGRAM_HEADER.pack(message['port'], len(address)) + address + message['data']
+    else:
+        payload = b''
+    command = COMMANDS[cmd] | (COMPRESSED if message.get('compressed') else 0)
+    return header.pack(command, message.get('id', 0), len(payload)), payload
+
+
+def encode(message, header=HEADER):
+    return b''.join(pack(message, header))
+
+
+def decode(command, sid, payload):
+    message = {'cmd': NAMES.get(command & ~COMPRESSED), 'id': sid}
+    if command & COMPRESSED:
+        message['compressed'] = True
+        command &= ~COMPRESSED
+    if command == COMMANDS['sync']:
+        message['data'] = payload
+    elif command == COMMANDS['connect']:
+        message['port'] = struct.unpack_from('>H', payload)[0]
+        message['addr'] = bytes(payload[2:]).decode()
+    elif command == COMMANDS['status']:
+        message['value'] = payload[0]
+    elif command in (COMMANDS['window'], COMMANDS['ping'], COMMANDS['pong'], COMMANDS['ack']):
+        message['value'] = struct.unpack('>I', payload)[0]
+    elif command == COMMANDS['datagram']:
+        message['port'], size = DATAGRAM_HEADER.unpack_from(payload)
+        offset = DATAGRAM_HEADER.size + size
+        message['addr'] = bytes(payload[DATAGRAM_HEADER.size:offset]).decode()
+        message['data'] = payload[offset:]
+    return message
+
+
+# JSON messages carry their data base64 encoded.
+def to_json(message):
+    if 'data' in message:
+        message = dict(message, data=base64.b64encode(message['data']).decode('ascii'))
+    return message
+
+
+def from_json(message):
+    if 'data' in message:
+        message['data'] = base64.b64decode(message['data'].encode('ascii'))
+    return message
+
+
+def encode_json(message):
+    data = json.dumps(to_json(message)).encode()
+    return LEGACY_HEADER.pack(len(data)) + data
+
+
+def decode_json(data):
+    return from_json(json.loads(data.decode('ascii')))
+
+
+# Returns the messages of a buffer of frames.
+def split(data, offset=0, header=LARGE_HEADER):
+    messages = []
+    while offset < len(data):
+        command, sid, size = header.unpack_from(data, offset)
+        offset += header.size
+        messages.append(decode(command, sid, data[offset:offset + size]))
+        offset += size
+    return messages
+
+
+# Reading side of a tunnel connection. Each read returns every complete frame received so far, cut straight
+# from the received data: sync and datagram payloads are memoryviews of it. A buffer is never resized once
+# there are views of it, what is left of the last frame goes to a new one. The transport stops being read
+# while the buffer is over HIGH_WATER. Writing still goes through a StreamWriter, which drains with the flow
+# control of this protocol.
+class Reader(asyncio.streams.FlowControlMixin):
+
+    def __init__(self, loop, connected=None):
+        super().__init__(loop=loop)
+        self.loop = loop
+        self.connected = connected
+        self.transport = None
+        self.buffer = b''
+        self.paused = False
+        self.eof = False
+        self.exception = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.connected is not None:
+            writer = asyncio.StreamWriter(transport, self, None, self.loop)
+            asyncio.async(self.connected(self, writer), loop=self.loop)
+
+    def data_received(self, data):
+        if not self.buffer:
+            self.buffer = data
+        else:
+            if not isinstance(self.buffer, bytearray):
+                self.buffer = bytearray(self.buffer)
+            self.buffer.extend(data)
+        if not self.paused and len(self.buffer) > HIGH_WATER:
+            self.paused = True
+            self.transport.pause_reading()
+        self.wakeup()
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.eof = True
+        self.exception = exc
+        self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    # Frames use the header given (JSON frames if None). Only one JSON frame is returned at a time, the
+    # ones after a hello or an upgrade are already binary.
+    def parse(self, header):
+        buffer = self.buffer
+        view = memoryview(buffer)
+        messages = []
+        offset = 0
+        if header is None:
+            if len(buffer) >= LEGACY_HEADER.size:
+                end = LEGACY_HEADER.size + LEGACY_HEADER.unpack_from(buffer)[0]
+                if end <= len(buffer):
+                    messages.append(decode_json(bytes(view[LEGACY_HEADER.size:end])))
+                    offset = end
+        else:
+            while len(buffer) - offset >= header.size:
+                command, sid, size = header.unpack_from(buffer, offset)
+                end = offset + header.size + size
+                if end > len(buffer):
+                    break
+                messages.append(decode(command, sid, view[offset + header.size:end]))
+                offset = end
+
+        if offset:
+            self.buffer = bytearray(view[offset:]) if offset < len(buffer) else b''
+        else:
+            view.release()
+        if self.paused and len(self.buffer) <= LOW_WATER:
+            self.paused = False
+            self.transport.resume_reading()
+        return messages
+
+    @asyncio.coroutine
+    def read(self, header=None):
+        while True:
+            messages = self.parse(header)
+            if messages:
+                return messages
+            if self.exception is not None:
+                raise self.exception
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+
+            self.waiter = asyncio.Future(loop=self.loop)
+            try:
+                yield from self.waiter
+            finally:
+                self.waiter = None
+
+
+# Same as asyncio.open_connection and asyncio.start_server, with a frame reader instead of a StreamReader.
+@asyncio.coroutine
+def open_connection(host, port, loop):
+    transport, reader = yield from loop.create_connection(lambda: Reader(loop), host, port)
+    return reader, asyncio.StreamWriter(transport, reader, None, loop)
+
+
+@asyncio.coroutine
+def start_server(handler, host, port, loop):
+    return (yield from loop.create_server(lambda: Reader(loop, handler), host, port))
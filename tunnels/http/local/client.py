@@ -0,0 +1,162 @@
+
+import ssl
+import asyncio
+import collections
+import http.cookies
+import urllib.parse
+
+
+# Seconds to wait for a response.
+TIMEOUT = 30.0
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Response:
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class Connection:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Whether it was already used by another request.
+        self.reused = False
+
+    def close(self):
+        try:
+            self.writer.close()
+        except:
+            pass
+
+
+# Minimal HTTP/1.1 client keeping up to "size" connections alive to the tunnel url. Cookies set by
+# the server are sent back with every request.
+class Pool:
+
+    def __init__(self, url, size=2, loop=None, timeout=TIMEOUT):
+        self.url = url
+        self.loop = loop
+        self.timeout = timeout
+
+        parts = urllib.parse.urlsplit(url)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.netloc = parts.netloc
+
+        self.cookies = http.cookies.SimpleCookie()
+        self.idle = collections.deque()
+        self.semaphore = asyncio.Semaphore(size, loop=loop)
+
+        # Connections opened, and requests sent again because the server had closed theirs.
+        self.connects = 0
+        self.retries = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self.semaphore.acquire()
+        if self.idle:
+            return self.idle.popleft()
+        try:
+            reader, writer = yield from asyncio.open_connection(self.host, self.port, ssl=self.ssl, loop=self.loop)
+        except:
+            self.semaphore.release()
+            raise
+        self.connects += 1
+        return Connection(reader, writer)
+
+    def release(self, connection, keep):
+        if keep:
+            connection.reused = True
+            self.idle.append(connection)
+        else:
+            connection.close()
+        self.semaphore.release()
+
+    def close(self):
+        while self.idle:
+            self.idle.popleft().close()
+
+    @asyncio.coroutine
+    def request(self, method, body=b'', timeout=None, content_type=None):
+        while True:
+            connection = yield from self.acquire()
+            try:
+                response, keep = yield from asyncio.wait_for(self.exchange(connection, method, body, content_type),
+                                                             timeout or self.timeout, loop=self.loop)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                self.release(connection, False)
+                # The server may have closed an idle connection, the request is sent again through a new one.
+                if connection.reused:
+                    self.retries += 1
+                    continue
+                raise HTTPError('connection lost: {}'.format(e))
+            except:
+                self.release(connection, False)
+                raise
+
+            self.release(connection, keep)
+            return response
+
+    @asyncio.coroutine
+    def exchange(self, connection, method, body, content_type):
+        headers = ['{} {} HTTP/1.1'.format(method, self.path), 'Host: {}'.format(self.netloc),
+                   'Content-Length: {}'.format(len(body)), 'Connection: keep-alive']
+        if content_type:
+            headers.append('Content-Type: {}'.format(content_type))
+        cookies = '; '.join('{}={}'.format(key, morsel.value) for key, morsel in self.cookies.items())
+        if cookies:
+            headers.append('Cookie: {}'.format(cookies))
+        connection.writer.writelines([('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'), body])
+
+        reader = connection.reader
+        line = yield from reader.readline()
+        if not line:
+            raise ConnectionResetError('connection closed by the server')
+        version, status = line.decode('latin-1').split(None, 2)[:2]
+
+        headers = {}
+        while True:
+            line = (yield from reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                self.cookies.load(value.strip())
+            else:
+                headers[name] = value.strip()
+
+        keep = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((yield from reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append((yield from reader.readexactly(size)))
+                yield from reader.readexactly(2)
+            # Trailers
+            while (yield from reader.readline()).strip():
+                pass
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = yield from reader.readexactly(int(headers['content-length']))
+        elif method == 'HEAD' or status in ('204', '304'):
+            body = b''
+        else:
+            body = yield from reader.read()
+            keep = False
+
+        return Response(int(status), headers, body), keep
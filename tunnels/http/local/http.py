@@ -1,145 +1,288 @@
-
-import time
 import json
-import socket
+import struct
+import asyncio
 import logging
-import requests
 import traceback
-import threading
-from threading import Thread, Condition
+import collections
+
+from ... import frames
+from .client import Pool, HTTPError, TIMEOUT
+from .reorder import ReorderBuffer, GAP_TIMEOUT
+
+
+# Seconds the remote extreme can hold a poll open waiting for data.
+HOLD = 20
+
+# Bulks are limited by their size in bytes. The limit follows the measured throughput so each request
+# takes about LATENCY seconds.
+BUDGET = 64 * 1024
+MIN_BUDGET = 16 * 1024
+MAX_BUDGET = 4 * 1024 * 1024
+LATENCY = 0.25
+
+# Capabilities agreed with the remote script at session start.
+CAPABILITIES = ['binary']
+BINARY = 'application/octet-stream'
 
 
 class HTTP:
 
-    def __init__(self, url, threads=1):
+    def __init__(self, url, threads=2, connections=None, hold=HOLD, gap_timeout=GAP_TIMEOUT, latency=LATENCY):
+        self.logger = logging.getLogger('bogeyman')
         self.url = url
-        self.number_of_threads = threads
+        # Requests in flight at the same time, and keep-alive connections they share.
+        self.number_of_workers = int(threads)
+        self.number_of_connections = int(connections or threads)
         self.loop = None
+        self.pool = None
 
-        # Stage 2: Trying to reconnect tunnel
-        # Stage 1: Tunnel is working
-        # Stage 0: Aborting
-        self.stage = 2
+        self.running = False
         self.adapter = None
-        self.threads = []
+        # Biggest piece of data the adapter puts into one message.
+        self.chunk_size = 8192
+        # No flow control nor datagrams over HTTP.
+        self.window = None
+        self.datagrams = False
+        self.workers = []
         self.delay = 0
-        self.lock = Condition()
+        self.wakeup = None
+
+        # Long polling: one request at a time waits on the remote extreme for its data, the workers only
+        # send ours. Endpoints which answer without holding it make us poll with growing delays instead.
+        self.hold = int(hold)
+        self.holding = self.hold > 0
+        self.poller = None
+
+        # Messages are queued already encoded, as binary frames if the remote script supports them.
+        self.binary = False
+        self.messages = collections.deque()
+        self.budget = BUDGET
+        self.latency = float(latency)
 
-        self.messages = []
-        self.cookies = None
-        self.buffer = {}
         # This will keep the messages in order
-        self.i_sequence = 0
+        self.gap_timeout = gap_timeout
+        self.responses = None
         self.o_sequence = 0
 
+        # Metrics
+        self.frames_in = 0
+        self.frames_out = 0
+
     def set_peer(self, peer):
         self.adapter = peer
 
+    # Every stream gets the same settings.
+    def settings(self, sid):
+        return self
+
     def dispatch(self, message):
-        with self.lock:
-            self.messages.append(message)
-            self.delay = 0
-            self.lock.notify_all()
+        if self.binary:
+            data = frames.encode(message, frames.LARGE_HEADER)
+        else:
+            data = json.dumps(frames.to_json(message)).encode()
+        self.messages.append(data)
+        self.frames_out += 1
+        self.delay = 0
+        self.wakeup.set()
+
+    # The message queue has no limit, so there is nothing to wait for.
+    @asyncio.coroutine
+    def send(self, message):
+        self.dispatch(message)
+        return True
 
-    # Waits until a bulk of messages arrived or return seq=-1 if we have to abort.
+    # Waits until a bulk of messages arrived (or the delay is over) and returns it with its sequence number
+    # and whether the budget was too small for all the queued messages.
+    @asyncio.coroutine
     def get_bulk(self):
-        with self.lock:
-            # This is not the only reason "delay" should be zero.
-            # if self.messages:
-            #     self.delay = 0
+        while self.holding and not self.messages:
+            self.wakeup.clear()
+            yield from self.wakeup.wait()
 
-            begin = time.time()
-            while self.delay:
-                self.lock.wait(self.delay)
-                if (self.stage == 0) or (time.time() - begin) > self.delay:
-                    break
+        if self.delay and not self.holding:
+            self.wakeup.clear()
+            try:
+                yield from asyncio.wait_for(self.wakeup.wait(), self.delay, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
 
-            if self.stage == 0:
-                return -1, []
+        self.delay = self.delay + 1.0 if self.delay < 8.0 else 8.0
 
-            self.delay = self.delay + 1.0 if self.delay < 8.0 else 8.0
+        # At least one message goes, even if it is bigger than the budget.
+        bulk = []
+        size = 0
+        while self.messages and (not bulk or size + len(self.messages[0]) <= self.budget):
+            data = self.messages.popleft()
+            bulk.append(data)
+            size += len(data)
 
-            bulk = self.messages[:64]
-            self.messages = self.messages[64:]
-            seq = self.o_sequence
-            self.o_sequence += 1
+        seq = self.o_sequence
+        self.o_sequence += 1
+        return seq, bulk, bool(self.messages)
 
-        return seq, bulk
+    # Returns an empty bulk for a poll.
+    def get_poll(self):
+        seq = self.o_sequence
+        self.o_sequence += 1
+        return seq, []
 
-    def handler(self):
-        session = requests.Session()
+    # Responses are handed to the adapter in the order the remote extreme numbered them.
+    def received(self, response):
+        if response['msgs']:
+            self.delay = 0
+            self.wakeup.set()
+        self.responses.push(response['seq'], response['msgs'])
+
+    def deliver(self, messages):
+        self.frames_in += len(messages)
+        for message in messages:
+            self.adapter.dispatch(message)
+
+    # Adapts the budget to how long the last bulk took. Only full bulks (or slow ones) tell how much
+    # we can send, and the budget changes at most twice or half its size each time.
+    def adapt(self, size, elapsed, full):
+        if not full and elapsed < self.latency:
+            return
+        budget = size * self.latency / max(elapsed, 0.001)
+        budget = min(max(budget, self.budget / 2), self.budget * 2)
+        self.budget = int(min(max(budget, MIN_BUDGET), MAX_BUDGET))
+
+    # Sends a bulk of messages and hands the answer to the adapter. Returns False if the tunnel is lost.
+    @asyncio.coroutine
+    def post(self, seq, bulk, hold=0, full=False):
+        # Wrap the bulk into another message (an http tunnel message), its messages are already encoded.
+        if self.binary:
+            data = frames.BULK_HEADER.pack(seq, hold) + b''.join(bulk)
+        else:
+            request = {'cmd': 'sync', 'seq': seq}
+            if hold:
+                request['hold'] = hold
+            data = json.dumps(request)[:-1].encode() + b', "msgs": [' + b', '.join(bulk) + b']}'
+        self.logger.debug('request #%s (%d bytes, %d messages)', seq, len(data), len(bulk))
+        begin = self.loop.time()
+        try:
+            result = yield from self.pool.request('POST', data, TIMEOUT + hold, BINARY if self.binary else None)
+            response = self.parse(result)
+        except (HTTPError, OSError, asyncio.TimeoutError, ValueError, KeyError, struct.error):
+            self.logger.critical('tunnel exception: \n{}'.format(traceback.format_exc()))
+            self.loop.stop()
+            return False
+
+        if not hold:
+            self.adapt(len(data), self.loop.time() - begin, full)
+
+        if hold and 'hold' not in response:
+            self.logger.info('remote extreme does not support long polling')
+            self.holding = False
+            self.wakeup.set()
+
+        self.received(response)
+        return True
+
+    def parse(self, result):
+        if result.headers.get('content-type', '').startswith(BINARY):
+            seq, hold = frames.BULK_HEADER.unpack_from(result.body)
+            return {'seq': seq, 'hold': hold, 'msgs': frames.split(result.body, frames.BULK_HEADER.size)}
 
-        with self.lock:
-            session.cookies = self.cookies.copy()
+        response = json.loads(result.body.decode())
+        response['msgs'] = [frames.from_json(message) for message in response['msgs']]
+        return response
 
-        while True:
+    @asyncio.coroutine
+    def handler(self):
+        while self.running:
             # Get a bulk of messages to send.
-            seq, bulk = self.get_bulk()
-            if seq < 0:
+            seq, bulk, full = yield from self.get_bulk()
+            if not (yield from self.post(seq, bulk, full=full)):
                 break
 
-            # Wrap the bulk into another message (an http tunnel message)
-            data = json.dumps({'cmd': 'sync', 'msgs': bulk, 'seq': seq})
-            logging.debug('request data: {}'.format(data))
-            try:
-                result = session.post(self.url, data=data)
-            except requests.exceptions.ConnectionError:
-                logging.critical('tunnel exception: \n{}'.format(traceback.format_exc()))
-                self.loop.stop()
+    @asyncio.coroutine
+    def poll(self):
+        while self.running and self.holding:
+            seq, bulk = self.get_poll()
+            if not (yield from self.post(seq, bulk, self.hold)):
                 break
-            response = result.json()
-
-            with self.lock:
-                if response['msgs']:
-                    self.delay = 0
-                # Our sequence number should be the next one.
-                while self.i_sequence < response['seq']:
-                    logging.debug('waiting for sequence number synchronization')
-                    self.lock.wait()
-                for message in response['msgs']:
-                    self.adapter.dispatch(message)
-                self.i_sequence += 1
-                self.lock.notify_all()
 
-    def stop(self):
-        if self.stage == 0:
-            return
+    def metrics(self):
+        return [
+            ('tunnel_connects_total', 'counter', 'Keep-alive connections opened to the remote script.',
+             self.pool.connects),
+            ('tunnel_reconnects_total', 'counter', 'Requests sent again because the server closed their connection.',
+             self.pool.retries),
+            ('tunnel_frames_total', 'counter', 'Messages sent (out) and received (in) through the tunnel.',
+             {'direction="in"': self.frames_in, 'direction="out"': self.frames_out}),
+            ('tunnel_buffered_bytes', 'gauge', 'Bytes of the messages waiting for a request.',
+             sum(len(data) for data in self.messages)),
+            ('tunnel_queued_messages', 'gauge', 'Messages waiting for a request.', len(self.messages)),
+            ('tunnel_budget_bytes', 'gauge', 'Bytes of messages each request can carry.', self.budget),
+            ('tunnel_responses_total', 'counter', 'Responses handed to the adapter in order.',
+             self.responses.delivered),
+            ('tunnel_lost_responses_total', 'counter', 'Responses given up as lost.', self.responses.skipped),
+            ('tunnel_reordered_responses_total', 'counter', 'Responses which arrived before a previous one.',
+             self.responses.reordered),
+            ('tunnel_late_responses_total', 'counter', 'Responses dropped because they arrived after being given up.',
+             self.responses.late),
+            ('tunnel_reorder_pending_responses', 'gauge', 'Responses waiting for a previous one.',
+             len(self.responses.pending)),
+            ('tunnel_reorder_max_depth', 'gauge', 'Most responses ever waiting for a previous one.',
+             self.responses.max_depth),
+        ]
 
-        with self.lock:
-            self.stage = 0
-            self.lock.notify_all()
-        current_id = threading.get_ident()
-        logging.info('stopping threads ...')
-        for thread in self.threads:
-            if current_id == thread.ident:
-                continue
-            thread.join()
-        logging.info('threads stopped')
-
-        logging.info('stopping remote loop')
-        session = requests.Session()
-        session.cookies = self.cookies
-        session.post(self.url, data='{"cmd":"stop"}')
-        time.sleep(0.5)
-        session.delete(self.url)
-        logging.info('remote loop stopped')
+    @asyncio.coroutine
+    def wait(self):
+        self.running = False
+        self.logger.info('stopping workers ...')
+        tasks = self.workers + [self.poller]
+        for task in tasks:
+            task.cancel()
+        yield from asyncio.wait(tasks, loop=self.loop)
+        self.logger.info('workers stopped, {}'.format(self.responses.report()))
 
-    def start(self, loop):
-        self.loop = loop
-        session = requests.Session()
+        self.logger.info('stopping remote loop')
+        try:
+            yield from self.pool.request('POST', b'{"cmd":"stop"}')
+            yield from asyncio.sleep(0.5)
+            yield from self.pool.request('DELETE')
+        except (HTTPError, OSError, asyncio.TimeoutError):
+            self.logger.error('remote loop did not answer')
+        self.pool.close()
+        self.logger.info('remote loop stopped')
 
+    def stop(self):
+        if self.running:
+            self.loop.run_until_complete(self.wait())
+
+    @asyncio.coroutine
+    def bootstrap(self):
         # Create session
-        session.get(self.url)
-        self.cookies = session.cookies
-        logging.debug('cookies: {}'.format(self.cookies))
+        yield from self.pool.request('GET')
+        self.logger.debug('cookies: {}'.format(self.pool.cookies.output(header='', sep=';')))
+
+        # Old remote scripts answer nothing to the hello, we keep talking JSON with them.
+        try:
+            result = yield from self.pool.request('POST', json.dumps({'cmd': 'hello', 'caps': CAPABILITIES}).encode())
+            caps = json.loads(result.body.decode()).get('caps', [])
+        except ValueError:
+            caps = []
+        self.binary = 'binary' in caps
+        self.logger.info('using {} bulks'.format('binary' if self.binary else 'JSON'))
 
         # Start remote session loop
         try:
-            session.post(self.url, data='{"cmd": "start"}', timeout=1)
-        except socket.timeout:
+            yield from asyncio.wait_for(self.pool.request('POST', b'{"cmd": "start"}'), 1.0, loop=self.loop)
+        except asyncio.TimeoutError:
             pass
 
-        for index in range(0, self.number_of_threads):
-            thread = Thread(target=self.handler)
-            thread.start()
-            self.threads.append(thread)
+    def start(self, loop):
+        self.loop = loop
+        self.wakeup = asyncio.Event(loop=loop)
+        self.responses = ReorderBuffer(self.deliver, loop, self.gap_timeout)
+        # The poll waiting on the remote extreme has a connection of its own.
+        self.pool = Pool(self.url, self.number_of_connections + 1, loop)
+
+        loop.run_until_complete(self.bootstrap())
+
+        self.running = True
+        for index in range(0, self.number_of_workers):
+            self.workers.append(asyncio.async(self.handler(), loop=loop))
+        self.poller = asyncio.async(self.poll(), loop=loop)
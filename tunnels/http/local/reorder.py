@@ -0,0 +1,66 @@
+
+import logging
+
+
+# Seconds a missing response can hold back the ones after it.
+GAP_TIMEOUT = 30.0
+
+
+# Puts the responses of the remote extreme back in order. Each response is delivered as soon as all
+# the previous ones arrived, the ones after a gap wait here. If a gap lasts more than "gap_timeout"
+# seconds its response is considered lost and skipped.
+class ReorderBuffer:
+
+    def __init__(self, deliver, loop, gap_timeout=GAP_TIMEOUT):
+        self.logger = logging.getLogger('bogeyman')
+        self.deliver = deliver
+        self.loop = loop
+        self.gap_timeout = float(gap_timeout)
+        self.sequence = 0
+        self.pending = {}
+        self.timer = None
+
+        # Metrics
+        self.delivered = 0
+        self.reordered = 0
+        self.max_depth = 0
+        self.skipped = 0
+        self.late = 0
+
+    def push(self, seq, item):
+        if seq < self.sequence:
+            self.logger.debug('late response {} dropped'.format(seq))
+            self.late += 1
+            return
+
+        self.pending[seq] = item
+        if seq != self.sequence:
+            self.reordered += 1
+            self.max_depth = max(self.max_depth, len(self.pending))
+        self.flush()
+
+    def flush(self):
+        sequence = self.sequence
+        while self.sequence in self.pending:
+            self.deliver(self.pending.pop(self.sequence))
+            self.sequence += 1
+            self.delivered += 1
+
+        # The timer runs while the same gap is open.
+        if self.timer is not None and (self.sequence != sequence or not self.pending):
+            self.timer.cancel()
+            self.timer = None
+        if self.pending and self.timer is None:
+            self.timer = self.loop.call_later(self.gap_timeout, self.expire)
+
+    def expire(self):
+        self.timer = None
+        missing = min(self.pending) - self.sequence
+        self.logger.warning('responses {} to {} lost'.format(self.sequence, self.sequence + missing - 1))
+        self.skipped += missing
+        self.sequence += missing
+        self.flush()
+
+    def report(self):
+        return '{} responses, {} out of order (max depth {}), {} lost, {} late'.format(
+            self.delivered, self.reordered, self.max_depth, self.skipped, self.late)
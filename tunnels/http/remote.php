@@ -28,6 +28,68 @@
  *
  */
 
+/*
+ * Bulks travel as JSON (with base64 data) or, once the "binary" capability was agreed with a
+ * hello, as application/octet-stream bodies: SEQ (4 bytes), HOLD (2 bytes) and then one frame
+ * per message (see tunnels/frames.py).
+ *
+ * +-----+----+--------+---------+
+ * | CMD | ID | LENGTH | PAYLOAD |
+ * +-----+----+--------+---------+
+ *    1     4     4
+ *
+ * Messages keep their data raw inside the session.
+ */
+$COMMANDS = array('connect'=>1, 'status'=>2, 'sync'=>3, 'disconnect'=>4, 'stop'=>5);
+$CAPABILITIES = array('binary');
+$BINARY = 'application/octet-stream';
+
+function encode_frame($message) {
+    global $COMMANDS;
+    switch ($message['cmd']) {
+        case 'sync':
+            $payload = $message['data'];
+            break;
+        case 'connect':
+            $payload = pack('n', $message['port']) . $message['addr'];
+            break;
+        case 'status':
+            $payload = pack('C', $message['value']);
+            break;
+        default:
+            $payload = '';
+    }
+    return pack('CNN', $COMMANDS[$message['cmd']], $message['id'], strlen($payload)) . $payload;
+}
+
+function decode_frames($data, $offset) {
+    global $COMMANDS;
+    $names = array_flip($COMMANDS);
+    $messages = array();
+    while ($offset + 9 <= strlen($data)) {
+        $header = unpack('Ccmd/Nid/Nlength', substr($data, $offset, 9));
+        $payload = (string)substr($data, $offset + 9, $header['length']);
+        $offset += 9 + $header['length'];
+
+        $message = array('cmd'=>$names[$header['cmd'] & 0x7f], 'id'=>$header['id']);
+        switch ($message['cmd']) {
+            case 'sync':
+                $message['data'] = $payload;
+                break;
+            case 'connect':
+                $port = unpack('n', substr($payload, 0, 2));
+                $message['port'] = $port[1];
+                $message['addr'] = (string)substr($payload, 2);
+                break;
+            case 'status':
+                $value = unpack('C', $payload);
+                $message['value'] = $value[1];
+        }
+        array_push($messages, $message);
+    }
+    return $messages;
+}
+
 class Stream {
 
     public $sid = null;
@@ -85,8 +147,7 @@ class Tunnel {
                 case 'sync':
                     $sid = $message['id'];
                     if (array_key_exists($sid, $this->streams)) {
-                        $data = base64_decode($message['data']);
-                        if (!$this->streams[$sid]->send($data)) {
+                        if (!$this->streams[$sid]->send($message['data'])) {
                             $msg = array('id'=>$sid, 'cmd'=>'status', 'value'=>5);
                             array_push($this->outgoing, $msg);
                         }
@@ -151,7 +212,6 @@ class Tunnel {
                     unset($this->socket_to_sid[$sock]);
                     continue;
                 }
-                $data = base64_encode($data);
                 array_push($this->outgoing, array('id'=>$sid, 'cmd'=>'sync', 'data'=>$data));
             }
         }
@@ -163,9 +223,29 @@ class Tunnel {
 $method = $_SERVER['REQUEST_METHOD'];
 if ($method == 'POST') {
 
-    $request = json_decode(file_get_contents('php://input'), true);
+    $body = file_get_contents('php://input');
+    $binary = isset($_SERVER['CONTENT_TYPE']) && ($_SERVER['CONTENT_TYPE'] == $BINARY);
+    if ($binary) {
+        $request = unpack('Nseq/nhold', substr($body, 0, 6));
+        $request['cmd'] = 'sync';
+        $request['msgs'] = decode_frames($body, 6);
+    } else {
+        $request = json_decode($body, true);
+        if (isset($request['msgs'])) {
+            foreach ($request['msgs'] as &$message) {
+                if (isset($message['data']))
+                    $message['data'] = base64_decode($message['data']);
+            }
+            unset($message);
+        }
+    }
 
     switch($request['cmd']) {
+        case 'hello':
+            $caps = array_values(array_intersect($request['caps'], $CAPABILITIES));
+            echo json_encode(array('cmd'=>'hello', 'caps'=>$caps));
+            break;
+
         case 'start':
             if (!isset($_SESSION['running'])) {
                 $_SESSION['running'] = true;
@@ -214,12 +294,40 @@ if ($method == 'POST') {
                 break;
             }
 
+            /* Long polling: holds the request until there is something to send back */
+            $hold = isset($request['hold']) ? min(intval($request['hold']), 60) : 0;
+            if ($hold > 0) {
+                set_time_limit($hold + 30);
+                $end = microtime(true) + $hold;
+                while (empty($_SESSION['outgoing']) && $_SESSION['running'] && (microtime(true) < $end)) {
+                    session_write_close();
+                    usleep(20000);
+                    @session_start();
+                }
+            }
+
             $msgs = array_slice($_SESSION['outgoing'], 0, 64);
             $_SESSION['outgoing'] = array_slice($_SESSION['outgoing'], 64);
 
-            $response = array('seq'=>$_SESSION['o_seq'], 'cmd'=>'sync', 'msgs'=>$msgs);
+            $seq = $_SESSION['o_seq'];
             $_SESSION['o_seq']++;
 
+            if ($binary) {
+                header("Content-Type: $BINARY");
+                echo pack('Nn', $seq, $hold) . implode('', array_map('encode_frame', $msgs));
+                break;
+            }
+
+            foreach ($msgs as &$message) {
+                if (isset($message['data']))
+                    $message['data'] = base64_encode($message['data']);
+            }
+            unset($message);
+
+            $response = array('seq'=>$seq, 'cmd'=>'sync', 'msgs'=>$msgs);
+            if (isset($request['hold']))
+                $response['hold'] = $hold;
+
             echo json_encode($response);
 
             break;
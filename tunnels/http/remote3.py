@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+
+import json
+import uuid
+import base64
+import struct
+import asyncio
+import logging
+import argparse
+import traceback
+import collections
+import configparser
+
+
+# Remote extreme of the HTTP tunnel, it speaks the same protocol as remote.php (see
+# tunnels/http/local/http.py). This script must stay self-contained.
+#
+# Bulks travel as JSON (with base64 data) or, once the "binary" capability was agreed with a hello,
+# as application/octet-stream bodies: SEQ (4 bytes), HOLD (2 bytes) and then one frame per message.
+# +-----+----+--------+---------+
+# | CMD | ID | LENGTH | PAYLOAD |
+# +-----+----+--------+---------+
+#    1     4     4
+CAPABILITIES = ['binary']
+BINARY = 'application/octet-stream'
+
+HEADER = struct.Struct('>BII')
+BULK_HEADER = struct.Struct('>IH')
+
+COMMANDS = {'connect': 1, 'status': 2, 'sync': 3, 'disconnect': 4, 'stop': 5}
+NAMES = {code: name for name, code in COMMANDS.items()}
+
+COOKIE = 'BOGEYMAN'
+# Longest time a poll can be held open.
+MAX_HOLD = 60
+# Bytes of messages each response can carry.
+BUDGET = 1024 * 1024
+# Bytes a session can queue for the local extreme before its streams stop reading.
+LIMIT = 4 * 1024 * 1024
+# Seconds a session can live without requests.
+SESSION_TIMEOUT = 300
+# Seconds a request can wait for the destinations of its data to keep up.
+SYNC_TIMEOUT = 1.0
+CONNECT_TIMEOUT = 8.0
+
+
+def encode_frame(message):
+    cmd = message['cmd']
+    if cmd == 'sync':
+        payload = message['data']
+    elif cmd == 'connect':
+        payload = struct.pack('>H', message['port']) + message['addr'].encode()
+    elif cmd == 'status':
+        payload = struct.pack('B', message['value'])
+    else:
+        payload = b''
+    return HEADER.pack(COMMANDS[cmd], message.get('id', 0), len(payload)) + payload
+
+
+def decode_frames(data, offset):
+    messages = []
+    while offset < len(data):
+        command, sid, size = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        payload = data[offset:offset + size]
+        offset += size
+
+        message = {'cmd': NAMES.get(command & 0x7f), 'id': sid}
+        if message['cmd'] == 'sync':
+            message['data'] = payload
+        elif message['cmd'] == 'connect':
+            message['port'] = struct.unpack('>H', payload[:2])[0]
+            message['addr'] = payload[2:].decode()
+        elif message['cmd'] == 'status':
+            message['value'] = payload[0]
+        messages.append(message)
+    return messages
+
+
+def to_json(message):
+    if 'data' in message:
+        message = dict(message, data=base64.b64encode(message['data']).decode('ascii'))
+    return message
+
+
+def from_json(message):
+    if 'data' in message:
+        message['data'] = base64.b64decode(message['data'].encode('ascii'))
+    return message
+
+
+class Stream(asyncio.Protocol):
+    def __init__(self, sid, session):
+        self.sid = sid
+        self.session = session
+        self.logger = session.logger
+        self.transport = None
+        self.task = None
+        self.closed = False
+        self.writable = asyncio.Event(loop=session.loop)
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.logger.info('Stream #{} connected'.format(self.sid))
+        self.transport = transport
+        # Before any data of the stream.
+        self.session.push({'cmd': 'status', 'value': 0, 'id': self.sid})
+        if self.session.paused:
+            transport.pause_reading()
+
+    def data_received(self, data):
+        self.session.push({'cmd': 'sync', 'data': data, 'id': self.sid}, len(data))
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        self.logger.info('Closing stream connection #{}'.format(self.sid))
+        self.writable.set()
+        # Tells the local extreme, unless it was the one closing the stream.
+        if not self.closed:
+            self.session.push({'cmd': 'status', 'value': 5, 'id': self.sid})
+        self.session.streams.pop(self.sid, None)
+
+    # The local extreme has closed the stream.
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+        elif self.task is not None:
+            self.task.cancel()
+            self.session.streams.pop(self.sid, None)
+
+    @asyncio.coroutine
+    def connect(self, address, port):
+        try:
+            self.logger.info('Stream #{} trying to connect to {}:{}'.format(self.sid, address, port))
+            connect_coro = self.session.loop.create_connection(lambda: self, address, port)
+            yield from asyncio.wait_for(connect_coro, CONNECT_TIMEOUT, loop=self.session.loop)
+            self.task = None
+            return
+
+        except asyncio.TimeoutError:
+            self.logger.debug('Connection timeout')
+            status = 6
+        except ConnectionRefusedError:
+            self.logger.debug('Connection refused')
+            status = 5
+        except asyncio.CancelledError:
+            return
+        except OSError:
+            self.logger.debug('Connection error: {}'.format(traceback.format_exc()))
+            status = 4
+
+        self.task = None
+        # The stream may have connected just before the timeout, its closing is already told.
+        if self.transport is None:
+            self.session.push({'cmd': 'status', 'value': status, 'id': self.sid})
+            self.session.streams.pop(self.sid, None)
+
+
+class Session:
+
+    def __init__(self, sid, loop, logger, budget=BUDGET, limit=LIMIT):
+        self.sid = sid
+        self.loop = loop
+        self.logger = logger
+        self.budget = budget
+        self.limit = limit
+        self.running = False
+        self.last_seen = loop.time()
+
+        self.streams = {}
+        # Incoming bulks are executed in the order the local extreme numbered them.
+        self.i_sequence = 0
+        self.o_sequence = 0
+        self.buffer = {}
+
+        # Messages for the local extreme, streams stop reading while there are too many.
+        self.outgoing = collections.deque()
+        self.queued = 0
+        self.paused = False
+        self.ready = asyncio.Event(loop=loop)
+
+    def push(self, message, size=0):
+        self.outgoing.append((message, size))
+        self.queued += size
+        self.ready.set()
+        if self.queued > self.limit and not self.paused:
+            self.paused = True
+            for stream in self.streams.values():
+                if stream.transport is not None:
+                    stream.transport.pause_reading()
+
+    # Returns the messages fitting into a response (at least one).
+    def pop(self):
+        messages = []
+        size = 0
+        while self.outgoing and (not messages or size + self.outgoing[0][1] <= self.budget):
+            message, length = self.outgoing.popleft()
+            messages.append(message)
+            size += length
+        self.queued -= size
+
+        if not self.outgoing:
+            self.ready.clear()
+        if self.paused and self.queued <= self.limit // 2:
+            self.paused = False
+            for stream in self.streams.values():
+                if stream.transport is not None:
+                    stream.transport.resume_reading()
+        return messages
+
+    # Returns the stream the message wrote to, if any.
+    def execute(self, message):
+        if message['cmd'] == 'connect':
+            stream = Stream(message['id'], self)
+            self.streams[stream.sid] = stream
+            stream.task = asyncio.async(stream.connect(message['addr'], message['port']), loop=self.loop)
+
+        elif message['cmd'] == 'sync':
+            stream = self.streams.get(message['id'])
+            if stream is not None and stream.transport is not None:
+                stream.transport.write(message['data'])
+                return stream
+
+        elif message['cmd'] == 'disconnect':
+            stream = self.streams.get(message['id'])
+            if stream is not None:
+                stream.close()
+
+    # Runs the bulks which are in order. Returns False if the bulk is older than expected.
+    @asyncio.coroutine
+    def sync(self, seq, messages):
+        if seq < self.i_sequence:
+            return False
+
+        self.buffer[seq] = messages
+        written = set()
+        while self.i_sequence in self.buffer:
+            for message in self.buffer.pop(self.i_sequence):
+                written.add(self.execute(message))
+            self.i_sequence += 1
+
+        # Destinations which do not keep up slow down the requests carrying their data, for a while (their
+        # data stays queued in their transports) or, once they have more than "limit" bytes queued, until they
+        # catch up. The other streams are not held back by them.
+        slow = [stream for stream in written if stream is not None and not stream.writable.is_set()]
+        if slow:
+            full = any(stream.transport.get_write_buffer_size() > self.limit for stream in slow)
+            waiters = [asyncio.async(stream.writable.wait(), loop=self.loop) for stream in slow]
+            done, pending = yield from asyncio.wait(waiters, timeout=None if full else SYNC_TIMEOUT, loop=self.loop)
+            for waiter in pending:
+                waiter.cancel()
+        return True
+
+    @asyncio.coroutine
+    def poll(self, hold):
+        if hold and not self.outgoing and self.running:
+            try:
+                yield from asyncio.wait_for(self.ready.wait(), min(hold, MAX_HOLD), loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+        seq = self.o_sequence
+        self.o_sequence += 1
+        return seq, self.pop()
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+        for stream in list(self.streams.values()):
+            stream.close()
+
+
+class Request:
+
+    def __init__(self, method, version, headers, body):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def cookie(self, name):
+        for item in self.headers.get('cookie', '').split(';'):
+            key, _, value = item.strip().partition('=')
+            if key == name:
+                return value
+        return None
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class Tunnel:
+
+    def __init__(self, host, port, logger, budget=BUDGET, limit=LIMIT, session_timeout=SESSION_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.budget = int(budget)
+        self.limit = int(limit)
+        self.session_timeout = float(session_timeout)
+        self.loop = None
+        self.server = None
+        self.sessions = {}
+        self.handlers = set()
+
+    def session(self, request):
+        session = self.sessions.get(request.cookie(COOKIE))
+        if session is None:
+            session = Session(uuid.uuid4().hex, self.loop, self.logger, self.budget, self.limit)
+            self.sessions[session.sid] = session
+            self.logger.info('new session {}'.format(session.sid))
+        session.last_seen = self.loop.time()
+        return session
+
+    # Forgets the sessions which stopped sending requests.
+    def expire(self):
+        now = self.loop.time()
+        for session in list(self.sessions.values()):
+            if now - session.last_seen > self.session_timeout:
+                self.logger.info('session {} expired'.format(session.sid))
+                session.stop()
+                del self.sessions[session.sid]
+        self.loop.call_later(self.session_timeout / 4, self.expire)
+
+    @asyncio.coroutine
+    def read_request(self, reader):
+        line = yield from reader.readline()
+        if not line:
+            return None
+        method, _, version = line.decode('latin-1').strip().split(' ', 2)
+
+        headers = {}
+        while True:
+            line = (yield from reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = b''
+        if 'content-length' in headers:
+            body = yield from reader.readexactly(int(headers['content-length']))
+        return Request(method, version, headers, body)
+
+    # Returns the body of the response and its content type.
+    @asyncio.coroutine
+    def execute(self, request, session):
+        if request.method == 'DELETE':
+            session.stop()
+            self.sessions.pop(session.sid, None)
+            return b'', None
+
+        if request.method != 'POST':
+            return json.dumps({'running': session.running}).encode(), 'application/json'
+
+        binary = request.headers.get('content-type') == BINARY
+        if binary:
+            seq, hold = BULK_HEADER.unpack_from(request.body)
+            message = {'cmd': 'sync', 'seq': seq, 'hold': hold, 'msgs': decode_frames(request.body, BULK_HEADER.size)}
+        else:
+            message = json.loads(request.body.decode())
+            message['msgs'] = [from_json(msg) for msg in message.get('msgs', [])]
+
+        if message['cmd'] == 'hello':
+            caps = [cap for cap in message.get('caps', []) if cap in CAPABILITIES]
+            return json.dumps({'cmd': 'hello', 'caps': caps}).encode(), 'application/json'
+
+        elif message['cmd'] == 'start':
+            session.running = True
+
+        elif message['cmd'] == 'stop':
+            session.stop()
+
+        elif message['cmd'] == 'sync':
+            if not (yield from session.sync(message['seq'], message['msgs'])):
+                return b'{"cmd":"error"}', 'application/json'
+
+            seq, messages = yield from session.poll(message.get('hold', 0))
+            if binary:
+                return BULK_HEADER.pack(seq, message['hold']) + b''.join(map(encode_frame, messages)), BINARY
+
+            response = {'seq': seq, 'cmd': 'sync', 'msgs': [to_json(msg) for msg in messages]}
+            if 'hold' in message:
+                response['hold'] = message['hold']
+            return json.dumps(response).encode(), 'application/json'
+
+        return b'', None
+
+    @asyncio.coroutine
+    def handler(self, reader, writer):
+        task = asyncio.Task.current_task(loop=self.loop)
+        self.handlers.add(task)
+        try:
+            while True:
+                request = yield from self.read_request(reader)
+                if request is None:
+                    break
+
+                session = self.session(request)
+                try:
+                    body, content_type = yield from self.execute(request, session)
+                    status = '200 OK'
+                except (ValueError, KeyError, struct.error):
+                    self.logger.debug('bad request: {}'.format(traceback.format_exc()))
+                    body, content_type = b'', None
+                    status = '400 Bad Request'
+
+                keep_alive = request.keep_alive()
+                headers = ['HTTP/1.1 {}'.format(status), 'Content-Length: {}'.format(len(body)),
+                           'Set-Cookie: {}={}; path=/'.format(COOKIE, session.sid),
+                           'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+                if content_type:
+                    headers.append('Content-Type: {}'.format(content_type))
+                writer.writelines([('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'), body])
+                yield from writer.drain()
+                if not keep_alive:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.handlers.discard(task)
+            writer.close()
+
+    @asyncio.coroutine
+    def stop_and_wait(self):
+        self.server.close()
+        yield from self.server.wait_closed()
+        for session in self.sessions.values():
+            session.stop()
+        for task in list(self.handlers):
+            task.cancel()
+        if self.handlers:
+            yield from asyncio.wait(self.handlers, loop=self.loop)
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+
+        try:
+            server_coroutine = asyncio.start_server(self.handler, self.host, self.port, loop=self.loop)
+            self.server = self.loop.run_until_complete(server_coroutine)
+            self.logger.info('listening on {}:{}'.format(self.host, self.port))
+            self.loop.call_later(self.session_timeout / 4, self.expire)
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            self.logger.info('stopping tunnel')
+
+        self.loop.run_until_complete(self.stop_and_wait())
+
+        self.logger.debug('closing loop')
+        self.loop.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-p', '--port', type=int, help='host port (default: 8080)')
+    parser.add_argument('-i', '--ip', help='host address. default 127.0.0.1')
+    parser.add_argument('-l', '--log', choices=['debug', 'info', 'warning', 'error', 'critical'])
+    parser.add_argument('-c', '--config', default='', help='uses a configuration file')
+
+    args = parser.parse_args()
+
+    # Default configuration
+    config = {'ip': '127.0.0.1', 'port': 8080, 'log': 'info', 'budget': BUDGET, 'limit': LIMIT,
+              'session_timeout': SESSION_TIMEOUT}
+
+    # Config file configuration
+    if args.config:
+        config_file = configparser.ConfigParser(allow_no_value=True)
+        if config_file.read(args.config) and ('http' in config_file.sections()):
+            # Tunnel configuration
+            for key, value in config_file.items('http'):
+                config[key.lower()] = value if value is None else value.lower()
+
+    for option in ['ip', 'port', 'log']:
+        value = getattr(args, option)
+        config[option] = value if value else config[option]
+
+    # Starts program
+    logging.basicConfig(format='[%(levelname)-0.1s][%(module)s] %(message)s')
+    logger = logging.getLogger('remote3')
+    logger.setLevel(getattr(logging, config['log'].upper()))
+
+    tunnel = Tunnel(config['ip'], config['port'], logger, config['budget'], config['limit'],
+                    config['session_timeout'])
+    tunnel.start()
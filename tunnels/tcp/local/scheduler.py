@@ -0,0 +1,214 @@
+
+import asyncio
+import collections
+
+
+# Bytes each stream can send per round.
+QUANTUM = 64 * 1024
+# Bytes kept in the transport buffer, the rest waits here so it can still be reordered.
+LIMIT = 64 * 1024
+# Frames are written in batches of up to BATCH_SIZE bytes, gathered during one loop iteration or
+# during DELAY microseconds.
+BATCH_SIZE = 64 * 1024
+DELAY = 0
+
+# Priority classes, lower goes first.
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_PORTS = '22,23,53,3389,5900'
+
+
+def parse_ports(ports):
+    return set(int(port) for port in str(ports).split(',') if port.strip())
+
+
+# Deficit round robin scheduler for the frames of one tunnel connection.
+# Control frames (status, window, ...) go first, then the streams of each priority class take turns
+# to send up to QUANTUM bytes. Classes are served in strict priority order.
+# Frames are tuples of byte strings (header and payload), each batch is written with one writelines.
+class Scheduler:
+
+    def __init__(self, writer, loop, quantum=QUANTUM, limit=LIMIT, batch_size=BATCH_SIZE, delay=DELAY):
+        self.writer = writer
+        self.loop = loop
+        self.quantum = quantum
+        self.limit = limit
+        self.batch_size = int(batch_size)
+        self.delay = int(delay) / 1000000
+
+        self.control = collections.deque()
+        self.queues = {}
+        self.deficits = {}
+        self.active = [collections.deque(), collections.deque()]
+        # Whether the stream at the head of each class already got its quantum this turn.
+        self.served = [False, False]
+
+        self.scheduled = False
+        self.waiting = False
+        writer.transport.set_write_buffer_limits(high=limit)
+
+        # Bytes of the frames still queued.
+        self.queued = 0
+
+        # Frames written and not acknowledged yet (None unless the link can be resumed), how many were
+        # acknowledged, and the ones to write again after a resumption.
+        self.replay = None
+        self.replay_size = 0
+        self.replay_limit = 0
+        self.acknowledged = 0
+        self.resend = collections.deque()
+
+        # How well batching works.
+        self.writes = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def push_control(self, frame):
+        size = sum(len(part) for part in frame)
+        self.control.append((frame, size))
+        self.queued += size
+        self.schedule()
+
+    def push(self, sid, frame, priority=BULK):
+        queue = self.queues.get(sid)
+        if queue is None:
+            queue = self.queues[sid] = collections.deque()
+            self.deficits[sid] = 0
+            self.active[priority].append(sid)
+        size = sum(len(part) for part in frame)
+        queue.append((frame, size))
+        self.queued += size
+        self.schedule()
+
+    # Only control frames if "held".
+    def pop(self, held=False):
+        if self.control:
+            return self.control.popleft()
+        if held:
+            return None
+
+        for priority, active in enumerate(self.active):
+            while active:
+                sid = active[0]
+                queue = self.queues[sid]
+                if not self.served[priority]:
+                    self.deficits[sid] += self.quantum
+                    self.served[priority] = True
+
+                if queue[0][1] <= self.deficits[sid]:
+                    frame = queue.popleft()
+                    self.deficits[sid] -= frame[1]
+                    if not queue:
+                        del self.queues[sid]
+                        del self.deficits[sid]
+                        active.popleft()
+                        self.served[priority] = False
+                    return frame
+
+                # Its turn is over, the remaining deficit is kept for the next one.
+                active.rotate(-1)
+                self.served[priority] = False
+        return None
+
+    # Frames are written once per loop iteration (or after the delay), while the transport buffer has room.
+    def schedule(self):
+        if not (self.scheduled or self.waiting or self.writer is None):
+            self.scheduled = True
+            if self.delay:
+                self.loop.call_later(self.delay, self.flush)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def write(self, size, held=False):
+        parts = []
+        length = 0
+        while length < size:
+            if self.resend:
+                frame = self.resend.popleft()
+            else:
+                frame = self.pop(held)
+                if frame is None:
+                    break
+                self.queued -= frame[1]
+                if self.replay is not None:
+                    self.replay.append(frame)
+                    self.replay_size += frame[1]
+            parts.extend(frame[0])
+            length += frame[1]
+            self.frames += 1
+
+        if parts:
+            self.writer.writelines(parts)
+            self.writes += 1
+            self.bytes += length
+        return length
+
+    def flush(self):
+        self.scheduled = False
+        if self.writer is None:
+            return
+        transport = self.writer.transport
+        while transport.get_write_buffer_size() <= self.limit:
+            # Over the replay limit only the frames to write again and the control ones (pings, pongs,
+            # windows, ...) go, the next acknowledge lets the streams go on.
+            held = self.replay is not None and self.replay_size > self.replay_limit
+            if not self.write(self.batch_size, held):
+                return
+
+        self.waiting = True
+        asyncio.async(self.wait(), loop=self.loop)
+
+    @asyncio.coroutine
+    def wait(self):
+        try:
+            yield from self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.waiting = False
+        self.flush()
+
+    # Writes everything right away (the frame format is about to change).
+    def flush_all(self):
+        while self.write(self.batch_size):
+            pass
+
+    # From now on the frames written are kept until they are acknowledged.
+    def enable_replay(self, limit):
+        self.replay = collections.deque()
+        self.replay_limit = int(limit)
+
+    # The other extreme received "value" frames (modulo 2^32) in total.
+    def acknowledge(self, value):
+        count = (value - self.acknowledged) & 0xffffffff
+        if self.replay is None or count > len(self.replay):
+            return False
+        for index in range(count):
+            self.replay_size -= self.replay.popleft()[1]
+        self.acknowledged = value
+        self.schedule()
+        return True
+
+    # The link lost its connection, frames wait until another one takes its place.
+    def detach(self):
+        self.writer = None
+        self.resend.clear()
+
+    # Writes again the frames the other extreme did not receive, then goes on with the queued ones.
+    # Returns False if it received frames we never wrote.
+    def attach(self, writer, received):
+        if not self.acknowledge(received):
+            return False
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high=self.limit)
+        self.resend = collections.deque(self.replay)
+        self.scheduled = False
+        self.waiting = False
+        self.schedule()
+        return True
+
+    def report(self):
+        if not self.writes:
+            return 'nothing written'
+        return '{} frames in {} writes ({:.1f} frames and {} bytes per write)'.format(
+            self.frames, self.writes, self.frames / self.writes, self.bytes // self.writes)
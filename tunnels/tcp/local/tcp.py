@@ -1,51 +1,463 @@
 
-import json
 import time
-import struct
+import zlib
+import random
 import asyncio
 import logging
+import collections
+
+from ... import frames
+from .scheduler import Scheduler, INTERACTIVE, BULK, PRIORITY_PORTS, BATCH_SIZE, DELAY, parse_ports
+
+
+# Seconds to wait for the remote extreme to answer the hello message (at least, see TCP.handshake).
+HANDSHAKE_TIMEOUT = 2.0
+
+# Messages each stream can queue while the tunnel is not ready, and seconds it waits for the
+# tunnel once its queue is full.
+QUEUE_SIZE = 16
+TIMEOUT = 60.0
+
+# How streams are assigned to the tunnel connections.
+POLICIES = ['hash', 'least', 'round']
+
+
+# What a tunnel connection agreed on with the remote extreme, the JSON protocol until it answers the hello.
+class Settings:
+
+    def __init__(self):
+        self.header = None
+        self.chunk_size = frames.MAX_LEGACY_DATA
+        # Credit the remote extreme grants to each new stream (None if it does not support flow control).
+        self.window = None
+        # zlib level of the data we send (None unless the remote extreme agreed on it).
+        self.compression = None
+        # Whether the remote extreme relays UDP datagrams.
+        self.datagrams = False
+
+
+class Connection:
+
+    def __init__(self, reader, writer, loop, batch_size=BATCH_SIZE, batch_delay=DELAY):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.scheduler = Scheduler(writer, loop, batch_size=batch_size, delay=batch_delay)
+        self.settings = Settings()
+        self.ready = False
+        # Number of streams assigned to this connection.
+        self.streams = 0
+        # Heartbeat and its timer, if the remote extreme answers pings.
+        self.heartbeat = None
+        self.timer = None
+
+        # Session resumption: id of the link, the lost link this connection offers to resume, frames
+        # received (and acknowledged), and how long the link waits to be resumed once it is lost.
+        self.link = None
+        self.orphan = None
+        self.received = 0
+        self.reported = 0
+        self.ack_timer = None
+        self.expiry = None
+
+    def write(self, message, priority=BULK):
+        if self.settings.header is None:
+            frame = (frames.encode_json(message),)
+        else:
+            frame = frames.pack(message, self.settings.header)
+
+        # Stream data (and its end) keeps its order, other messages go first.
+        if message['cmd'] in ('sync', 'disconnect', 'datagram'):
+            self.scheduler.push(message['id'], frame, priority)
+        else:
+            self.scheduler.push_control(frame)
+
+    # Counts a frame received, the remote extreme learns it once a few of them arrived or a moment later.
+    def count(self):
+        self.received += 1
+        if self.received - self.reported >= frames.ACK_FRAMES:
+            self.acknowledge()
+        elif self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(frames.ACK_DELAY, self.acknowledge)
+
+    # Acks go straight to the transport, they are not counted nor kept for a resumption.
+    def acknowledge(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.scheduler.writer is not None:
+            self.reported = self.received
+            self.writer.write(frames.encode({'cmd': 'ack', 'value': self.received & 0xffffffff},
+                                            self.settings.header))
 
 
 class TCP:
 
-    def __init__(self, tunnel_ip, tunnel_port, reverse=False):
+    def __init__(self, tunnel_ip, tunnel_port, reverse=False, window=frames.WINDOW, max_window=frames.MAX_WINDOW,
+                 queue_size=QUEUE_SIZE, timeout=TIMEOUT, connections=1, policy='hash',
+                 priority_ports=PRIORITY_PORTS, compression=frames.COMPRESSION, batch_size=BATCH_SIZE,
+                 batch_delay=DELAY, heartbeat=frames.HEARTBEAT, heartbeat_misses=frames.MISSES,
+                 resume_timeout=frames.RESUME_TIMEOUT, replay_size=frames.REPLAY_SIZE,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
         self.logger = logging.getLogger('bogeyman')
         self.host = tunnel_ip
         self.port = tunnel_port
         self.reverse = reverse
 
-        self.task = None
+        # Per stream flow control, the credit we grant to each new stream (the one the remote extreme grants
+        # is in the settings of each connection).
+        self.initial_window = int(window)
+        self.max_window = max(int(max_window), self.initial_window)
+
+        # Messages waiting for the tunnel to be ready, by stream.
+        self.queue_size = int(queue_size)
+        self.timeout = float(timeout)
+        self.queues = {}
+
+        # Pool of tunnel connections. Each stream sticks to one of them until it dies.
+        assert policy in POLICIES, 'unknown connection policy: {}'.format(policy)
+        self.number_of_connections = max(int(connections), 1)
+        self.policy = policy
+        self.connections = []
+        self.routes = {}
+        self.next_connection = 0
+
+        # Streams to these destination ports are scheduled before the bulk ones.
+        self.priority_ports = parse_ports(priority_ports)
+        self.priorities = {}
+
+        # Frames are written in batches of up to "batch_size" bytes, gathered during "batch_delay"
+        # microseconds (or one loop iteration).
+        self.batch_size = int(batch_size)
+        self.batch_delay = int(batch_delay)
+
+        # zlib level of the data we send (if the remote extreme agreed on it) and compression contexts by
+        # stream.
+        self.level = int(compression)
+        self.deflaters = {}
+        self.inflaters = {}
+
+        # Seconds between pings (0 disables them), and unanswered intervals before a connection is dropped.
+        self.heartbeat = float(heartbeat)
+        self.heartbeat_misses = int(heartbeat_misses)
+
+        # Remote extremes which do not answer the hello in time are taken for old ones, which only speak JSON.
+        # The wait follows the retransmission timeout of the slowest connection, the last one measured while no
+        # connection has any (0 until then), and "binary" tells whether the remote extreme ever answered.
+        self.handshake_timeout = float(handshake_timeout)
+        self.rto = 0
+        self.binary = False
+
+        # Session resumption. Lost links keep their streams (and the frames the remote extreme did not
+        # acknowledge) for "resume_timeout" seconds, waiting for a new connection to take their place.
+        self.session = random.getrandbits(63)
+        self.resume_timeout = float(resume_timeout)
+        self.replay_size = int(replay_size)
+        self.links = 0
+        self.orphans = []
+
+        # Metrics. "lost" are the connections which were not replaced yet.
+        self.frames_in = 0
+        self.frames_out = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.lost = 0
+        self.dead = 0
+        self.resumed = 0
+
+        self.tasks = []
+        self.handlers = set()
         self.tunnel = None
         self.adapter = None
         self.loop = None
-        self.writer = None
+        # Settings of the last connection which got ready, for the streams which have none yet.
+        self.negotiated = Settings()
+        self.ready = None
         self.running = False
 
     def set_peer(self, peer):
         self.adapter = peer
 
+    # Returns the connection a stream has to use.
+    def route(self, sid):
+        connection = self.routes.get(sid)
+        if connection is not None and (connection.ready or connection.expiry is not None):
+            return connection
+
+        if not self.connections:
+            return None
+
+        if self.policy == 'least':
+            connection = min(self.connections, key=lambda c: c.streams)
+        elif self.policy == 'round':
+            connection = self.connections[self.next_connection % len(self.connections)]
+            self.next_connection += 1
+        else:
+            connection = self.connections[sid % len(self.connections)]
+
+        # Messages without stream (id 0) do not stick to any connection.
+        if sid:
+            self.routes[sid] = connection
+            connection.streams += 1
+        return connection
+
+    # Settings of the connection a stream goes through (it sticks to it from now on), or of the last one which
+    # got ready if there is none.
+    def settings(self, sid):
+        connection = self.route(sid)
+        return connection.settings if connection is not None else self.negotiated
+
+    def release(self, sid):
+        self.priorities.pop(sid, None)
+        self.deflaters.pop(sid, None)
+        self.inflaters.pop(sid, None)
+        connection = self.routes.pop(sid, None)
+        if connection is not None:
+            connection.streams -= 1
+
     def dispatch(self, message):
-        if self.writer is None:
+        connection = self.route(message.get('id', 0))
+        if connection is None:
             return False
-        self.logger.debug('receive message {}'.format(message))
-        data = json.dumps(message).encode()
-        self.writer.write(struct.pack('>H', len(data)) + data)
+        self.logger.debug('receive message %s #%s (%d bytes)', message['cmd'], message.get('id'),
+                          len(message.get('data', '')))
+
+        if message['cmd'] == 'connect' and message['port'] in self.priority_ports:
+            self.priorities[message['id']] = INTERACTIVE
+
+        # Datagrams are mostly name lookups, someone is waiting for them.
+        elif message['cmd'] == 'datagram':
+            self.priorities[message['id']] = INTERACTIVE
+
+        elif message['cmd'] == 'sync' and connection.settings.compression:
+            deflater = self.deflaters.get(message['id'])
+            if deflater is None:
+                deflater = self.deflaters[message['id']] = frames.Deflater(connection.settings.compression)
+            message = deflater.compress(message)
+
+        connection.write(message, self.priorities.get(message.get('id'), BULK))
+        self.frames_out += 1
+        if message['cmd'] == 'disconnect':
+            self.release(message['id'])
+        return True
+
+    # Sends a message, queueing it if the tunnel is not ready. Once the stream queue is full, it waits
+    # until the tunnel is back. Returns False if that did not happen in time.
+    @asyncio.coroutine
+    def send(self, message):
+        deadline = self.loop.time() + self.timeout
+        while not self.dispatch(message):
+            queue = self.queues.setdefault(message['id'], collections.deque())
+            if len(queue) < self.queue_size:
+                queue.append(message)
+                return True
+
+            try:
+                yield from asyncio.wait_for(self.ready.wait(), deadline - self.loop.time(), loop=self.loop)
+            except asyncio.TimeoutError:
+                return False
         return True
 
+    # A connection is ready. If it is the first one, the queued messages go first.
+    def set_ready(self, connection):
+        self.negotiated = connection.settings
+        if not connection.ready:
+            connection.ready = True
+            self.connections.append(connection)
+            self.logger.info('{} of {} connections ready'.format(len(self.connections), self.number_of_connections))
+        if self.ready.is_set():
+            return
+
+        self.ready.set()
+        queues, self.queues = self.queues, {}
+        for queue in queues.values():
+            for message in queue:
+                self.dispatch(message)
+
+    def set_lost(self, connection):
+        if connection.ready:
+            connection.ready = False
+            self.connections.remove(connection)
+        if not self.connections:
+            self.ready.clear()
+
+        if connection.ack_timer is not None:
+            connection.ack_timer.cancel()
+            connection.ack_timer = None
+        # Its streams stay with it, their messages are queued until the link is resumed.
+        if connection.scheduler.replay is not None and self.running and self.resume_timeout > 0:
+            connection.scheduler.detach()
+            connection.expiry = self.loop.call_later(self.resume_timeout, self.abandon, connection)
+            self.orphans.append(connection)
+        # The lost link it offered to resume waits for another one.
+        if connection.orphan is not None:
+            if connection.orphan.expiry is not None:
+                self.orphans.append(connection.orphan)
+            connection.orphan = None
+
+    # Offers the remote extreme to resume a lost link through the new connection.
+    def offer(self, connection):
+        if self.orphans:
+            connection.orphan = self.orphans.pop(0)
+            connection.link = connection.orphan.link
+        else:
+            self.links += 1
+            connection.link = self.links
+
+    # The connection takes the place of the lost link it offered, unless the remote extreme does not have
+    # it anymore. Returns the connection to use from now on.
+    def resume(self, connection, message):
+        orphan, connection.orphan = connection.orphan, None
+        if orphan is None:
+            return connection
+
+        if orphan.expiry is not None and 'received' in message and \
+                orphan.settings.header == connection.settings.header:
+            if orphan.scheduler.attach(connection.writer, message['received']):
+                orphan.expiry.cancel()
+                orphan.expiry = None
+                orphan.reader = connection.reader
+                orphan.writer = connection.writer
+                self.resumed += 1
+                self.logger.info('link {} resumed, {} frames sent again'.format(
+                    orphan.link, len(orphan.scheduler.resend)))
+                return orphan
+
+        self.abandon(orphan)
+        return connection
+
+    # The link was not resumed in time, its streams are lost.
+    def abandon(self, connection):
+        if connection.expiry is not None:
+            connection.expiry.cancel()
+            connection.expiry = None
+        if connection in self.orphans:
+            self.orphans.remove(connection)
+
+        sids = [sid for sid, route in self.routes.items() if route is connection]
+        self.logger.info('link {} lost with {} streams'.format(connection.link, len(sids)))
+        for sid in sids:
+            self.release(sid)
+            self.adapter.dispatch({'cmd': 'status', 'value': 1, 'id': sid})
+
+    # Seconds to wait for the hello answer.
+    def handshake(self):
+        rtos = [connection.heartbeat.rtt + 4 * connection.heartbeat.rttvar for connection in self.connections
+                if connection.heartbeat is not None and connection.heartbeat.rtt is not None]
+        if rtos:
+            self.rto = max(rtos)
+        return max(self.handshake_timeout, self.rto)
+
+    # Old remote extremes never answer the hello message, so after a while we keep talking JSON. Not if the
+    # remote extreme already talked binary, or if the connection offers to resume a lost link (that would
+    # lose it): the answer is just slow, the connection is dropped and the next one tries again. The link
+    # is kept, a late answer still upgrades the connection.
+    def legacy(self, connection):
+        if connection.ready:
+            return
+        if self.binary or connection.orphan is not None:
+            self.logger.warning('no hello answer in {:.1f} seconds, dropping the connection'.format(self.handshake()))
+            connection.writer.transport.abort()
+            return
+        self.logger.warning('no hello answer in {:.1f} seconds, the remote extreme does not speak the binary '
+                            'protocol'.format(self.handshake()))
+        self.set_ready(connection)
+
+    # The remote extreme has accepted the binary protocol.
+    def upgrade(self, connection, message):
+        caps = message.get('caps', [])
+        self.logger.info('using binary protocol version {} {}'.format(message['version'], caps))
+        self.binary = True
+        # Frames still queued were encoded as JSON, they have to go before the upgrade.
+        connection.scheduler.flush_all()
+        connection.writer.write(frames.encode_json({'cmd': 'upgrade'}))
+        settings = connection.settings
+        settings.header, settings.chunk_size = frames.negotiate(caps)
+
+        if 'resume' in caps:
+            connection = self.resume(connection, message)
+            if connection.scheduler.replay is None and self.resume_timeout > 0:
+                connection.scheduler.enable_replay(self.replay_size)
+        else:
+            connection.link = None
+            if connection.orphan is not None:
+                self.abandon(connection.orphan)
+                connection.orphan = None
+        # The resumed link takes the settings agreed through the new connection.
+        connection.settings = settings
+        settings.window = message.get('window') if 'window' in caps else None
+        # Compressed data can be a bit bigger than the original, so it needs large frames.
+        if 'zlib' in caps and 'large' in caps:
+            settings.compression = self.level
+        settings.datagrams = 'udp' in caps and 'large' in caps
+        if 'ping' in caps and self.heartbeat > 0:
+            connection.heartbeat = frames.Heartbeat(self.heartbeat, self.heartbeat_misses)
+            connection.timer = self.loop.call_later(self.heartbeat, self.beat, connection)
+        self.set_ready(connection)
+        return connection
+
+    # Pings the remote extreme, the connection is aborted once its pings go unanswered for too long (its
+    # handler then sees it closed, and a new one is made).
+    def beat(self, connection):
+        heartbeat = connection.heartbeat
+        ping = heartbeat.beat(self.loop.time())
+        if heartbeat.expired():
+            self.logger.warning('no pong in {:.0f} seconds, dropping the connection'.format(
+                heartbeat.interval * heartbeat.missed))
+            self.dead += 1
+            connection.timer = None
+            connection.writer.transport.abort()
+            return
+
+        if ping is not None:
+            connection.write(ping)
+        connection.timer = self.loop.call_later(heartbeat.interval, self.beat, connection)
+
+    # Smoothed round trip time of the tunnel (its fastest connection), None until a pong arrived.
+    def rtt(self):
+        rtts = [connection.heartbeat.rtt for connection in self.connections
+                if connection.heartbeat is not None and connection.heartbeat.rtt is not None]
+        return min(rtts) if rtts else None
+
     @asyncio.coroutine
     def handler(self, reader, writer):
         self.logger.info('connection ready')
-        self.task = asyncio.Task.current_task(loop=self.loop)
+        task = asyncio.Task.current_task(loop=self.loop)
+        self.handlers.add(task)
+        self.connects += 1
+        if self.lost:
+            self.lost -= 1
+            self.reconnects += 1
 
-        self.writer = writer
-        while self.running:
+        # The remote extreme only connects again to replace a connection it lost, maybe before we noticed (then
+        # its link would not be offered, and its streams would be lost). It gets a moment to go.
+        if self.reverse:
+            deadline = self.loop.time() + self.handshake()
+            try:
+                while len(self.connections) >= self.number_of_connections and not self.orphans and \
+                        self.running and self.loop.time() < deadline:
+                    yield from asyncio.sleep(0.05, loop=self.loop)
+            except asyncio.CancelledError:
+                self.handlers.discard(task)
+                writer.close()
+                return
+
+        connection = Connection(reader, writer, self.loop, self.batch_size, self.batch_delay)
+        header = None
+        corrupt = False
+
+        self.offer(connection)
+        hello = {'cmd': 'hello', 'version': frames.VERSION, 'caps': frames.capabilities(self.level),
+                 'window': self.initial_window, 'session': self.session, 'link': connection.link,
+                 'received': connection.orphan.received & 0xffffffff if connection.orphan else 0}
+        writer.write(frames.encode_json(hello))
+        fallback = self.loop.call_later(self.handshake(), self.legacy, connection)
+
+        while self.running and not corrupt:
             try:
-                data = yield from reader.readexactly(2)
-                size = struct.unpack('>H', data)[0]
-                data = yield from reader.readexactly(size)
+                messages = yield from reader.read(header)
 
-            except asyncio.streams.IncompleteReadError:
-                self.writer = None
+            except (asyncio.streams.IncompleteReadError, ConnectionError):
                 self.logger.info('disconnected')
                 break
 
@@ -56,16 +468,57 @@ class TCP:
                 self.loop.stop()
                 break
 
-            message = json.loads(data.decode('ascii'))
+            self.frames_in += len(messages)
+            for message in messages:
+                self.logger.debug('incoming message %s #%s (%d bytes)', message['cmd'], message.get('id'),
+                                  len(message.get('data', '')))
+
+                if message['cmd'] == 'hello':
+                    fallback.cancel()
+                    connection = self.upgrade(connection, message)
+                    header = connection.settings.header
+                    continue
 
-            self.logger.debug('incoming message {}'.format(message))
-            self.adapter.dispatch(message)
+                if message['cmd'] == 'ack':
+                    connection.scheduler.acknowledge(message['value'])
+                    continue
 
+                if header is not None and connection.link is not None:
+                    connection.count()
+
+                if message['cmd'] == 'ping':
+                    connection.write({'cmd': 'pong', 'value': message['value']})
+                    continue
+
+                if message['cmd'] == 'pong':
+                    if connection.heartbeat is not None:
+                        connection.heartbeat.pong(message, self.loop.time())
+                    continue
+
+                try:
+                    message = frames.inflate(message, self.inflaters)
+                except zlib.error as e:
+                    # The stream data of the connection can not be trusted anymore.
+                    self.logger.warning('corrupt compressed data, dropping the connection: {}'.format(e))
+                    writer.transport.abort()
+                    corrupt = True
+                    break
+                self.adapter.dispatch(message)
+
+        fallback.cancel()
+        if connection.timer is not None:
+            connection.timer.cancel()
+        # Keeps the timeout measured so far, in case this was the last connection.
+        self.handshake()
+        self.set_lost(connection)
+        self.handlers.discard(task)
+        if self.running:
+            self.lost += 1
         try:
-            self.writer.close()
+            writer.close()
         except:
             pass
-        self.logger.info('connection closed')
+        self.logger.info('connection closed, {}'.format(connection.scheduler.report()))
 
     # Keeps connecting with the other tunnel extreme.
     @asyncio.coroutine
@@ -73,7 +526,7 @@ class TCP:
         while self.running:
             self.logger.info('connecting to {}:{}'.format(self.host, self.port))
             try:
-                connect_coro = asyncio.open_connection(self.host, self.port, loop=self.loop)
+                connect_coro = frames.open_connection(self.host, self.port, self.loop)
                 reader, writer = yield from asyncio.wait_for(connect_coro, 8.0)
                 yield from self.handler(reader, writer)
 
@@ -89,6 +542,29 @@ class TCP:
             except asyncio.CancelledError:
                 self.running = False
 
+    def metrics(self):
+        buffered = sum(connection.writer.transport.get_write_buffer_size() + connection.scheduler.queued
+                       for connection in self.connections)
+        rtt = self.rtt()
+        families = [] if rtt is None else [('tunnel_rtt_seconds', 'gauge', 'Smoothed round trip time.', rtt)]
+        replay = sum(connection.scheduler.replay_size for connection in self.connections + self.orphans)
+        return families + [
+            ('tunnel_connections', 'gauge', 'Tunnel connections ready.', len(self.connections)),
+            ('tunnel_connects_total', 'counter', 'Tunnel connections established.', self.connects),
+            ('tunnel_reconnects_total', 'counter', 'Tunnel connections established to replace lost ones.',
+             self.reconnects),
+            ('tunnel_dead_connections_total', 'counter', 'Tunnel connections dropped for not answering pings.',
+             self.dead),
+            ('tunnel_resumed_total', 'counter', 'Lost links resumed by a new connection.', self.resumed),
+            ('tunnel_lost_links', 'gauge', 'Lost links waiting to be resumed.', len(self.orphans)),
+            ('tunnel_replay_bytes', 'gauge', 'Bytes of the frames kept until they are acknowledged.', replay),
+            ('tunnel_frames_total', 'counter', 'Messages sent (out) and received (in) through the tunnel.',
+             {'direction="in"': self.frames_in, 'direction="out"': self.frames_out}),
+            ('tunnel_buffered_bytes', 'gauge', 'Bytes queued by the schedulers and the transports.', buffered),
+            ('tunnel_queued_messages', 'gauge', 'Messages waiting for the tunnel to be ready.',
+             sum(len(queue) for queue in self.queues.values())),
+        ]
+
     @asyncio.coroutine
     def wait(self):
         self.running = False
@@ -97,8 +573,9 @@ class TCP:
                 self.tunnel.close()
                 yield from asyncio.wait_for(self.tunnel.wait_closed(), 2.0, loop=self.loop)
             else:
-                self.tunnel.cancel()
-                yield from asyncio.wait_for(self.tunnel, 2.0, loop=self.loop)
+                for task in self.tasks:
+                    task.cancel()
+                yield from asyncio.wait_for(asyncio.wait(self.tasks, loop=self.loop), 2.0, loop=self.loop)
         except asyncio.TimeoutError:
             self.logger.debug('timeout')
         except asyncio.CancelledError:
@@ -106,24 +583,26 @@ class TCP:
         except:
             self.logger.debug('unknown exception')
 
-        self.task.cancel()
-        yield from self.task
+        for task in list(self.handlers):
+            task.cancel()
+            yield from task
 
-        #if self.task is not None:
-        #    print('ESPERANDO TASK QUE ESTA A MEDIAS')
-        #    yield from self.task
+        for connection in self.orphans:
+            connection.expiry.cancel()
 
     def stop(self):
         self.loop.run_until_complete(self.wait())
 
     def start(self, loop):
         self.loop = loop
+        self.ready = asyncio.Event(loop=loop)
         self.running = True
 
         if self.reverse:
-            server_coroutine = asyncio.start_server(self.handler, self.host, self.port, loop=loop)
+            server_coroutine = frames.start_server(self.handler, self.host, self.port, loop)
             self.tunnel = loop.run_until_complete(server_coroutine)
             self.logger.info('listening on {}:{}'.format(self.host, self.port))
 
         else:
-            self.tunnel = asyncio.async(self.connect(), loop=loop)
+            for index in range(0, self.number_of_connections):
+                self.tasks.append(asyncio.async(self.connect(), loop=loop))
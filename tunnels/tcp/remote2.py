@@ -2,227 +2,771 @@
 
 import time
 import json
+import zlib
+import errno
 import base64
 import socket
 import select
 import struct
 import logging
 import argparse
+import threading
 import traceback
+import Queue as queue
 import ConfigParser as configparser
 
-from threading import Thread, Condition
+from collections import deque
+
+
+# Binary frame protocol (see tunnels/frames.py, this script must stay self-contained).
+# +-----+----+--------+---------+
+# | CMD | ID | LENGTH | PAYLOAD |
+# +-----+----+--------+---------+
+#    1     4    2/4
+# The highest bit of CMD marks sync payloads compressed with the zlib context of their stream.
+VERSION = 1
+CAPABILITIES = ['large', 'zlib', 'ping']
+
+LEGACY_HEADER = struct.Struct('>H')
+HEADER = struct.Struct('>BIH')
+LARGE_HEADER = struct.Struct('>BII')
+
+MAX_PAYLOAD = 0xffff
+MAX_LARGE_PAYLOAD = 256 * 1024
+MAX_LEGACY_DATA = 48750
+
+COMMANDS = {'connect': 1, 'status': 2, 'sync': 3, 'disconnect': 4, 'stop': 5, 'ping': 8, 'pong': 9}
+NAMES = dict((code, name) for name, code in COMMANDS.items())
+COMPRESSED = 0x80
+
+COMPRESSION = 6
+MIN_COMPRESS = 128
+PROBE = 16 * 1024
+RATIO = 0.9
+SIGNATURES = (b'\x16\x03', b'\x17\x03', b'\x1f\x8b', b'PK\x03\x04', b'\x89PNG', b'\xff\xd8\xff')
+
+# Seconds a stream can take to connect (name resolution included), and threads resolving names.
+CONNECT_TIMEOUT = 8.0
+RESOLVERS = 4
+
+# Seconds between pings, and intervals without pong before the tunnel is considered dead.
+HEARTBEAT = 5.0
+MISSES = 3
+
+# Bytes read from the tunnel, and sent to a socket, at once.
+RECV_SIZE = 256 * 1024
+SEND_SIZE = 256 * 1024
+# Bytes a socket can have waiting to be sent before what feeds it stops being read.
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+READ = 1
+WRITE = 2
+
+
+def negotiate(caps):
+    if caps is None:
+        return None, MAX_LEGACY_DATA
+    if 'large' in caps:
+        return LARGE_HEADER, MAX_LARGE_PAYLOAD
+    return HEADER, MAX_PAYLOAD
+
+
+# Heartbeat of the tunnel connection (see tunnels/frames.py).
+class Heartbeat:
+
+    def __init__(self, interval=HEARTBEAT, misses=MISSES):
+        self.interval = float(interval)
+        self.misses = int(misses)
+        self.rtt = None
+        self.rttvar = None
+        self.value = 0
+        self.sent = None
+        self.missed = 0
+
+    def beat(self, now):
+        if self.sent is not None:
+            self.missed += 1
+            return None
+        self.value = (self.value + 1) & 0xffffffff
+        self.sent = now
+        return {'cmd': 'ping', 'value': self.value}
+
+    def expired(self):
+        return self.missed >= self.misses
+
+    def pong(self, message, now):
+        if self.sent is None or message['value'] != self.value:
+            return
+        sample = now - self.sent
+        self.sent = None
+        self.missed = 0
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+
+# Compression context of the data one stream sends (see tunnels/frames.py).
+class Deflater:
+
+    def __init__(self, level=COMPRESSION):
+        self.context = zlib.compressobj(level)
+        self.original = 0
+        self.compressed = 0
+
+    def compress(self, message):
+        data = message['data']
+        if self.context is None or len(data) < MIN_COMPRESS:
+            return message
+
+        if not self.original and data.startswith(SIGNATURES):
+            self.context = None
+            return message
+
+        payload = self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        if self.original < PROBE:
+            self.original += len(data)
+            self.compressed += len(payload)
+            if self.original >= PROBE and self.compressed > self.original * RATIO:
+                self.context = None
+        return dict(message, data=payload, compressed=True)
+
+
+def encode_frame(message, header):
+    cmd = message['cmd']
+    if cmd == 'sync':
+        payload = message['data']
+    elif cmd == 'connect':
+        payload = struct.pack('>H', message['port']) + message['addr'].encode('utf-8')
+    elif cmd == 'status':
+        payload = struct.pack('B', message['value'])
+    elif cmd in ('ping', 'pong'):
+        payload = struct.pack('>I', message['value'])
+    else:
+        payload = b''
+    command = COMMANDS[cmd] | (COMPRESSED if message.get('compressed') else 0)
+    return header.pack(command, message.get('id', 0), len(payload)) + payload
+
+
+def decode_frame(command, sid, payload):
+    message = {'cmd': NAMES.get(command & ~COMPRESSED), 'id': sid}
+    if command & COMPRESSED:
+        message['compressed'] = True
+        command &= ~COMPRESSED
+    if command == COMMANDS['sync']:
+        message['data'] = payload
+    elif command == COMMANDS['connect']:
+        message['port'] = struct.unpack('>H', payload[:2])[0]
+        message['addr'] = payload[2:].decode('utf-8')
+    elif command == COMMANDS['status']:
+        message['value'] = struct.unpack('B', payload[:1])[0]
+    elif command in (COMMANDS['ping'], COMMANDS['pong']):
+        message['value'] = struct.unpack('>I', payload)[0]
+    return message
+
+
+def encode_json(message):
+    if 'data' in message:
+        message = dict(message, data=base64.b64encode(message['data']))
+    data = json.dumps(message).encode()
+    return LEGACY_HEADER.pack(len(data)) + data
+
+
+def decode_json(data):
+    message = json.loads(data)
+    if 'data' in message:
+        message['data'] = base64.b64decode(message['data'])
+    return message
+
+
+# Readiness registry of the streams. Sockets stay registered between polls, so each poll costs what the
+# ready sockets cost and not what all of them do. It uses epoll, poll or select, whichever the platform has.
+class Poller:
+
+    def __init__(self):
+        self.events = {}
+        if hasattr(select, 'epoll'):
+            self.backend = select.epoll()
+            self.flags = ((READ, select.EPOLLIN), (WRITE, select.EPOLLOUT))
+            self.errors = select.EPOLLERR | select.EPOLLHUP
+            self.epoll = True
+        elif hasattr(select, 'poll'):
+            self.backend = select.poll()
+            self.flags = ((READ, select.POLLIN), (WRITE, select.POLLOUT))
+            self.errors = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self.epoll = False
+        else:
+            self.backend = None
+
+    def mask(self, events):
+        return sum(flag for event, flag in self.flags if events & event)
+
+    def register(self, fd, events):
+        self.events[fd] = events
+        if self.backend is not None:
+            self.backend.register(fd, self.mask(events))
+
+    def modify(self, fd, events):
+        if self.events.get(fd) != events:
+            self.events[fd] = events
+            if self.backend is not None:
+                self.backend.modify(fd, self.mask(events))
+
+    def unregister(self, fd):
+        if self.events.pop(fd, None) is not None and self.backend is not None:
+            self.backend.unregister(fd)
+
+    # Returns (fd, events) for the ready sockets, errors are reported as both events so the next socket
+    # operation shows them.
+    def poll(self, timeout=None):
+        try:
+            if self.backend is None:
+                readers = [fd for fd, events in self.events.items() if events & READ]
+                writers = [fd for fd, events in self.events.items() if events & WRITE]
+                readers, writers, _ = select.select(readers, writers, [], timeout)
+                ready = dict((fd, READ) for fd in readers)
+                for fd in writers:
+                    ready[fd] = ready.get(fd, 0) | WRITE
+                return ready.items()
+
+            # epoll takes seconds and poll milliseconds.
+            if self.epoll:
+                result = self.backend.poll(-1 if timeout is None else timeout)
+            else:
+                result = self.backend.poll(None if timeout is None else timeout * 1000)
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = []
+        for fd, flags in result:
+            events = READ | WRITE if flags & self.errors else 0
+            for event, flag in self.flags:
+                if flags & flag:
+                    events |= event
+            ready.append((fd, events & self.events.get(fd, 0)))
+        return ready
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+
+def socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    sock, _ = server.accept()
+    server.close()
+    return sock, client
+
+
+# Name resolution of the streams. getaddrinfo blocks, so worker threads do it and every answer wakes up the
+# poller through "wakeup", which the loop watches like any other socket.
+class Resolver:
+
+    def __init__(self, workers=RESOLVERS):
+        self.requests = queue.Queue()
+        self.results = deque()
+        self.wakeup, self.signal = socketpair()
+        self.wakeup.setblocking(0)
+        for _ in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    # Returns the address of numeric hosts right away, None if the stream has to wait for its answer.
+    def resolve(self, stream, host, port):
+        try:
+            return socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM, 0,
+                                      socket.AI_NUMERICHOST)[0][4]
+        except socket.error:
+            self.requests.put((stream, host, port))
+            return None
+
+    def work(self):
+        while True:
+            stream, host, port = self.requests.get()
+            try:
+                result = (stream, socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4], None)
+            except socket.error as e:
+                # Name resolution errors
+                result = (stream, None, e.args[0])
+            self.results.append(result)
+            try:
+                self.signal.send(b'\0')
+            except socket.error:
+                return
+
+    # Returns the (stream, address, error) answers so far.
+    def answers(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+        answers = []
+        while self.results:
+            answers.append(self.results.popleft())
+        return answers
+
+    def close(self):
+        self.wakeup.close()
+        self.signal.close()
+
+
+# Outgoing data of a socket, sent as the socket becomes writable.
+class Buffer:
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    # Sends as much as the socket takes, small chunks go together.
+    def flush(self, sock):
+        while self.chunks:
+            chunks = [self.chunks.popleft()]
+            length = len(chunks[0])
+            while self.chunks and length < SEND_SIZE:
+                chunks.append(self.chunks.popleft())
+                length += len(chunks[-1])
+            data = b''.join(chunks)
+
+            try:
+                sent = sock.send(data)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                sent = 0
+
+            self.size -= sent
+            if sent < len(data):
+                self.chunks.appendleft(data[sent:])
+                return
 
 
 class Stream(socket.socket):
-    def __init__(self, sid):
+    def __init__(self, sid, compression=None):
         socket.socket.__init__(self, socket.AF_INET, socket.SOCK_STREAM)
+        self.setblocking(0)
         self.sid = sid
-        self.creation = time.time()
-
-
+        # The descriptor is still needed to unregister the socket once it is closed.
+        self.fd = self.fileno()
+        self.deadline = time.time() + CONNECT_TIMEOUT
+        # Where it connects to, None while its name is resolved.
+        self.address = None
+        self.connected = False
+        self.deflater = Deflater(compression) if compression else None
+        self.inflater = None
+        # Data for the destination, the stream is closed once it is sent if the local extreme closed it.
+        self.buffer = Buffer()
+        self.closing = False
+
+    def received(self, data, compressed=False):
+        if compressed:
+            if self.inflater is None:
+                self.inflater = zlib.decompressobj()
+            data = self.inflater.decompress(data)
+        self.buffer.append(data)
+
+
+# Every socket is non-blocking and handled by one loop. Each one has a buffer with what could not be sent
+# yet. Streams are not read while the tunnel buffer is over HIGH_WATER, and the tunnel is not read while the
+# buffer of a stream is, until they go under LOW_WATER.
 class Tunnel:
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, compression=COMPRESSION, heartbeat=HEARTBEAT, heartbeat_misses=MISSES):
         self.host = host
         self.port = port
         self.sock = None
-
-        # Stage 2 - trying to reconnect tunnel
-        # Stage 1 - tunnel working
-        # Stage 0 - aborting
-        self.stage = 2
-        self.lock = Condition()
+        self.main_sock = None
+        self.header, self.chunk_size = negotiate(None)
+        # zlib level of the data we send, "compression" is None until the local extreme agrees on it.
+        self.level = int(compression)
+        self.compression = None
+        self.running = True
+        # When to try the reverse connection again.
+        self.retry = 0
+
+        # Seconds between pings (0 disables them), and unanswered intervals before the tunnel is dropped.
+        # "pinger" is the heartbeat of the connection, if the local extreme answers pings.
+        self.heartbeat = float(heartbeat)
+        self.heartbeat_misses = int(heartbeat_misses)
+        self.pinger = None
+        self.next_beat = 0
+
+        # Data read from the tunnel and not handled yet, the header of its frames and the frames to send.
+        self.incoming = b''
+        self.read_header = None
+        self.outgoing = Buffer()
+
+        self.poller = Poller()
+        self.resolver = Resolver()
+        self.poller.register(self.resolver.wakeup.fileno(), READ)
         self.streams = {}
-        self.streams_thread = None
-        self.connecting_streams = []
+        # Sockets by descriptor, and the connecting ones in the order their timeouts expire.
+        self.sockets = {}
+        self.connecting_streams = deque()
+        self.paused = True
+        self.blocked = set()
 
-    # Sends message back to the other tunnel extreme.
+    # Sends message back to the other tunnel extreme. Messages are dropped while it is not connected.
     def dispatch(self, message):
-        data = json.dumps(message).encode()
-        data = struct.pack('>H', len(data)) + data
-        while data:
-            with self.lock:
-                # if the tunnel is not connected
-                while self.stage == 2:
-                    self.lock.wait()
-                if self.stage == 0:
-                    return False
-            try:
-                sent_bytes = self.sock.send(data)
-                data = data[sent_bytes:]
-            except Exception as e:
-                logging.debug('[#{}] sending exception: {}'.format(message['id'], e))
-                continue
-        return True
-
-    def streams_handler(self):
-        error_to_status = {111: 5, 0: 0}
-        while True:
-            with self.lock:
-                if self.stage == 0:
-                    return
-
-                if not (self.streams or self.connecting_streams):
-                    self.lock.wait()
-                    continue
-
-                active_streams = list(self.streams.values())
-                connecting_streams = list(self.connecting_streams)
-
-            ready_streams, connected_streams, _ = select.select(active_streams, connecting_streams, [], 1.0)
-
-            # Controls the connections' result value
-            for stream in connected_streams:
-                error = stream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
-                # 4 is the default status
-                status = error_to_status.get(error, 4)
-
-                if not self.dispatch({'cmd': 'status', 'value': status, 'id': stream.sid}):
-                    return
-
-                if status == 0:
-                    with self.lock:
-                        self.streams[stream.sid] = stream
-                        self.lock.notify_all()
-                    logging.info('connection #{} done'.format(stream.sid))
-                else:
-                    stream.close()
-
-            processed_sids = set([stream.sid for stream in connected_streams])
-            current_time = time.time()
-            with self.lock:
-                not_ready_streams = [stream for stream in self.connecting_streams if stream.sid not in processed_sids]
-                # Controls which connections have achieved timeout
-                self.connecting_streams = []
-                for stream in not_ready_streams:
-                    if (current_time - stream.creation) < 8.0:
-                        self.connecting_streams.append(stream)
-                    else:
-                        logging.debug('[#{}] connection timeout'.format(stream.sid))
-                        stream.close()
-
-            for stream in ready_streams:
-                try:
-                    data = stream.recv(48750)
-                    if data:
-                        logging.debug('data read: {}'.format(repr(data)))
-                        if not self.dispatch({'cmd': 'sync', 'data': base64.b64encode(data), 'id': stream.sid}):
-                            return
-                        continue
-
-                except socket.error as e:
-                    logging.debug('connection #{} error: {}'.format(stream.sid, e))
-
-                self.dispatch({'id': stream.sid, 'cmd': 'disconnect'})
-                with self.lock:
-                    stream.close()
-                    del(self.streams[stream.sid])
-
-    def fixed_recv(self, size):
-        total_data = b''
-        while len(total_data) < size:
-            data = self.sock.recv(size - len(total_data))
-            if not data:
-                return None
-            total_data += data
-        return total_data
-
-    def tunnel_handler(self):
+        if self.sock is not None:
+            self.outgoing.append(encode_json(message) if self.header is None else encode_frame(message, self.header))
+
+    # Answers the hello message, from now on we talk binary.
+    def upgrade(self, message):
+        version = min(message['version'], VERSION)
+        caps = [cap for cap in message.get('caps', []) if cap in CAPABILITIES]
+        if not self.level and 'zlib' in caps:
+            caps.remove('zlib')
+        self.dispatch({'cmd': 'hello', 'version': version, 'caps': caps})
+        self.header, self.chunk_size = negotiate(caps)
+        # Compressed data can be a bit bigger than the original, so it needs large frames.
+        self.compression = self.level if 'zlib' in caps and 'large' in caps else None
+        if 'ping' in caps and self.heartbeat > 0:
+            self.pinger = Heartbeat(self.heartbeat, self.heartbeat_misses)
+            self.next_beat = time.time() + self.heartbeat
+        logging.info('using binary protocol version {} {}'.format(version, caps))
+
+    # Updates which sockets are read and written after the buffers changed.
+    def update(self):
+        if self.paused:
+            paused = self.sock is None or len(self.outgoing) > LOW_WATER
+        else:
+            paused = self.sock is None or len(self.outgoing) > HIGH_WATER
+        if paused != self.paused:
+            self.paused = paused
+            for stream in self.streams.values():
+                self.watch(stream)
+
+        if self.sock is not None:
+            self.poller.modify(self.sock.fileno(), (0 if self.blocked else READ) | (WRITE if self.outgoing else 0))
+
+    def watch(self, stream):
+        if not stream.connected:
+            # Streams are registered once their names are resolved.
+            if stream.address is None:
+                return
+            events = WRITE
+        else:
+            events = (0 if self.paused or stream.closing else READ) | (WRITE if stream.buffer else 0)
+        self.poller.modify(stream.fd, events)
+
+    def connect_tunnel(self, sock):
         logging.info('connected')
+        sock.setblocking(0)
+        self.sock = sock
+        self.header, self.chunk_size = negotiate(None)
+        self.compression = None
+        self.incoming = b''
+        self.read_header = None
+        self.outgoing = Buffer()
+        self.poller.register(sock.fileno(), READ)
+        if self.main_sock is not None:
+            self.poller.modify(self.main_sock.fileno(), 0)
+
+    def close_tunnel(self):
+        logging.info('connection closed')
+        self.poller.unregister(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        self.pinger = None
+        if self.main_sock is not None:
+            self.poller.modify(self.main_sock.fileno(), READ)
+        else:
+            logging.debug('waiting 4 seconds before retrying reconnection')
+            self.retry = time.time() + 4.0
+
+    def flush_tunnel(self):
+        try:
+            self.outgoing.flush(self.sock)
+        except socket.error as e:
+            logging.debug('sending exception: {}'.format(e))
+            self.close_tunnel()
 
-        # Handles each incoming message
-        while True:
-            with self.lock:
-                if self.stage == 0:
-                    break
-
-            # Reads message size
-            data = self.fixed_recv(2)
-            if data is None:
-                break
-            size = struct.unpack('>H', data)[0]
-
-            # Reads message
-            data = self.fixed_recv(size)
-            if data is None:
+    def read_tunnel(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+
+        if not data:
+            self.close_tunnel()
+            return
+        self.incoming += data
+        self.parse()
+
+    # Returns the next message of the incoming data and where it ends, or None if it did not arrive whole.
+    def read_frame(self, offset):
+        header = self.read_header or LEGACY_HEADER
+        if len(self.incoming) - offset < header.size:
+            return None, offset
+
+        if self.read_header is None:
+            size = LEGACY_HEADER.unpack_from(self.incoming, offset)[0]
+        else:
+            command, sid, size = header.unpack_from(self.incoming, offset)
+        end = offset + header.size + size
+        if len(self.incoming) < end:
+            return None, offset
+
+        payload = self.incoming[offset + header.size:end]
+        if self.read_header is None:
+            return decode_json(payload), end
+        return decode_frame(command, sid, payload), end
+
+    # Handles the messages read, until a stream has too much data to send.
+    def parse(self):
+        offset = 0
+        while not self.blocked:
+            message, offset = self.read_frame(offset)
+            if message is None:
                 break
-
-            message = json.loads(data)
-            logging.debug('new message {}'.format(message))
-
-            if message['cmd'] == 'connect':
-                stream = Stream(message['id'])
-                stream.setblocking(0)
-                stream.connect_ex((message['addr'], message['port']))
-                logging.info('waiting connection #{id} to {addr}:{port}'.format(**message))
-                with self.lock:
-                    self.connecting_streams.append(stream)
-                    self.lock.notify_all()
-
-            elif message['cmd'] == 'sync':
-                data = base64.b64decode(message['data'])
-                with self.lock:
-                    if message['id'] in self.streams:
-                        self.streams[message['id']].send(data)
-
-            elif message['cmd'] == 'stop':
-                with self.lock:
-                    self.stage = 0
-                    self.lock.notify_all()
+            logging.debug('new message {} #{}'.format(message['cmd'], message.get('id')))
+            self.handle(message)
+        self.incoming = self.incoming[offset:]
+
+    def handle(self, message):
+        if message['cmd'] == 'hello':
+            self.upgrade(message)
+
+        elif message['cmd'] == 'upgrade':
+            self.read_header = self.header
+
+        elif message['cmd'] == 'connect':
+            stream = Stream(message['id'], self.compression)
+            logging.info('waiting connection #{id} to {addr}:{port}'.format(**message))
+            self.streams[stream.sid] = stream
+            self.sockets[stream.fd] = stream
+            self.connecting_streams.append(stream)
+            address = self.resolver.resolve(stream, message['addr'], message['port'])
+            if address is not None:
+                self.connect_stream(stream, address)
+
+        elif message['cmd'] == 'sync':
+            stream = self.streams.get(message['id'])
+            if stream is not None:
+                stream.received(message['data'], message.get('compressed', False))
+                if stream.connected:
+                    self.flush_stream(stream)
+
+        elif message['cmd'] == 'disconnect':
+            stream = self.streams.get(message['id'])
+            if stream is not None:
+                stream.closing = True
+                if stream.connected:
+                    self.flush_stream(stream)
+                else:
+                    self.remove(stream)
+
+        elif message['cmd'] == 'ping':
+            self.dispatch({'cmd': 'pong', 'value': message['value']})
+
+        elif message['cmd'] == 'pong':
+            if self.pinger is not None:
+                self.pinger.pong(message, time.time())
+
+        elif message['cmd'] == 'stop':
+            self.running = False
+
+    # Pings the local extreme, the tunnel is closed once its pings go unanswered for too long. Returns the
+    # seconds until the next ping.
+    def beat(self):
+        if self.pinger is None:
+            return None
+        current_time = time.time()
+        if current_time < self.next_beat:
+            return self.next_beat - current_time
+
+        ping = self.pinger.beat(current_time)
+        if self.pinger.expired():
+            logging.warning('no pong in {:.0f} seconds, dropping the connection'.format(
+                self.pinger.interval * self.pinger.missed))
+            self.close_tunnel()
+            return None
+
+        if ping is not None:
+            self.dispatch(ping)
+        self.next_beat = current_time + self.pinger.interval
+        return self.pinger.interval
+
+    # Closes the streams which took too long to connect. Returns the seconds until the next timeout.
+    def expire(self):
+        current_time = time.time()
+        while self.connecting_streams:
+            stream = self.connecting_streams[0]
+            # Closed streams may have left their descriptor to a newer one.
+            if self.sockets.get(stream.fd) is stream and not stream.connected:
+                if stream.deadline > current_time:
+                    return stream.deadline - current_time
+                logging.debug('[#{}] connection timeout'.format(stream.sid))
+                self.remove(stream)
+                self.dispatch({'cmd': 'status', 'value': 6, 'id': stream.sid})
+            self.connecting_streams.popleft()
+        return None
+
+    def connect_stream(self, stream, address, error=None):
+        if error is None:
+            stream.address = address
+            error = stream.connect_ex(address)
+            self.poller.register(stream.fd, WRITE)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.connected(stream, error)
+
+    # Connects the streams whose names were resolved, unless they were closed meanwhile.
+    def resolved(self):
+        for stream, address, error in self.resolver.answers():
+            if self.streams.get(stream.sid) is stream:
+                self.connect_stream(stream, address, error)
+
+    def remove(self, stream):
+        self.poller.unregister(stream.fd)
+        del(self.sockets[stream.fd])
+        stream.close()
+        self.streams.pop(stream.sid, None)
+        self.blocked.discard(stream.sid)
+
+    # Reports the connection result value.
+    def connected(self, stream, error=None):
+        if error is None:
+            error = stream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        # 4 is the default status
+        status = {errno.ECONNREFUSED: 5, 0: 0}.get(error, 4)
+        self.dispatch({'cmd': 'status', 'value': status, 'id': stream.sid})
+
+        if status == 0:
+            logging.info('connection #{} done'.format(stream.sid))
+            stream.connected = True
+            self.flush_stream(stream)
+        else:
+            self.remove(stream)
+
+    def readable(self, stream):
+        try:
+            data = stream.recv(self.chunk_size)
+            if data:
+                logging.debug('[#{}] {} bytes read'.format(stream.sid, len(data)))
+                message = {'cmd': 'sync', 'data': data, 'id': stream.sid}
+                if stream.deflater is not None:
+                    message = stream.deflater.compress(message)
+                self.dispatch(message)
+                return
+
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.debug('connection #{} error: {}'.format(stream.sid, e))
+
+        self.remove(stream)
+        self.dispatch({'id': stream.sid, 'cmd': 'disconnect'})
+
+    def flush_stream(self, stream):
+        try:
+            stream.buffer.flush(stream)
+        except socket.error as e:
+            logging.debug('connection #{} error: {}'.format(stream.sid, e))
+            self.remove(stream)
+            self.dispatch({'id': stream.sid, 'cmd': 'disconnect'})
+            return
+
+        if stream.closing and not stream.buffer:
+            self.remove(stream)
+            return
+
+        if len(stream.buffer) > HIGH_WATER:
+            self.blocked.add(stream.sid)
+        elif len(stream.buffer) <= LOW_WATER:
+            self.blocked.discard(stream.sid)
+        self.watch(stream)
+
+    def process(self, fd, events):
+        if self.main_sock is not None and fd == self.main_sock.fileno():
+            sock, address = self.main_sock.accept()
+            logging.info('connection from {}:{}'.format(*address))
+            self.connect_tunnel(sock)
+
+        elif fd == self.resolver.wakeup.fileno():
+            self.resolved()
+
+        elif self.sock is not None and fd == self.sock.fileno():
+            if events & WRITE:
+                self.flush_tunnel()
+            if events & READ and self.sock is not None:
+                self.read_tunnel()
+
+        elif fd in self.sockets:
+            stream = self.sockets[fd]
+            if not stream.connected:
+                self.connected(stream)
+                return
+            if events & WRITE:
+                self.flush_stream(stream)
+            if events & READ and fd in self.sockets:
+                self.readable(stream)
 
     # Keeps connecting with the other tunnel extreme.
     def start(self, reverse):
-        main_sock = None
         try:
-            # Starts streams handler thread.
-            self.streams_thread = Thread(target=self.streams_handler)
-            self.streams_thread.start()
-
             # Starts server socket if we have to listen for connections.
             if not reverse:
-                main_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                main_sock.bind((self.host, self.port))
-                main_sock.listen(2)
+                self.main_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.main_sock.bind((self.host, self.port))
+                self.main_sock.listen(2)
+                self.poller.register(self.main_sock.fileno(), READ)
                 logging.info('listening on {}:{}'.format(self.host, self.port))
 
-            # Reconnects until KeyboardInterrupt occur.
-            while True:
-                with self.lock:
-                    if self.stage == 0:
-                        break
-
-                try:
-                    if reverse:
-                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        logging.info('connecting to {}:{}'.format(self.host, self.port))
-                        sock.connect((self.host, self.port))
-
-                    else:
-                        sock, address = main_sock.accept()
-                        logging.info('connection from {}:{}'.format(*address))
-
-                    self.sock = sock
-                    with self.lock:
-                        self.stage = 1
-                        self.lock.notify_all()
-                    self.tunnel_handler()
-
-                    logging.info('connection closed')
-
-                except socket.timeout:
-                    logging.info('connection timeout')
-
-                except socket.error:
-                    logging.info('connection refused')
-
-                with self.lock:
-                    self.stage = 2
-                    self.lock.notify_all()
-
-                if reverse:
-                    logging.debug('waiting 4 seconds before retrying reconnection')
-                    time.sleep(4.0)
+            # Runs until KeyboardInterrupt or a stop message.
+            while self.running:
+                timeout = self.expire()
+                wait = self.beat()
+                if wait is not None:
+                    timeout = wait if timeout is None else min(timeout, wait)
+
+                if reverse and self.sock is None:
+                    if time.time() >= self.retry:
+                        try:
+                            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                            logging.info('connecting to {}:{}'.format(self.host, self.port))
+                            sock.connect((self.host, self.port))
+                            self.connect_tunnel(sock)
+
+                        except socket.error:
+                            logging.info('connection refused')
+                            logging.debug('waiting 4 seconds before retrying reconnection')
+                            self.retry = time.time() + 4.0
+
+                    if self.sock is None:
+                        wait = max(self.retry - time.time(), 0)
+                        timeout = wait if timeout is None else min(timeout, wait)
+
+                self.update()
+                for fd, events in self.poller.poll(timeout):
+                    self.process(fd, events)
+
+                # What the handled events queued goes out together.
+                if self.sock is not None:
+                    if not self.blocked and self.incoming:
+                        self.parse()
+                    if self.outgoing:
+                        self.flush_tunnel()
 
         except KeyboardInterrupt:
             logging.info('please wait until the program stops...')
@@ -230,14 +774,14 @@ class Tunnel:
         except:
             logging.critical('tunnel exception: \n{}'.format(traceback.format_exc()))
 
-        with self.lock:
-            self.stage = 0
-            self.lock.notify_all()
-
-        if main_sock is not None:
-            main_sock.close()
-
-        self.streams_thread.join(2.0)
+        for stream in list(self.streams.values()):
+            self.remove(stream)
+        if self.sock is not None:
+            self.sock.close()
+        if self.main_sock is not None:
+            self.main_sock.close()
+        self.resolver.close()
+        self.poller.close()
 
         logging.debug('shutting down')
 
@@ -255,7 +799,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # Default configuration
-    config = {'ip': '127.0.0.1', 'port': 8888, 'log': 'info', 'reverse': False}
+    config = {'ip': '127.0.0.1', 'port': 8888, 'log': 'info', 'reverse': False, 'compression': COMPRESSION,
+              'heartbeat': HEARTBEAT, 'heartbeat_misses': MISSES}
 
     # Config file configuration
     if args.config:
@@ -273,5 +818,6 @@ if __name__ == "__main__":
     logging.basicConfig(level=getattr(logging, config['log'].upper()),
                         format='[%(levelname)-0.1s][%(module)s] %(message)s')
 
-    tunnel = Tunnel(config['ip'], config['port'])
+    tunnel = Tunnel(config['ip'], config['port'], config['compression'], config['heartbeat'],
+                    config['heartbeat_misses'])
     tunnel.start(config['reverse'])
@@ -1,44 +1,893 @@
 #!/usr/bin/python3
 
 import json
+import zlib
+import bisect
+import functools
+import socket
 import struct
 import base64
 import asyncio
 import logging
 import argparse
 import traceback
+import collections
 import configparser
 
 
-class Stream(asyncio.Protocol):
+# Binary frame protocol (see tunnels/frames.py, this script must stay self-contained).
+# +-----+----+--------+---------+
+# | CMD | ID | LENGTH | PAYLOAD |
+# +-----+----+--------+---------+
+#    1     4    2/4
+# The highest bit of CMD marks sync payloads compressed with the zlib context of their stream.
+VERSION = 1
+CAPABILITIES = ['large', 'window', 'zlib', 'udp', 'ping', 'resume']
+
+LEGACY_HEADER = struct.Struct('>H')
+HEADER = struct.Struct('>BIH')
+LARGE_HEADER = struct.Struct('>BII')
+
+MAX_PAYLOAD = 0xffff
+MAX_LARGE_PAYLOAD = 256 * 1024
+MAX_LEGACY_DATA = 48750
+
+WINDOW = 256 * 1024
+MAX_WINDOW = 4 * 1024 * 1024
+
+COMMANDS = {'connect': 1, 'status': 2, 'sync': 3, 'disconnect': 4, 'stop': 5, 'window': 6, 'datagram': 7,
+            'ping': 8, 'pong': 9, 'ack': 10}
+DATAGRAM_HEADER = struct.Struct('>HB')
+NAMES = {code: name for name, code in COMMANDS.items()}
+COMPRESSED = 0x80
+
+COMPRESSION = 6
+MIN_COMPRESS = 128
+PROBE = 16 * 1024
+RATIO = 0.9
+SIGNATURES = (b'\x16\x03', b'\x17\x03', b'\x1f\x8b', b'PK\x03\x04', b'\x89PNG', b'\xff\xd8\xff')
+
+HEARTBEAT = 5.0
+MISSES = 3
+
+RESUME_TIMEOUT = 60.0
+REPLAY_SIZE = 4 * 1024 * 1024
+ACK_FRAMES = 16
+ACK_DELAY = 0.02
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+
+def negotiate(caps):
+    if caps is None:
+        return None, MAX_LEGACY_DATA
+    if 'large' in caps:
+        return LARGE_HEADER, MAX_LARGE_PAYLOAD
+    return HEADER, MAX_PAYLOAD
+
+
+# Heartbeat of one tunnel connection (see tunnels/frames.py).
+class Heartbeat:
+
+    def __init__(self, interval=HEARTBEAT, misses=MISSES):
+        self.interval = float(interval)
+        self.misses = int(misses)
+        self.rtt = None
+        self.rttvar = None
+        self.value = 0
+        self.sent = None
+        self.missed = 0
+
+    def beat(self, now):
+        if self.sent is not None:
+            self.missed += 1
+            return None
+        self.value = (self.value + 1) & 0xffffffff
+        self.sent = now
+        return {'cmd': 'ping', 'value': self.value}
+
+    def expired(self):
+        return self.missed >= self.misses
+
+    def pong(self, message, now):
+        if self.sent is None or message['value'] != self.value:
+            return
+        sample = now - self.sent
+        self.sent = None
+        self.missed = 0
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+
+# Compression context of the data one stream sends (see tunnels/frames.py).
+class Deflater:
+
+    def __init__(self, level=COMPRESSION):
+        self.context = zlib.compressobj(level)
+        self.original = 0
+        self.compressed = 0
+
+    def compress(self, message):
+        data = message['data']
+        if self.context is None or len(data) < MIN_COMPRESS:
+            return message
+
+        if not self.original and data.startswith(SIGNATURES):
+            self.context = None
+            return message
+
+        payload = self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        if self.original < PROBE:
+            self.original += len(data)
+            self.compressed += len(payload)
+            if self.original >= PROBE and self.compressed > self.original * RATIO:
+                self.context = None
+        return dict(message, data=payload, compressed=True)
+
+
+# Returns the frame header and payload, so they can be written without joining them first.
+def encode_frame(message, header):
+    cmd = message['cmd']
+    if cmd == 'sync':
+        payload = message['data']
+    elif cmd == 'connect':
+        payload = struct.pack('>H', message['port']) + message['addr'].encode()
+    elif cmd == 'status':
+        payload = struct.pack('B', message['value'])
+    elif cmd in ('window', 'ping', 'pong', 'ack'):
+        payload = struct.pack('>I', message['value'])
+    elif cmd == 'datagram':
+        address = message['addr'].encode()
+        payload = DATAGRAM_HEADER.pack(message['port'], len(address)) + address + message['data']
+    else:
+        payload = b''
+    command = COMMANDS[cmd] | (COMPRESSED if message.get('compressed') else 0)
+    return header.pack(command, message.get('id', 0), len(payload)), payload
+
+
+def decode_frame(command, sid, payload):
+    message = {'cmd': NAMES.get(command & ~COMPRESSED), 'id': sid}
+    if command & COMPRESSED:
+        message['compressed'] = True
+        command &= ~COMPRESSED
+    if command == COMMANDS['sync']:
+        message['data'] = payload
+    elif command == COMMANDS['connect']:
+        message['port'] = struct.unpack_from('>H', payload)[0]
+        message['addr'] = bytes(payload[2:]).decode()
+    elif command == COMMANDS['status']:
+        message['value'] = payload[0]
+    elif command in (COMMANDS['window'], COMMANDS['ping'], COMMANDS['pong'], COMMANDS['ack']):
+        message['value'] = struct.unpack('>I', payload)[0]
+    elif command == COMMANDS['datagram']:
+        message['port'], size = DATAGRAM_HEADER.unpack_from(payload)
+        offset = DATAGRAM_HEADER.size + size
+        message['addr'] = bytes(payload[DATAGRAM_HEADER.size:offset]).decode()
+        message['data'] = payload[offset:]
+    return message
+
+
+def encode_json(message):
+    if 'data' in message:
+        message = dict(message, data=base64.b64encode(message['data']).decode('ascii'))
+    data = json.dumps(message).encode()
+    return LEGACY_HEADER.pack(len(data)) + data
+
+
+def decode_json(data):
+    message = json.loads(data.decode('ascii'))
+    if 'data' in message:
+        message['data'] = base64.b64decode(message['data'].encode('ascii'))
+    return message
+
+
+# Reading side of a tunnel connection, each read returns every complete frame received so far (see
+# tunnels/frames.py).
+class FrameReader(asyncio.streams.FlowControlMixin):
+
+    def __init__(self, loop, connected=None):
+        super().__init__(loop=loop)
+        self.loop = loop
+        self.connected = connected
+        self.transport = None
+        self.buffer = b''
+        self.paused = False
+        self.eof = False
+        self.exception = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.connected is not None:
+            writer = asyncio.StreamWriter(transport, self, None, self.loop)
+            asyncio.async(self.connected(self, writer), loop=self.loop)
+
+    def data_received(self, data):
+        if not self.buffer:
+            self.buffer = data
+        else:
+            if not isinstance(self.buffer, bytearray):
+                self.buffer = bytearray(self.buffer)
+            self.buffer.extend(data)
+        if not self.paused and len(self.buffer) > HIGH_WATER:
+            self.paused = True
+            self.transport.pause_reading()
+        self.wakeup()
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.eof = True
+        self.exception = exc
+        self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def parse(self, header):
+        buffer = self.buffer
+        view = memoryview(buffer)
+        messages = []
+        offset = 0
+        if header is None:
+            if len(buffer) >= LEGACY_HEADER.size:
+                end = LEGACY_HEADER.size + LEGACY_HEADER.unpack_from(buffer)[0]
+                if end <= len(buffer):
+                    messages.append(decode_json(bytes(view[LEGACY_HEADER.size:end])))
+                    offset = end
+        else:
+            while len(buffer) - offset >= header.size:
+                command, sid, size = header.unpack_from(buffer, offset)
+                end = offset + header.size + size
+                if end > len(buffer):
+                    break
+                messages.append(decode_frame(command, sid, view[offset + header.size:end]))
+                offset = end
+
+        # Payloads are views of the buffer, what is left goes to a new one.
+        if offset:
+            self.buffer = bytearray(view[offset:]) if offset < len(buffer) else b''
+        else:
+            view.release()
+        if self.paused and len(self.buffer) <= LOW_WATER:
+            self.paused = False
+            self.transport.resume_reading()
+        return messages
+
+    @asyncio.coroutine
+    def read(self, header=None):
+        while True:
+            messages = self.parse(header)
+            if messages:
+                return messages
+            if self.exception is not None:
+                raise self.exception
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+
+            self.waiter = asyncio.Future(loop=self.loop)
+            try:
+                yield from self.waiter
+            finally:
+                self.waiter = None
+
+
+# Bytes each stream can send per round.
+QUANTUM = 64 * 1024
+# Bytes kept in the transport buffer, the rest waits here so it can still be reordered.
+LIMIT = 64 * 1024
+# Bytes each tunnel connection can have queued. Over it the streams it carries stop reading until half of
+# it was written (their windows only bound each one of them).
+QUEUE_BUDGET = 1024 * 1024
+# Frames are written in batches of up to BATCH_SIZE bytes, gathered during one loop iteration or
+# during DELAY microseconds.
+BATCH_SIZE = 64 * 1024
+DELAY = 0
+
+# Priority classes, lower goes first.
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_PORTS = '22,23,53,3389,5900'
+
+
+def parse_ports(ports):
+    return set(int(port) for port in str(ports).split(',') if port.strip())
+
+
+# Deficit round robin scheduler for the frames of one tunnel connection (see tunnels/tcp/local/scheduler.py).
+# Control frames (status, window, ...) go first, then the streams of each priority class take turns
+# to send up to QUANTUM bytes. Classes are served in strict priority order.
+# Frames are tuples of byte strings (header and payload), each batch is written with one writelines.
+class Scheduler:
+
+    def __init__(self, writer, loop, quantum=QUANTUM, limit=LIMIT, batch_size=BATCH_SIZE, delay=DELAY,
+                 budget=QUEUE_BUDGET):
+        self.writer = writer
+        self.loop = loop
+        self.quantum = quantum
+        self.limit = limit
+        self.batch_size = int(batch_size)
+        self.delay = int(delay) / 1000000
+
+        self.control = collections.deque()
+        self.queues = {}
+        self.deficits = {}
+        self.active = [collections.deque(), collections.deque()]
+        # Whether the stream at the head of each class already got its quantum this turn.
+        self.served = [False, False]
+
+        self.scheduled = False
+        self.waiting = False
+        writer.transport.set_write_buffer_limits(high=limit)
+
+        # Bytes of the frames still queued. Once they went over the budget, "drained" is called when they
+        # are under half of it again.
+        self.queued = 0
+        self.budget = int(budget)
+        self.backlogged = False
+        self.drained = None
+
+        # Frames written and not acknowledged yet (None unless the link can be resumed), how many were
+        # acknowledged, and the ones to write again after a resumption.
+        self.replay = None
+        self.replay_size = 0
+        self.replay_limit = 0
+        self.acknowledged = 0
+        self.resend = collections.deque()
+
+        # How well batching works.
+        self.writes = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def push_control(self, frame):
+        size = sum(len(part) for part in frame)
+        self.control.append((frame, size))
+        self.queued += size
+        self.schedule()
+
+    def push(self, sid, frame, priority=BULK):
+        queue = self.queues.get(sid)
+        if queue is None:
+            queue = self.queues[sid] = collections.deque()
+            self.deficits[sid] = 0
+            self.active[priority].append(sid)
+        size = sum(len(part) for part in frame)
+        queue.append((frame, size))
+        self.queued += size
+        if self.queued > self.budget:
+            self.backlogged = True
+        self.schedule()
+
+    # Only control frames if "held".
+    def pop(self, held=False):
+        if self.control:
+            return self.control.popleft()
+        if held:
+            return None
+
+        for priority, active in enumerate(self.active):
+            while active:
+                sid = active[0]
+                queue = self.queues[sid]
+                if not self.served[priority]:
+                    self.deficits[sid] += self.quantum
+                    self.served[priority] = True
+
+                if queue[0][1] <= self.deficits[sid]:
+                    frame = queue.popleft()
+                    self.deficits[sid] -= frame[1]
+                    if not queue:
+                        del self.queues[sid]
+                        del self.deficits[sid]
+                        active.popleft()
+                        self.served[priority] = False
+                    return frame
+
+                # Its turn is over, the remaining deficit is kept for the next one.
+                active.rotate(-1)
+                self.served[priority] = False
+        return None
+
+    # Frames are written once per loop iteration (or after the delay), while the transport buffer has room.
+    def schedule(self):
+        if not (self.scheduled or self.waiting or self.writer is None):
+            self.scheduled = True
+            if self.delay:
+                self.loop.call_later(self.delay, self.flush)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def write(self, size, held=False):
+        parts = []
+        length = 0
+        while length < size:
+            if self.resend:
+                frame = self.resend.popleft()
+            else:
+                frame = self.pop(held)
+                if frame is None:
+                    break
+                self.queued -= frame[1]
+                if self.replay is not None:
+                    self.replay.append(frame)
+                    self.replay_size += frame[1]
+            parts.extend(frame[0])
+            length += frame[1]
+            self.frames += 1
+
+        if parts:
+            self.writer.writelines(parts)
+            self.writes += 1
+            self.bytes += length
+        if self.backlogged and self.queued <= self.budget // 2:
+            self.backlogged = False
+            if self.drained is not None:
+                self.drained()
+        return length
+
+    def flush(self):
+        self.scheduled = False
+        if self.writer is None:
+            return
+        transport = self.writer.transport
+        while transport.get_write_buffer_size() <= self.limit:
+            # Over the replay limit only the frames to write again and the control ones (pings, pongs,
+            # windows, ...) go, the next acknowledge lets the streams go on.
+            held = self.replay is not None and self.replay_size > self.replay_limit
+            if not self.write(self.batch_size, held):
+                return
+
+        self.waiting = True
+        asyncio.async(self.wait(), loop=self.loop)
+
+    @asyncio.coroutine
+    def wait(self):
+        try:
+            yield from self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.waiting = False
+        self.flush()
+
+    # Writes everything right away (the frame format is about to change).
+    def flush_all(self):
+        while self.write(self.batch_size):
+            pass
+
+    # From now on the frames written are kept until they are acknowledged.
+    def enable_replay(self, limit):
+        self.replay = collections.deque()
+        self.replay_limit = int(limit)
+
+    # The other extreme received "value" frames (modulo 2^32) in total.
+    def acknowledge(self, value):
+        count = (value - self.acknowledged) & 0xffffffff
+        if self.replay is None or count > len(self.replay):
+            return False
+        for index in range(count):
+            self.replay_size -= self.replay.popleft()[1]
+        self.acknowledged = value
+        self.schedule()
+        return True
+
+    # The link lost its connection, frames wait until another one takes its place.
+    def detach(self):
+        self.writer = None
+        self.resend.clear()
+
+    # Writes again the frames the other extreme did not receive, then goes on with the queued ones.
+    # Returns False if it received frames we never wrote.
+    def attach(self, writer, received):
+        if not self.acknowledge(received):
+            return False
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high=self.limit)
+        self.resend = collections.deque(self.replay)
+        self.scheduled = False
+        self.waiting = False
+        self.schedule()
+        return True
+
+    def report(self):
+        if not self.writes:
+            return 'nothing written'
+        return '{} frames in {} writes ({:.1f} frames and {} bytes per write)'.format(
+            self.frames, self.writes, self.frames / self.writes, self.bytes // self.writes)
+
+
+# Seconds resolved names are kept (failed ones too), and how many of them.
+DNS_TTL = 60
+DNS_NEGATIVE_TTL = 5
+DNS_CACHE_SIZE = 1024
+
+
+# Caches the addresses of the names streams connect to. Entries expire after "ttl" seconds, failures after
+# "negative_ttl", and the least recently used go first once there are "size" of them. Streams asking for a
+# name which is already being resolved wait for that same lookup.
+class Resolver:
+
+    def __init__(self, loop, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, size=DNS_CACHE_SIZE):
+        self.loop = loop
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.size = int(size)
+        self.cache = collections.OrderedDict()
+        self.lookups = {}
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.failures = 0
+
+    # Returns a list of (family, address) for the name, or raises the resolution error.
+    @asyncio.coroutine
+    def resolve(self, host):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+                return [(family, (host, 0) if family == socket.AF_INET else (host, 0, 0, 0))]
+            except (OSError, ValueError):
+                pass
+
+        entry = self.cache.get(host)
+        if entry is not None:
+            expiry, addresses, error = entry
+            if expiry > self.loop.time():
+                self.hits += 1
+                self.cache.move_to_end(host)
+                if error is not None:
+                    raise error
+                return addresses
+            del self.cache[host]
+
+        lookup = self.lookups.get(host)
+        if lookup is None:
+            self.misses += 1
+            lookup = self.lookups[host] = asyncio.async(self.lookup(host), loop=self.loop)
+        else:
+            self.merged += 1
+        # The lookup goes on even if this stream is closed meanwhile.
+        return (yield from asyncio.shield(lookup, loop=self.loop))
+
+    @asyncio.coroutine
+    def lookup(self, host):
+        try:
+            infos = yield from self.loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            addresses = [(family, address) for family, _, _, _, address in infos]
+            self.store(host, addresses, None, self.ttl)
+            return addresses
+        except OSError as e:
+            self.failures += 1
+            self.store(host, None, e, self.negative_ttl)
+            raise
+        finally:
+            del self.lookups[host]
+
+    def store(self, host, addresses, error, ttl):
+        if ttl <= 0:
+            return
+        self.cache[host] = (self.loop.time() + ttl, addresses, error)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    # Connects to the first address of the name which accepts the connection.
+    @asyncio.coroutine
+    def create_connection(self, protocol_factory, host, port):
+        error = None
+        for family, address in (yield from self.resolve(host)):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.setblocking(False)
+                yield from self.loop.sock_connect(sock, address[:1] + (port,) + address[2:])
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            except:
+                sock.close()
+                raise
+            return (yield from self.loop.create_connection(protocol_factory, sock=sock))
+        raise error
+
+    def report(self):
+        return '{} hits, {} lookups ({} more streams waited for one), {} failed, {} names cached'.format(
+            self.hits, self.misses, self.merged, self.failures, len(self.cache))
+
+
+# Seconds the UDP socket of an association can stay idle.
+UDP_TIMEOUT = 60
+
+
+# UDP socket relaying the datagrams of a SOCKS5 UDP ASSOCIATE, to and from any destination. The first
+# datagram opens it and it is closed after "udp_timeout" idle seconds (the next datagram opens another).
+class Association(asyncio.DatagramProtocol):
+
     def __init__(self, sid, tunnel):
+        self.sid = sid
+        self.tunnel = tunnel
+        self.logger = tunnel.logger
+        self.transport = None
+        self.opening = None
+        self.timer = None
+        self.last_used = 0
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.closed:
+            transport.close()
+            return
+        self.timer = self.tunnel.loop.call_later(self.tunnel.udp_timeout, self.expire)
+
+    def datagram_received(self, data, address):
+        self.last_used = self.tunnel.loop.time()
+        self.tunnel.dispatch({'cmd': 'datagram', 'addr': address[0], 'port': address[1], 'data': data,
+                              'id': self.sid})
+
+    def error_received(self, exc):
+        self.logger.debug('[#{}] datagram error: {}'.format(self.sid, exc))
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def expire(self):
+        idle = self.tunnel.loop.time() - self.last_used
+        if idle < self.tunnel.udp_timeout:
+            self.timer = self.tunnel.loop.call_later(self.tunnel.udp_timeout - idle, self.expire)
+            return
+        self.timer = None
+        self.logger.debug('[#{}] closing idle UDP socket'.format(self.sid))
+        if self.tunnel.associations.get(self.sid) is self:
+            del self.tunnel.associations[self.sid]
+            self.tunnel.routes.pop(self.sid, None)
+        self.close()
+
+    @asyncio.coroutine
+    def send(self, address, port, data):
+        try:
+            if self.opening is None:
+                self.opening = asyncio.async(self.tunnel.loop.create_datagram_endpoint(
+                    lambda: self, local_addr=('0.0.0.0', 0)), loop=self.tunnel.loop)
+            yield from asyncio.shield(self.opening, loop=self.tunnel.loop)
+
+            for family, sockaddr in (yield from self.tunnel.resolver.resolve(address)):
+                if family == socket.AF_INET:
+                    break
+            else:
+                self.logger.debug('[#{}] no IPv4 address for {}'.format(self.sid, address))
+                return
+
+            if self.transport is not None and not self.closed:
+                self.last_used = self.tunnel.loop.time()
+                self.transport.sendto(data, (sockaddr[0], port))
+
+        except OSError as e:
+            self.logger.debug('[#{}] datagram to {}:{} dropped: {}'.format(self.sid, address, port, e))
+            # The socket could not be opened, the next datagram tries again.
+            if self.transport is None and self.opening.done():
+                self.opening = None
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+
+# Prometheus metrics (see metrics.py).
+PREFIX = 'bogeyman_'
+LATENCIES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LIFETIMES = (0.1, 1, 10, 60, 300, 1800, 3600, 14400)
+SIZES = (1024, 16 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024, 1024 * 1024 * 1024)
+SCRAPE_TIMEOUT = 5.0
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=''):
+        prefix = labels + ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, total))
+        labels = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+
+def render(families, prefix=PREFIX):
+    lines = []
+    for name, kind, description, value in families:
+        name = prefix + name
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        samples = value if isinstance(value, dict) else {'': value}
+        for labels, sample in sorted(samples.items()):
+            if isinstance(sample, Histogram):
+                lines.extend(sample.lines(name, labels))
+            else:
+                lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', sample))
+    return '\n'.join(lines) + '\n'
+
+
+# Stats listener, each scrape asks the tunnel for its metrics.
+@asyncio.coroutine
+def scrape(tunnel, reader, writer):
+    try:
+        request = yield from asyncio.wait_for(reader.readline(), SCRAPE_TIMEOUT, loop=tunnel.loop)
+        while (yield from asyncio.wait_for(reader.readline(), SCRAPE_TIMEOUT, loop=tunnel.loop)).strip():
+            pass
+    except (asyncio.TimeoutError, ConnectionError):
+        writer.close()
+        return
+
+    parts = request.decode('latin-1').split()
+    if len(parts) > 1 and parts[1].split('?')[0] in ('/', '/metrics'):
+        status, body = '200 OK', render(tunnel.metrics()).encode()
+    else:
+        status, body = '404 Not Found', b'not found\n'
+
+    headers = ['HTTP/1.0 {}'.format(status), 'Content-Type: text/plain; version=0.0.4; charset=utf-8',
+               'Content-Length: {}'.format(len(body)), 'Connection: close']
+    writer.writelines([('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'), body])
+    try:
+        yield from writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+class Stream(asyncio.Protocol):
+    def __init__(self, sid, tunnel, connection):
         self.sid = sid
         self.tunnel = tunnel
         self.logger = tunnel.logger
         self.transport = None
         self.task = None
 
+        self.priority = BULK
+
+        # Flow control (see tunnels/frames.py), if the connection of the stream agreed on it. A None credit
+        # means it is disabled.
+        self.credit = connection.window
+        self.window = tunnel.initial_window if connection.window is not None else 0
+        self.consumed = 0
+        self.reading = True
+        self.writing = True
+        # Whether its tunnel connection has too much queued.
+        self.throttled = False
+
+        # Compression contexts (None until they are needed).
+        self.deflater = Deflater(connection.compression) if connection.compression else None
+        self.inflater = None
+
+        # Data to the destination (upload) and from it (download).
+        self.begin = tunnel.loop.time()
+        self.connected = False
+        self.uploaded = 0
+        self.downloaded = 0
+
     def connection_made(self, transport):
         self.logger.info('Stream #{} connected'.format(self.sid))
         self.transport = transport
         self.task = None
+        self.connected = True
 
     def data_received(self, data):
-        remaining = data
-        while remaining:
-            b64data = base64.b64encode(remaining[:48750]).decode('ascii')
-            remaining = remaining[48750:]
-            self.tunnel.dispatch({'cmd': 'sync', 'data': b64data, 'id': self.sid})
+        self.downloaded += len(data)
+        connection = self.tunnel.route(self.sid)
+        chunk = connection.chunk_size if connection is not None else MAX_LEGACY_DATA
+        for offset in range(0, len(data), chunk):
+            message = {'cmd': 'sync', 'data': data[offset:offset + chunk], 'id': self.sid}
+            if self.deflater is not None:
+                message = self.deflater.compress(message)
+            self.tunnel.dispatch(message)
+
+        if self.credit is not None:
+            self.credit -= len(data)
+        self.throttle(self.tunnel.backlogged(self.sid))
+
+    def add_credit(self, value):
+        if self.credit is None:
+            return
+        self.credit += value
+        self.update_reading()
+
+    def throttle(self, throttled):
+        self.throttled = throttled
+        self.update_reading()
+
+    # Reads while the local extreme gives us credit and the tunnel connection keeps up.
+    def update_reading(self):
+        reading = (self.credit is None or self.credit > 0) and not self.throttled
+        if reading != self.reading and self.transport is not None:
+            self.reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+
+    # Writes data coming from the tunnel, the credit is given back once the transport accepts more.
+    def received(self, data, compressed=False):
+        if compressed:
+            if self.inflater is None:
+                self.inflater = zlib.decompressobj()
+            data = self.inflater.decompress(data)
+        self.transport.write(data)
+        self.uploaded += len(data)
+        if self.window:
+            self.consumed += len(data)
+            self.acknowledge()
+
+    def acknowledge(self):
+        # Small acknowledges are delayed, the local extreme still has most of its credit.
+        if not self.writing or self.consumed < self.window // 4:
+            return
+
+        increment = self.consumed
+        # The destination keeps up with the data, so we let the local extreme send more at once. Not while the
+        # tunnel connection is backlogged, the window updates would wait behind its queue anyway.
+        if self.consumed >= self.window // 2 and self.window < self.tunnel.max_window:
+            if not self.transport.get_write_buffer_size() and not self.tunnel.congested(self.sid):
+                growth = min(self.window, self.tunnel.max_window - self.window)
+                self.window += growth
+                increment += growth
+
+        self.consumed = 0
+        self.tunnel.dispatch({'cmd': 'window', 'value': increment, 'id': self.sid})
+
+    def pause_writing(self):
+        self.writing = False
+
+    def resume_writing(self):
+        self.writing = True
+        if self.window:
+            self.acknowledge()
 
     def connection_lost(self, exc):
         self.logger.info('Closing stream connection #{}'.format(self.sid))
         # self.tunnel.dispatch({'cmd': 'disconnect', 'id': self.sid})
+        self.tunnel.close_stream(self.sid)
+
+    # The local extreme has closed the stream.
+    def close(self):
+        if self.transport is None:
+            self.task.cancel()
+            self.tunnel.close_stream(self.sid)
+        else:
+            self.transport.close()
 
     @asyncio.coroutine
     def connect(self, address, port):
         try:
             self.logger.info('Stream #{} trying to connect to {}:{}'.format(self.sid, address, port))
-            yield from self.tunnel.loop.create_connection(lambda: self, address, port)
+            begin = self.tunnel.loop.time()
+            yield from self.tunnel.resolver.create_connection(lambda: self, address, port)
+            self.tunnel.connect_latencies.observe(self.tunnel.loop.time() - begin)
             status = 0
 
         except TimeoutError:
@@ -47,6 +896,9 @@ class Stream(asyncio.Protocol):
         except ConnectionRefusedError:
             self.logger.debug('Connection refused')
             status = 5
+        except socket.gaierror as e:
+            self.logger.debug('Name resolution error: {}'.format(e))
+            status = 4
         except asyncio.CancelledError:
             return
         except GeneratorExit:
@@ -61,67 +913,446 @@ class Stream(asyncio.Protocol):
         self.tunnel.dispatch({'cmd': 'status', 'value': status, 'id': self.sid})
 
         if status != 0:
-            del self.tunnel.streams[self.sid]
+            self.tunnel.failed += 1
+            self.tunnel.close_stream(self.sid)
+
+
+class Connection:
+
+    def __init__(self, writer, loop, batch_size=BATCH_SIZE, batch_delay=DELAY, budget=QUEUE_BUDGET):
+        self.writer = writer
+        self.loop = loop
+        self.scheduler = Scheduler(writer, loop, batch_size=batch_size, delay=batch_delay, budget=budget)
+        # What the local extreme agreed on through this connection (JSON until its hello): frame header, biggest
+        # data frames, credit it grants to each new stream (None without flow control) and zlib level of the
+        # data we send (None without compression).
+        self.header = None
+        self.chunk_size = MAX_LEGACY_DATA
+        self.window = None
+        self.compression = None
+        # Heartbeat and its timer, if the local extreme answers pings.
+        self.heartbeat = None
+        self.timer = None
+        # Session resumption (see tunnels/tcp/local/tcp.py).
+        self.link = None
+        self.received = 0
+        self.reported = 0
+        self.ack_timer = None
+        self.expiry = None
+
+    def write(self, message, priority=BULK):
+        if self.header is None:
+            frame = (encode_json(message),)
+        else:
+            frame = encode_frame(message, self.header)
+
+        # Stream data (and its end) keeps its order, other messages go first.
+        if message['cmd'] in ('sync', 'disconnect', 'datagram'):
+            self.scheduler.push(message['id'], frame, priority)
+        else:
+            self.scheduler.push_control(frame)
+
+    def count(self):
+        self.received += 1
+        if self.received - self.reported >= ACK_FRAMES:
+            self.acknowledge()
+        elif self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(ACK_DELAY, self.acknowledge)
+
+    def acknowledge(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.scheduler.writer is not None:
+            self.reported = self.received
+            self.writer.writelines(encode_frame({'cmd': 'ack', 'value': self.received & 0xffffffff}, self.header))
 
 
 class Tunnel:
 
-    def __init__(self, host, port, logger):
+    def __init__(self, host, port, logger, window=WINDOW, max_window=MAX_WINDOW, connections=1,
+                 priority_ports=PRIORITY_PORTS, compression=COMPRESSION, batch_size=BATCH_SIZE, batch_delay=DELAY,
+                 dns_ttl=DNS_TTL, dns_negative_ttl=DNS_NEGATIVE_TTL, dns_cache_size=DNS_CACHE_SIZE,
+                 udp_timeout=UDP_TIMEOUT, metrics_ip='127.0.0.1', metrics_port=None, heartbeat=HEARTBEAT,
+                 heartbeat_misses=MISSES, resume_timeout=RESUME_TIMEOUT, replay_size=REPLAY_SIZE,
+                 queue_budget=QUEUE_BUDGET):
         self.host = host
         self.port = port
         self.logger = logger
+        # Credit we grant to each new stream, the one the local extreme grants is agreed by each connection.
+        self.initial_window = int(window)
+        self.max_window = max(int(max_window), self.initial_window)
         self.loop = None
         self.tunnel = None
-        self.writer = None
         self.streams = {}
         self.running = False
         self.pending_tasks = []
 
+        # Pool of tunnel connections. Each stream answers through the connection its last message came
+        # from, and moves to another one if that connection dies.
+        self.number_of_connections = max(int(connections), 1)
+        self.connections = []
+        self.routes = {}
+
+        # Streams to these destination ports are scheduled before the bulk ones.
+        self.priority_ports = parse_ports(priority_ports)
+
+        # Frames are written in batches of up to "batch_size" bytes, gathered during "batch_delay"
+        # microseconds (or one loop iteration).
+        self.batch_size = int(batch_size)
+        self.batch_delay = int(batch_delay)
+        self.queue_budget = int(queue_budget)
+
+        # zlib level of the data we send, if the local extreme agrees on it.
+        self.level = int(compression)
+
+        # Name resolution cache of the streams, it needs the loop.
+        self.dns = (dns_ttl, dns_negative_ttl, dns_cache_size)
+        self.resolver = None
+
+        # UDP sockets of the SOCKS5 associations, by stream id.
+        self.associations = {}
+        self.udp_timeout = float(udp_timeout)
+
+        # Seconds between pings (0 disables them), and unanswered intervals before a connection is dropped.
+        self.heartbeat = float(heartbeat)
+        self.heartbeat_misses = int(heartbeat_misses)
+
+        # Links of the local extreme by (session, link) id. Lost ones keep their streams for "resume_timeout"
+        # seconds, waiting for a new connection to resume them.
+        self.links = {}
+        self.resume_timeout = float(resume_timeout)
+        self.replay_size = int(replay_size)
+
+        # Metrics, served on "metrics_port" if there is one. Bytes of the open streams are added when they are
+        # collected, and "lost" are the tunnel connections which were not replaced yet.
+        self.stats = (metrics_ip, metrics_port)
+        self.stats_server = None
+        self.opened = 0
+        self.failed = 0
+        self.uploaded = 0
+        self.downloaded = 0
+        self.connect_latencies = Histogram(LATENCIES)
+        self.lifetimes = Histogram(LIFETIMES)
+        self.sizes = Histogram(SIZES)
+        self.frames_in = 0
+        self.frames_out = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.lost = 0
+        self.dead = 0
+        self.resumed = 0
+
+    def route(self, sid):
+        connection = self.routes.get(sid)
+        if connection is not None and (connection in self.connections or connection.expiry is not None):
+            return connection
+
+        if not self.connections:
+            return None
+
+        connection = self.connections[sid % len(self.connections)]
+        if sid in self.streams:
+            self.routes[sid] = connection
+        return connection
+
+    # Whether the connection of a stream has more queued than its budget (its streams are paused), or more
+    # than fits in its transport buffer.
+    def backlogged(self, sid):
+        connection = self.routes.get(sid)
+        return connection is not None and connection.scheduler.backlogged
+
+    def congested(self, sid):
+        connection = self.routes.get(sid)
+        return connection is not None and connection.scheduler.queued > connection.scheduler.limit
+
+    # The queue of the connection went under half its budget (or the connection is gone), its streams
+    # read again.
+    def drained(self, connection):
+        for sid, route in list(self.routes.items()):
+            if route is connection and sid in self.streams:
+                self.streams[sid].throttle(False)
+
     # Send message back to the other tunnel extreme.
     def dispatch(self, message):
         if not self.running:
             return
-        data = json.dumps(message).encode()
-        self.logger.debug('outgoing message: {}'.format(message))
-        self.writer.write(struct.pack('>H', len(data)) + data)
+        connection = self.route(message.get('id', 0))
+        if connection is None:
+            return
+        self.logger.debug('outgoing message %s #%s (%d bytes)', message['cmd'], message.get('id'),
+                          len(message.get('data', '')))
+        stream = self.streams.get(message.get('id'))
+        if message['cmd'] == 'datagram':
+            priority = INTERACTIVE
+        else:
+            priority = BULK if stream is None else stream.priority
+        connection.write(message, priority)
+        self.frames_out += 1
+
+    def close_stream(self, sid):
+        stream = self.streams.pop(sid, None)
+        self.routes.pop(sid, None)
+        if stream is not None:
+            self.uploaded += stream.uploaded
+            self.downloaded += stream.downloaded
+            if stream.connected:
+                self.lifetimes.observe(self.loop.time() - stream.begin)
+                self.sizes.observe(stream.uploaded + stream.downloaded)
+
+    # Pings the local extreme, the connection is aborted once its pings go unanswered for too long.
+    def beat(self, connection):
+        heartbeat = connection.heartbeat
+        ping = heartbeat.beat(self.loop.time())
+        if heartbeat.expired():
+            self.logger.warning('no pong in {:.0f} seconds, dropping the connection'.format(
+                heartbeat.interval * heartbeat.missed))
+            self.dead += 1
+            connection.timer = None
+            connection.writer.transport.abort()
+            return
+
+        if ping is not None:
+            connection.write(ping)
+        connection.timer = self.loop.call_later(heartbeat.interval, self.beat, connection)
+
+    # Registers the link of a new connection, or resumes the lost one it names. Returns the connection the
+    # handler has to use from now on, and the frames it received if the link was resumed.
+    def resume(self, connection, message):
+        # Each worker of the local extreme has a session of its own.
+        key = (message.get('session'), message.get('link'))
+        link = self.links.get(key)
+        if link is not None and link.header == connection.header and \
+                link.scheduler.attach(connection.writer, message.get('received', 0)):
+            # The old connection may not know it is gone yet.
+            if link.expiry is not None:
+                link.expiry.cancel()
+                link.expiry = None
+            else:
+                link.writer.transport.abort()
+            if link.timer is not None:
+                link.timer.cancel()
+                link.timer = None
+            link.heartbeat = None
+            link.writer = connection.writer
+            if link in self.connections:
+                self.connections.remove(link)
+            self.connections[self.connections.index(connection)] = link
+            self.resumed += 1
+            self.logger.info('link {} resumed, {} frames sent again'.format(key[1], len(link.scheduler.resend)))
+            return link, link.received
+
+        if link is not None:
+            self.abandon(link)
+        connection.link = key
+        self.links[key] = connection
+        return connection, None
+
+    # The link was not resumed in time, its streams and associations are closed.
+    def abandon(self, connection):
+        if connection.expiry is not None:
+            connection.expiry.cancel()
+            connection.expiry = None
+        if self.links.get(connection.link) is connection:
+            del self.links[connection.link]
+
+        sids = [sid for sid, route in self.routes.items() if route is connection]
+        self.logger.info('link {} lost with {} streams'.format(connection.link[1], len(sids)))
+        for sid in sids:
+            self.routes.pop(sid)
+            if sid in self.streams:
+                self.streams[sid].close()
+            elif sid in self.associations:
+                self.associations.pop(sid).close()
+
+    # Smoothed round trip time of the tunnel (its fastest connection), None until a pong arrived.
+    def rtt(self):
+        rtts = [connection.heartbeat.rtt for connection in self.connections
+                if connection.heartbeat is not None and connection.heartbeat.rtt is not None]
+        return min(rtts) if rtts else None
+
+    def metrics(self):
+        streams = list(self.streams.values())
+        buffered = sum(connection.writer.transport.get_write_buffer_size() + connection.scheduler.queued
+                       for connection in self.connections)
+        rtt = self.rtt()
+        families = [] if rtt is None else [('tunnel_rtt_seconds', 'gauge', 'Smoothed round trip time.', rtt)]
+        return families + [
+            ('streams', 'gauge', 'Open streams.', len(streams)),
+            ('streams_opened_total', 'counter', 'Streams the local extreme asked for.', self.opened),
+            ('connect_failures_total', 'counter', 'Streams whose destination could not be reached.', self.failed),
+            ('stream_bytes_total', 'counter', 'Stream data to the destinations (upload) and from them (download).',
+             {'direction="upload"': self.uploaded + sum(stream.uploaded for stream in streams),
+              'direction="download"': self.downloaded + sum(stream.downloaded for stream in streams)}),
+            ('connect_duration_seconds', 'histogram', 'Seconds destinations took to accept the connection.',
+             self.connect_latencies),
+            ('stream_duration_seconds', 'histogram', 'Seconds the closed streams lasted.', self.lifetimes),
+            ('stream_size_bytes', 'histogram', 'Bytes moved by each closed stream, both directions.', self.sizes),
+            ('associations', 'gauge', 'UDP associations.', len(self.associations)),
+            ('tunnel_connections', 'gauge', 'Tunnel connections.', len(self.connections)),
+            ('tunnel_connects_total', 'counter', 'Tunnel connections established.', self.connects),
+            ('tunnel_reconnects_total', 'counter', 'Tunnel connections established to replace lost ones.',
+             self.reconnects),
+            ('tunnel_dead_connections_total', 'counter', 'Tunnel connections dropped for not answering pings.',
+             self.dead),
+            ('tunnel_resumed_total', 'counter', 'Lost links resumed by a new connection.', self.resumed),
+            ('tunnel_lost_links', 'gauge', 'Lost links waiting to be resumed.',
+             sum(1 for link in self.links.values() if link.expiry is not None)),
+            ('tunnel_replay_bytes', 'gauge', 'Bytes of the frames kept until they are acknowledged.',
+             sum(link.scheduler.replay_size for link in self.links.values())),
+            ('tunnel_frames_total', 'counter', 'Messages sent (out) and received (in) through the tunnel.',
+             {'direction="in"': self.frames_in, 'direction="out"': self.frames_out}),
+            ('tunnel_buffered_bytes', 'gauge', 'Bytes queued by the schedulers and the transports.', buffered),
+            ('dns_requests_total', 'counter', 'Names asked to the resolver cache, by how they were answered.',
+             {'result="hit"': self.resolver.hits, 'result="lookup"': self.resolver.misses,
+              'result="merged"': self.resolver.merged}),
+            ('dns_failures_total', 'counter', 'Lookups which failed.', self.resolver.failures),
+            ('dns_cached_names', 'gauge', 'Names in the resolver cache.', len(self.resolver.cache)),
+        ]
 
     @asyncio.coroutine
     def handler(self, reader, writer):
-        self.writer = writer
-        self.logger.info('connection ready')
+        connection = Connection(writer, self.loop, self.batch_size, self.batch_delay, self.queue_budget)
+        connection.scheduler.drained = functools.partial(self.drained, connection)
+        self.connections.append(connection)
+        header = None
+        self.connects += 1
+        if self.lost:
+            self.lost -= 1
+            self.reconnects += 1
+        self.logger.info('connection ready ({} of {})'.format(len(self.connections), self.number_of_connections))
         # Handles each incoming message
 
         while self.running:
             try:
-                data = yield from reader.readexactly(2)
-                size = struct.unpack('>H', data)[0]
-                data = yield from reader.readexactly(size)
-                message = json.loads(data.decode('ascii'))
-                self.logger.debug('incoming message: {}'.format(message))
-
-                if message['cmd'] == 'connect':
-                    stream = Stream(message['id'], self)
-                    self.streams[stream.sid] = stream
-                    stream.task = asyncio.async(stream.connect(message['addr'], message['port']), loop=self.loop)
-                    # task = asyncio.async(stream.connect(message['addr'], message['port']), loop=self.loop)
-                    # self.pending_tasks.append(task)
-
-                elif message['cmd'] == 'sync':
-                    if message['id'] not in self.streams:
-                        self.dispatch({'cmd': 'status', 'value': 5, 'id': message['id']})
+                messages = yield from reader.read(header)
+                self.frames_in += len(messages)
+                for message in messages:
+                    self.logger.debug('incoming message %s #%s (%d bytes)', message['cmd'], message.get('id'),
+                                      len(message.get('data', '')))
+
+                    if message['cmd'] == 'hello':
+                        # From now on we talk binary, the local extreme will do the same after "upgrade".
+                        version = min(message['version'], VERSION)
+                        caps = [cap for cap in message.get('caps', []) if cap in CAPABILITIES]
+                        if not self.level and 'zlib' in caps:
+                            caps.remove('zlib')
+                        hello = {'cmd': 'hello', 'version': version, 'caps': caps, 'window': self.initial_window}
+                        # Frames still queued were encoded as JSON, they have to go before the hello.
+                        connection.scheduler.flush_all()
+                        connection.header, connection.chunk_size = negotiate(caps)
+                        if 'resume' in caps:
+                            # Frames the resumed link has to write again go after the hello (attach only
+                            # schedules them).
+                            connection, received = self.resume(connection, message)
+                            if received is not None:
+                                hello['received'] = received & 0xffffffff
+                            elif self.resume_timeout > 0:
+                                connection.scheduler.enable_replay(self.replay_size)
+                        writer.write(encode_json(hello))
+                        connection.window = message.get('window') if 'window' in caps else None
+                        # Compressed data can be a bit bigger than the original, so it needs large frames.
+                        connection.compression = self.level if 'zlib' in caps and 'large' in caps else None
+                        if 'ping' in caps and self.heartbeat > 0 and connection.heartbeat is None:
+                            connection.heartbeat = Heartbeat(self.heartbeat, self.heartbeat_misses)
+                            connection.timer = self.loop.call_later(self.heartbeat, self.beat, connection)
+                        self.logger.info('using binary protocol version {} {}'.format(version, caps))
+                        continue
+
+                    elif message['cmd'] == 'upgrade':
+                        header = connection.header
+                        continue
+
+                    elif message['cmd'] == 'ack':
+                        connection.scheduler.acknowledge(message['value'])
                         continue
-                    data = base64.b64decode(message['data'].encode('ascii'))
-                    self.streams[message['id']].transport.write(data)
 
-                # self.pending_tasks = [task for task in self.pending_tasks if not task.done()]
+                    if header is not None and connection.link is not None:
+                        connection.count()
+
+                    if message['cmd'] == 'ping':
+                        connection.write({'cmd': 'pong', 'value': message['value']})
+                        continue
+
+                    elif message['cmd'] == 'pong':
+                        if connection.heartbeat is not None:
+                            connection.heartbeat.pong(message, self.loop.time())
+                        continue
+
+                    if message['id'] in self.streams or message['id'] in self.associations:
+                        self.routes[message['id']] = connection
+
+                    if message['cmd'] == 'connect':
+                        stream = Stream(message['id'], self, connection)
+                        if message['port'] in self.priority_ports:
+                            stream.priority = INTERACTIVE
+                        self.streams[stream.sid] = stream
+                        self.routes[stream.sid] = connection
+                        self.opened += 1
+                        stream.task = asyncio.async(stream.connect(message['addr'], message['port']), loop=self.loop)
+                        # task = asyncio.async(stream.connect(message['addr'], message['port']), loop=self.loop)
+                        # self.pending_tasks.append(task)
+
+                    elif message['cmd'] == 'sync':
+                        if message['id'] not in self.streams:
+                            connection.write({'cmd': 'status', 'value': 5, 'id': message['id']})
+                            continue
+                        self.streams[message['id']].received(message['data'], message.get('compressed', False))
+
+                    elif message['cmd'] == 'window':
+                        if message['id'] in self.streams:
+                            self.streams[message['id']].add_credit(message['value'])
 
-            except asyncio.IncompleteReadError:
+                    elif message['cmd'] == 'datagram':
+                        association = self.associations.get(message['id'])
+                        if association is None:
+                            association = self.associations[message['id']] = Association(message['id'], self)
+                            self.routes[message['id']] = connection
+                        asyncio.async(association.send(message['addr'], message['port'], message['data']),
+                                      loop=self.loop)
+
+                    elif message['cmd'] == 'disconnect':
+                        if message['id'] in self.streams:
+                            self.streams[message['id']].close()
+                        elif message['id'] in self.associations:
+                            self.associations.pop(message['id']).close()
+                            self.routes.pop(message['id'], None)
+
+                    # self.pending_tasks = [task for task in self.pending_tasks if not task.done()]
+
+            except (asyncio.IncompleteReadError, ConnectionError):
                 self.logger.debug('tunnel connection lost')
-                return
+                break
+
+            except zlib.error as e:
+                # The stream data of the connection can not be trusted anymore.
+                self.logger.warning('corrupt compressed data, dropping the connection: {}'.format(e))
+                break
 
             except KeyboardInterrupt:
                 self.loop.stop()
-                return
+                break
+
+        # A new connection took over the link, it is not ours to clean up anymore.
+        if connection.writer is writer:
+            self.connections.remove(connection)
+            if connection.timer is not None:
+                connection.timer.cancel()
+            if connection.ack_timer is not None:
+                connection.ack_timer.cancel()
+                connection.ack_timer = None
+            if connection.scheduler.replay is not None and self.running:
+                connection.scheduler.detach()
+                connection.expiry = self.loop.call_later(self.resume_timeout, self.abandon, connection)
+            else:
+                if connection.link is not None:
+                    self.links.pop(connection.link, None)
+                # Its streams move to other connections.
+                self.drained(connection)
+        if self.running:
+            self.lost += 1
+        writer.close()
+        self.logger.info('connection closed, {}'.format(connection.scheduler.report()))
 
     # Keeps connecting with the other tunnel extreme.
     @asyncio.coroutine
@@ -129,8 +1360,9 @@ class Tunnel:
         while self.running:
             self.logger.info('connecting to {}:{}'.format(self.host, self.port))
             try:
-                connect_coro = asyncio.open_connection(self.host, self.port, loop=self.loop)
-                reader, writer = yield from asyncio.wait_for(connect_coro, 8.0)
+                connect_coro = self.loop.create_connection(lambda: FrameReader(self.loop), self.host, self.port)
+                transport, reader = yield from asyncio.wait_for(connect_coro, 8.0)
+                writer = asyncio.StreamWriter(transport, reader, None, self.loop)
                 yield from self.handler(reader, writer)
 
             except asyncio.TimeoutError:
@@ -153,22 +1385,33 @@ class Tunnel:
                 break
 
     @asyncio.coroutine
-    def stop_and_wait(self):
-        # First we have to stop the tunnel connection.
+    def stop_and_wait(self, reverse):
+        if self.stats_server is not None:
+            self.stats_server.close()
+
+        # First we have to stop the tunnel connections.
         self.running = False
+        for connection in self.connections:
+            connection.writer.close()
+        for connection in self.links.values():
+            if connection.expiry is not None:
+                connection.expiry.cancel()
         try:
-            self.writer.close()
-            if True:
-                self.tunnel.cancel()
-                yield from self.tunnel
+            if reverse:
+                for task in self.tunnel:
+                    task.cancel()
+                yield from asyncio.wait(self.tunnel, loop=self.loop)
             else:
                 self.tunnel.close()
                 yield from asyncio.wait_for(self.tunnel.wait_closed(), 2.0, loop=self.loop)
         except:
             pass
 
+        for association in self.associations.values():
+            association.close()
+
         # Then, we start stopping the streams
-        for stream in self.streams.values():
+        for stream in list(self.streams.values()):
             try:
                 if stream.task is None:
                     stream.transport.close()
@@ -180,23 +1423,33 @@ class Tunnel:
 
     def start(self, reverse):
         self.loop = asyncio.get_event_loop()
+        self.resolver = Resolver(self.loop, *self.dns)
 
         try:
             self.running = True
             if reverse:
                 # self.loop.run_until_complete(self.connect())
-                self.tunnel = asyncio.async(self.connect(), loop=self.loop)
+                self.tunnel = [asyncio.async(self.connect(), loop=self.loop)
+                               for index in range(0, self.number_of_connections)]
 
             else:
-                server_coroutine = asyncio.start_server(self.handler, self.host, self.port, loop=self.loop)
+                server_coroutine = self.loop.create_server(lambda: FrameReader(self.loop, self.handler), self.host,
+                                                           self.port)
                 self.tunnel = self.loop.run_until_complete(server_coroutine)
                 self.logger.info('listening on {}:{}'.format(self.host, self.port))
 
+            if self.stats[1]:
+                stats = asyncio.start_server(lambda reader, writer: scrape(self, reader, writer), self.stats[0],
+                                             int(self.stats[1]), loop=self.loop)
+                self.stats_server = self.loop.run_until_complete(stats)
+                self.logger.info('metrics on http://{}:{}/metrics'.format(*self.stats))
+
             self.loop.run_forever()
         except KeyboardInterrupt:
             self.logger.info('stopping tunnel')
 
-        self.loop.run_until_complete(self.stop_and_wait())
+        self.loop.run_until_complete(self.stop_and_wait(reverse))
+        self.logger.info('name resolution: {}'.format(self.resolver.report()))
 
         self.logger.debug('closing loop')
         self.loop.close()
@@ -210,11 +1463,17 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--reverse', action='store_true', help='use reverse connection')
     parser.add_argument('-l', '--log', choices=['debug', 'info', 'warning', 'error', 'critical'])
     parser.add_argument('-c', '--config', default='', help='uses a configuration file')
+    parser.add_argument('-m', '--metrics-port', type=int, help='serves Prometheus metrics on this port (default: off)')
 
     args = parser.parse_args()
 
     # Default configuration
-    config = {'ip': '127.0.0.1', 'port': 8888, 'log': 'info', 'reverse': False}
+    config = {'ip': '127.0.0.1', 'port': 8888, 'log': 'info', 'reverse': False,
+              'window': WINDOW, 'max_window': MAX_WINDOW, 'connections': 1, 'priority_ports': PRIORITY_PORTS,
+              'compression': COMPRESSION, 'batch_size': BATCH_SIZE, 'batch_delay': DELAY, 'dns_ttl': DNS_TTL,
+              'dns_negative_ttl': DNS_NEGATIVE_TTL, 'dns_cache_size': DNS_CACHE_SIZE, 'udp_timeout': UDP_TIMEOUT,
+              'metrics_ip': '127.0.0.1', 'metrics_port': None, 'heartbeat': HEARTBEAT, 'heartbeat_misses': MISSES,
+              'resume_timeout': RESUME_TIMEOUT, 'replay_size': REPLAY_SIZE, 'queue_budget': QUEUE_BUDGET}
 
     # Config file configuration
     if args.config:
@@ -224,7 +1483,7 @@ if __name__ == "__main__":
             for key, value in config_file.items('tcp'):
                 config[key.lower()] = value if value is None else value.lower()
 
-    for option in ['ip', 'port', 'reverse', 'log']:
+    for option in ['ip', 'port', 'reverse', 'log', 'metrics_port']:
         value = getattr(args, option)
         config[option] = value if value else config[option]
 
@@ -233,5 +1492,10 @@ if __name__ == "__main__":
     logger = logging.getLogger('remote3')
     logger.setLevel(getattr(logging, config['log'].upper()))
 
-    tunnel = Tunnel(config['ip'], config['port'], logger)
+    tunnel = Tunnel(config['ip'], config['port'], logger, config['window'], config['max_window'],
+                    config['connections'], config['priority_ports'], config['compression'], config['batch_size'],
+                    config['batch_delay'], config['dns_ttl'], config['dns_negative_ttl'], config['dns_cache_size'],
+                    config['udp_timeout'], config['metrics_ip'], config['metrics_port'], config['heartbeat'],
+                    config['heartbeat_misses'], config['resume_timeout'], config['replay_size'],
+                    config['queue_budget'])
     tunnel.start(args.reverse)
@@ -0,0 +1,155 @@
+
+import sys
+import signal
+import socket
+import asyncio
+import logging
+
+import metrics
+
+
+# Seconds before a crashed worker is started again, and seconds the workers have to stop.
+RESTART_DELAY = 1.0
+STOP_TIMEOUT = 5.0
+
+
+# Runs "workers" copies of bogeyman.py, each with its own SOCKS5 listener (on the same port) and its own
+# tunnel. Crashed workers are started again, the ones which stop cleanly (the remote extreme asked for it)
+# are not. Each worker gets a socket pair channel to send its metrics when the supervisor asks.
+class Supervisor:
+
+    def __init__(self, workers, arguments):
+        self.logger = logging.getLogger('bogeyman')
+        self.number_of_workers = int(workers)
+        self.arguments = list(arguments)
+        self.loop = None
+        self.running = False
+        self.tasks = []
+
+        # Process and channel of each worker, by index.
+        self.processes = {}
+        self.channels = {}
+        self.requests = 0
+        self.finished = 0
+
+        # Metrics
+        self.starts = 0
+        self.restarts = 0
+
+    @asyncio.coroutine
+    def watch(self, index):
+        while self.running:
+            channel, other = socket.socketpair()
+            command = [sys.executable, sys.argv[0], '--worker', str(other.fileno())] + self.arguments
+            try:
+                process = yield from asyncio.create_subprocess_exec(*command, pass_fds=(other.fileno(),),
+                                                                    loop=self.loop)
+            finally:
+                other.close()
+            reader, writer = yield from asyncio.open_connection(sock=channel, loop=self.loop)
+            self.processes[index] = process
+            self.channels[index] = (reader, writer, asyncio.Lock(loop=self.loop))
+            self.starts += 1
+            self.logger.info('worker {} started (pid {})'.format(index, process.pid))
+
+            code = yield from process.wait()
+            del self.processes[index]
+            del self.channels[index]
+            writer.close()
+            if not self.running:
+                break
+            if not code:
+                self.logger.info('worker {} stopped'.format(index))
+                # Nothing left to do once every worker stopped by itself.
+                self.finished += 1
+                if self.finished == self.number_of_workers:
+                    self.loop.stop()
+                break
+
+            self.logger.warning('worker {} exited with code {}, restarting it'.format(index, code))
+            self.restarts += 1
+            yield from asyncio.sleep(RESTART_DELAY, loop=self.loop)
+
+    # Asks a worker for its metrics, None if it does not answer.
+    @asyncio.coroutine
+    def collect(self, index):
+        reader, writer, lock = self.channels[index]
+        with (yield from lock):
+            self.requests += 1
+            request = self.requests
+            writer.write('{}\n'.format(request).encode())
+            try:
+                # Answers to requests which timed out arrive late, they are skipped.
+                while True:
+                    line = yield from asyncio.wait_for(reader.readline(), metrics.TIMEOUT, loop=self.loop)
+                    if not line:
+                        return None
+                    number, _, data = line.partition(b' ')
+                    if int(number) == request:
+                        return metrics.load(data)
+            except (asyncio.TimeoutError, ConnectionError, ValueError):
+                return None
+
+    # The metrics of the workers are added up.
+    @asyncio.coroutine
+    def metrics(self):
+        families = []
+        for index in list(self.channels):
+            result = yield from self.collect(index)
+            if result is not None:
+                families.append(result)
+        return metrics.merge(families) + [
+            ('workers', 'gauge', 'Running worker processes.', len(self.processes)),
+            ('worker_starts_total', 'counter', 'Worker processes started.', self.starts),
+            ('worker_restarts_total', 'counter', 'Worker processes started again after crashing.', self.restarts),
+        ]
+
+    @asyncio.coroutine
+    def wait(self):
+        self.running = False
+        for process in self.processes.values():
+            try:
+                process.send_signal(signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+        done, pending = yield from asyncio.wait(self.tasks, timeout=STOP_TIMEOUT, loop=self.loop)
+        for process in self.processes.values():
+            self.logger.warning('worker (pid {}) did not stop, killing it'.format(process.pid))
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        if pending:
+            yield from asyncio.wait(pending, loop=self.loop)
+
+    def stop(self):
+        self.loop.run_until_complete(self.wait())
+
+    def start(self, loop):
+        self.loop = loop
+        self.running = True
+        for index in range(0, self.number_of_workers):
+            self.tasks.append(asyncio.async(self.watch(index), loop=loop))
+
+
+# Worker side of the channel: answers each request with the metrics of the sources. The worker stops if
+# the supervisor is gone.
+@asyncio.coroutine
+def serve(fileno, sources, loop):
+    channel = socket.socket(fileno=fileno)
+    reader, writer = yield from asyncio.open_connection(sock=channel, loop=loop)
+    while True:
+        try:
+            line = yield from reader.readline()
+        except ConnectionError:
+            line = b''
+        if not line:
+            logging.getLogger('bogeyman').warning('supervisor is gone, stopping')
+            loop.stop()
+            return
+
+        families = []
+        for source in sources:
+            families.extend(source.metrics())
+        writer.write(line.strip() + b' ' + metrics.dump(families) + b'\n')